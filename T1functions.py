@@ -42,5 +42,5 @@ def calc_new_qcj(q_cj, q_th, new_q_th):
     :return: New value of jth sediment concentration (turbidity current)
     '''
     with np.errstate(divide='ignore', invalid='ignore'):
-        var = np.nan_to_num(q_cj * (q_th / new_q_th)[:, :, np.newaxis])
+        var = np.nan_to_num(q_cj * (q_th / new_q_th)[..., np.newaxis])
     return var
\ No newline at end of file
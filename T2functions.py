@@ -16,11 +16,11 @@ def rescale_Dj_E_j(Dj,dt,porosity,q_th,q_cj,p_adh,q_cbj,Ej,q_d):
     :param q_d: Soft sediment thickness in sea bed
     :return: Rescaled deposition and erosion rate
     '''
-    Dj = np.where(Dj*dt/(1-porosity) <= q_th[:,:,None]*q_cj-p_adh, Dj, (q_th[:,:,None]*q_cj-p_adh)*(1-porosity)/dt)
+    Dj = np.where(Dj*dt/(1-porosity) <= q_th[...,None]*q_cj-p_adh, Dj, (q_th[...,None]*q_cj-p_adh)*(1-porosity)/dt)
     Dj[Dj<0] = 0
 
     leftover = 0
-    Ej = np.where(q_cbj*Ej*dt/(1-porosity) <= q_d[:,:,None]*q_cbj, Ej, ((q_d-leftover)*(1-porosity)/dt)[:,:,None])
+    Ej = np.where(q_cbj*Ej*dt/(1-porosity) <= q_d[...,None]*q_cbj, Ej, ((q_d-leftover)*(1-porosity)/dt)[...,None])
     Ej[Ej<0] = 0 # Should not be necessary
     Ej[np.isinf(Ej)]=0
     return Dj, Ej
@@ -85,6 +85,107 @@ def T2_calc_change_qd(pt, Dj, q_cbj, Ej, gamma, q_th, q_cj):
     return np.nan_to_num(var)[1:-1,1:-1]
 
 
+def T2_exchange(dt, Dj, Ej, porosity, q_th, q_cj, p_adh, q_cbj, q_d):
+    '''
+    Erosion and deposition in one pass. Dj and Ej are rescaled as in rescale_Dj_E_j, the net exchange\
+    with the sea bed is computed once per cell and sediment class, and the changes of T2_calc_change_qd,\
+    T2calc_change_qcj and T2_calc_change_qCBJ are all derived from it. Works for any shape with the\
+    sediment classes last, e.g. (Ny,Nx,Nj) or (N,Nj), and returns changes for the cells given.\
+    The work is split into T2_class_exchange and T2_class_change_qcbj, which can be called for blocks\
+    of sediment classes, and T2_sum_exchange, which sums over all classes.
+
+    :param dt: Time step. A scalar, or an array of the shape of q_th with one time step per cell.
+    :param Dj: Deposition rate
+    :param Ej: Erosion rate
+    :param porosity: porosity. Constant.
+    :param q_th: Turbidity current thickness
+    :param q_cj: jth current sediment volume concentration
+    :param p_adh: Unmovable amount of turbidity current
+    :param q_cbj: jth sediment sea bed fraction
+    :param q_d: Soft sediment thickness in sea bed
+    :return: Rescaled Dj, rescaled Ej, and the changes in q_d, q_cj (to be subtracted) and q_cbj
+    '''
+    Dj, Ej, net, var, change_qcj = T2_class_exchange(dt, Dj, Ej, porosity, q_th, q_cj, p_adh, q_cbj, q_d)
+    change_qd, total = T2_sum_exchange(dt, porosity, net, var)
+    change_qcbj = T2_class_change_qcbj(var, q_cbj, q_d, total)
+    return Dj, Ej, change_qd, change_qcj, change_qcbj
+
+
+def T2_class_exchange(dt, Dj, Ej, porosity, q_th, q_cj, p_adh, q_cbj, q_d):
+    '''
+    The part of T2_exchange that is independent for each sediment class. The class arrays may hold any\
+    subset of the sediment classes. Parameters as for T2_exchange.
+
+    :return: Rescaled Dj, rescaled Ej, the net deposition rate Dj - q_cbj*Ej, the net deposited volume\
+    over the time step and the change in q_cj (to be subtracted)
+    '''
+    dt = np.asarray(dt, dtype=float)
+    dt_j = dt[..., None]
+    # Computed in place where possible, as every temporary of shape (...,Nj) costs a pass over memory
+    with np.errstate(divide='ignore', invalid='ignore'):
+        available = q_th[..., None] * q_cj
+        available -= p_adh
+        moved = Dj * dt_j
+        moved /= 1 - porosity
+        keep = moved <= available
+        rescaled = available
+        rescaled *= 1 - porosity
+        rescaled /= dt_j
+        np.copyto(rescaled, Dj, where=keep)
+        Dj = rescaled
+        Dj[Dj < 0] = 0
+
+        np.multiply(q_cbj, Ej, out=moved)
+        moved *= dt_j
+        moved /= 1 - porosity
+        np.less_equal(moved, q_d[..., None] * q_cbj, out=keep)
+        rescaled = np.empty_like(moved)
+        rescaled[...] = (q_d * (1 - porosity) / dt)[..., None]
+        np.copyto(rescaled, Ej, where=keep)
+        Ej = rescaled
+        Ej[Ej < 0] = 0
+        Ej[np.isinf(Ej)] = 0
+
+        net = np.multiply(q_cbj, Ej, out=moved)
+        np.subtract(Dj, net, out=net)
+        var = (dt / (1 - porosity))[..., None] * net
+        change_qcj = np.nan_to_num(var / q_th[..., None], copy=False)
+    return Dj, Ej, net, var, change_qcj
+
+
+def T2_sum_exchange(dt, porosity, net, var):
+    '''
+    Sums the exchange of all sediment classes, always in the same order (see T2_class_exchange).
+
+    :param dt: Time step. A scalar or one time step per cell.
+    :param porosity: porosity. Constant.
+    :param net: Net deposition rate of all classes
+    :param var: Net deposited volume of all classes
+    :return: The change in soft sediment thickness, and the total net deposited volume
+    '''
+    factor = np.asarray(dt, dtype=float) / (1 - porosity)
+    change_qd = np.nan_to_num(factor * np.sum(net, axis=-1))
+    total = np.nan_to_num(np.sum(var, axis=-1))
+    return change_qd, total
+
+
+def T2_class_change_qcbj(var, q_cbj, q_d, total):
+    '''
+    The change in the jth bed sediment fraction, for any subset of the sediment classes.
+
+    :param var: Net deposited volume of the classes (see T2_class_exchange)
+    :param q_cbj: jth sediment sea bed fraction of the classes
+    :param q_d: Soft sediment thickness
+    :param total: Total net deposited volume of all classes (see T2_sum_exchange)
+    :return: The change in the jth bed sediment fraction
+    '''
+    with np.errstate(divide='ignore', invalid='ignore'):
+        change_qcbj = q_cbj / q_d[..., None]
+        change_qcbj *= total[..., None]
+        np.subtract(var / q_d[..., None], change_qcbj, out=change_qcbj)
+    return np.nan_to_num(change_qcbj, copy=False)
+
+
 def calc_erotionRate(Z_mj):
     '''
     :type Z_mj: numpy.ndarray(Ny,Nx,Nj)
@@ -116,7 +217,7 @@ def calc_Z_mj(kappa, Ustar, v_sj, f):
     '''
     # res = kappa * (np.sqrt(Ustar ** 2)[:, :, np.newaxis]) * v_sj * f # version used in geomorph
 
-    res = kappa * (np.sqrt(Ustar ** 2)[:, :, np.newaxis]) * f/v_sj  # version used in Salles Thesis & Imran et al
+    res = kappa * (np.sqrt(Ustar ** 2)[..., np.newaxis]) * f/v_sj  # version used in Salles Thesis & Imran et al
     return res
 
 def calc_kappa(D_s):  # TODO! SJEKK!
@@ -162,7 +263,7 @@ def calc_fofR(R_pj):
     :rtype: numpy.ndarray(Nj)
     :return: This function returns the value defined by eq.(40) TODO!
     '''
-    if (R_pj < 1):
+    if np.any(R_pj < 1):
         print("Undefined function value for R_pj<1 !")
     return np.where(R_pj >= 3.5, R_pj ** (0.6), 0.586 * R_pj ** (1.23))
 
@@ -214,7 +315,7 @@ def calc_nearBedConcentration_SusSed(D_sj, D_sg, q_cj):
     # res[:,:,1]
 
     with np.errstate(divide='ignore', invalid='ignore'):
-        res = (0.4 * (D_sj / D_sg[:, :, np.newaxis]) ** (1.64) + 1.64) * q_cj
+        res = (0.4 * (D_sj / D_sg[..., np.newaxis]) ** (1.64) + 1.64) * q_cj
     #         print("(D_sj/D_sg[:,:,np.newaxis])**(1.64).shape",((D_sj/D_sg[:,:,np.newaxis])**(1.64)).shape)
     return res
 
@@ -231,11 +332,11 @@ def calc_averageSedimentSize(q_cj: np.ndarray, D_sj: np.ndarray):
     :return: Geometric mean size of suspended sediment mixture in cell
     '''
     # mean =  np.sum(q_cj * D_sj, axis=2) # Arithmetic mean
-    scale = np.sum(q_cj, axis=2)
+    scale = np.sum(q_cj, axis=-1)
     # scale = 1
     len = D_sj.shape
 
-    mean = np.nan_to_num(np.prod(q_cj*D_sj,axis=2)/scale)**(1/len[0]) # geometric mean
+    mean = np.nan_to_num(np.prod(q_cj*D_sj,axis=-1)/scale)**(1/len[0]) # geometric mean
 
     return mean
 
@@ -0,0 +1,233 @@
+'''
+Stored performance baselines with regression detection.
+
+Measures the throughput of every rule of Hexgrid (in cell updates per second), of whole time steps, the
+peak resident memory of a short run and the import time of hexgrid. Every rule is timed on a fork of the
+same prepared grid, with a current in every cell, so that all samples see the same input. The results are
+compared with earlier runs on the same machine (the same fingerprint of CPU, Python and numpy) and with the
+same settings, stored in a local JSON history together with the commit they were measured at.
+
+A metric has regressed when it is worse than the median of the last --baseline-runs runs by more than both
+--min-change and --sigmas times the noise. The noise is estimated from the spread of the samples, as
+1.4826 times their median absolute deviation, relative to the median, of the new run and the baseline
+runs. Every regressed metric is listed, so a slowdown is attributed to the rule it is in. The run is
+added to the history when nothing regressed (see --record). Nothing needs a network connection.
+
+Usage: python benchmarks/baseline.py [--history FILE] [--size N] [--classes NJ] [--repeat N]
+                                     [--baseline-runs N] [--sigmas K] [--min-change F]
+                                     [--record {pass,always,never}]
+'''
+import argparse
+import datetime
+import hashlib
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+import warnings
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import numpy as np  # noqa: E402
+import runner  # noqa: E402
+from import_time import FORBIDDEN, PROBE  # noqa: E402
+
+SCENARIO = os.path.join(ROOT, 'scenarios', 'main.toml')
+HISTORY = os.path.join(ROOT, 'benchmarks', 'baseline.json')
+RULES = ('T_1', 'T_2', 'I_1', 'I_2', 'I_3', 'I_4', 'time_step')
+
+# Metrics other than the rules, and whether higher values are better
+HIGHER_IS_BETTER = dict({rule: True for rule in RULES}, peak_rss_mb=False, import_ms=False)
+UNITS = dict({rule: 'cells/s' for rule in RULES}, peak_rss_mb='MB', import_ms='ms')
+
+# Run in a fresh interpreter to measure the peak memory of building a grid and a few time steps
+RSS_PROBE = '''
+import json, resource, sys, warnings
+sys.path.insert(0, {root!r})
+sys.path.insert(0, {benchmarks!r})
+warnings.simplefilter('ignore')
+import baseline
+g = baseline.grid({size}, {classes})
+for i in range(5):
+    g.time_step()
+print(json.dumps(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss))
+'''
+
+
+def grid(size, Nj):
+    '''A grid of the scenario of main.toml with Nj sediment classes and a current in every cell.'''
+    rng = np.random.default_rng(0)
+    scenario = runner.load_scenario(SCENARIO)
+    scenario = dict(scenario, grid=dict(scenario['grid'], Nx=size, Ny=size),
+                    bed=dict(scenario['bed'], Q_cbj=[0.4 / Nj] * Nj),
+                    sources=[dict(scenario['sources'][0], Q_cj=[0.3 / Nj] * Nj)],
+                    constants=dict(scenario['constants'], rho_j=[2650] * Nj,
+                                   D_sj=np.linspace(0.0001, 0.00012, Nj).tolist()))
+    g = runner.build_grid(scenario)
+    g.Q_th[1:-1, 1:-1] = rng.uniform(0.5, 1.5, (size - 2, size - 2))
+    g.Q_v[1:-1, 1:-1] = rng.uniform(0.1, 0.3, (size - 2, size - 2))
+    g.Q_cj[1:-1, 1:-1] = rng.uniform(0, 0.3 / Nj, (size - 2, size - 2, Nj))
+    g.dt = g.calc_dt()
+    g.I_1()  # Outflows for I_2 and I_3
+    return g
+
+
+def rule_samples(g, rule, repeat):
+    '''Times a rule on repeat forks of g. Returns the samples in cell updates per second.'''
+    cells = (g.Ny - 2) * (g.Nx - 2)
+    samples = []
+    for i in range(repeat):
+        fork = g.fork()
+        for name in fork.SUBSTATES:  # Copy the shared substates before timing
+            getattr(fork, name)
+        t = time.perf_counter()
+        getattr(fork, rule)()
+        samples.append(cells / (time.perf_counter() - t))
+    return samples
+
+
+def rss_samples(size, classes, repeat):
+    '''Peak resident memory in MB of building a grid and running 5 steps in fresh interpreters.'''
+    code = RSS_PROBE.format(root=ROOT, benchmarks=os.path.join(ROOT, 'benchmarks'), size=size, classes=classes)
+    return [json.loads(subprocess.run([sys.executable, '-c', code], cwd=ROOT, capture_output=True, text=True,
+                                      check=True).stdout) / 1024 for i in range(repeat)]
+
+
+def import_samples(repeat):
+    '''Import times of hexgrid in ms in fresh interpreters (see import_time.py).'''
+    return [json.loads(subprocess.run([sys.executable, '-c', PROBE.format(module='hexgrid', forbidden=FORBIDDEN)],
+                                      cwd=ROOT, capture_output=True, text=True, check=True).stdout)['seconds'] * 1e3
+            for i in range(repeat)]
+
+
+def fingerprint():
+    '''Description of the machine and software the benchmarks ran on, and a short hash of it.'''
+    cpu = platform.processor()
+    try:
+        with open('/proc/cpuinfo') as file:
+            cpu = next((line.split(':', 1)[1].strip() for line in file if line.startswith('model name')), cpu)
+    except OSError:
+        pass
+    machine = {'cpu': cpu, 'cpus': os.cpu_count(), 'machine': platform.machine(), 'system': platform.system(),
+               'python': platform.python_version(), 'numpy': np.__version__}
+    return hashlib.sha256(json.dumps(machine, sort_keys=True).encode()).hexdigest()[:12], machine
+
+
+def commit():
+    '''The current git commit, with -dirty if files that are tracked have been changed, or None without git.'''
+    try:
+        head = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True, text=True,
+                              check=True).stdout.strip()
+        dirty = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=ROOT,
+                               capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return head + ('-dirty' if dirty else '')
+
+
+def load_history(path):
+    if not os.path.exists(path):
+        return {'runs': []}
+    with open(path) as file:
+        return json.load(file)
+
+
+def save_history(path, history):
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path + '.tmp', 'w') as file:
+        json.dump(history, file, indent=1)
+    os.replace(path + '.tmp', path)
+
+
+def noise(samples):
+    '''Robust relative spread of samples: 1.4826 * median absolute deviation / median.'''
+    median = statistics.median(samples)
+    return 1.4826 * statistics.median(abs(s - median) for s in samples) / abs(median) if median else 0.0
+
+
+def compare(run, baseline_runs, sigmas, min_change):
+    '''
+    Compares the metrics of a run with the baseline runs.
+
+    :return: List of dicts with 'metric', 'baseline', 'value', 'change' (relative, positive is better),\
+    'threshold' (relative) and 'regressed', one per metric of run
+    '''
+    rows = []
+    for metric, samples in run['metrics'].items():
+        history = [r['metrics'][metric] for r in baseline_runs if metric in r['metrics']]
+        value = statistics.median(samples)
+        if not history:
+            rows.append({'metric': metric, 'baseline': None, 'value': value, 'change': None, 'threshold': None,
+                         'regressed': False})
+            continue
+        base = statistics.median(statistics.median(h) for h in history)
+        change = (value - base) / base if base else 0.0
+        if not HIGHER_IS_BETTER[metric]:
+            change = -change
+        spread = noise(samples) + statistics.median(noise(h) for h in history)
+        threshold = max(min_change, sigmas * spread)
+        rows.append({'metric': metric, 'baseline': base, 'value': value, 'change': change, 'threshold': threshold,
+                     'regressed': change < -threshold})
+    return rows
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--history', default=HISTORY, help='JSON history file')
+    parser.add_argument('--size', type=int, default=150, help='Grid size (Nx = Ny)')
+    parser.add_argument('--classes', type=int, default=1, help='Number of sediment classes')
+    parser.add_argument('--repeat', type=int, default=9, help='Samples per rule')
+    parser.add_argument('--processes', type=int, default=3, help='Fresh interpreters for memory and import time')
+    parser.add_argument('--baseline-runs', type=int, default=5, help='Number of earlier runs compared against')
+    parser.add_argument('--sigmas', type=float, default=3, help='Regression threshold in units of the noise')
+    parser.add_argument('--min-change', type=float, default=0.05, help='Smallest relative change that can regress')
+    parser.add_argument('--record', choices=('pass', 'always', 'never'), default='pass',
+                        help='When to add the run to the history')
+    args = parser.parse_args(argv)
+    warnings.simplefilter('ignore')
+
+    key, machine = fingerprint()
+    config = {'size': args.size, 'classes': args.classes}
+    g = grid(args.size, args.classes)
+    metrics = {}
+    with np.errstate(all='ignore'):
+        for rule in RULES:
+            metrics[rule] = rule_samples(g, rule, args.repeat)
+    metrics['peak_rss_mb'] = rss_samples(args.size, args.classes, args.processes)
+    metrics['import_ms'] = import_samples(args.processes)
+    run = {'commit': commit(), 'fingerprint': key, 'machine': machine, 'config': config,
+           'time': datetime.datetime.now(datetime.timezone.utc).isoformat(timespec='seconds'), 'metrics': metrics}
+
+    history = load_history(args.history)
+    baseline_runs = [r for r in history['runs'] if r['fingerprint'] == key and r['config'] == config]
+    baseline_runs = baseline_runs[-args.baseline_runs:]
+    rows = compare(run, baseline_runs, args.sigmas, args.min_change)
+
+    print('commit %s, machine %s, %d baseline runs (%s)' % (run['commit'], key, len(baseline_runs),
+          ', '.join(r['commit'] or '?' for r in baseline_runs) or 'none'))
+    print('%-12s %14s %14s %9s %10s' % ('metric', 'baseline', 'value', 'change', 'threshold'))
+    for row in rows:
+        unit = UNITS[row['metric']]
+        if row['baseline'] is None:
+            print('%-12s %14s %14.4g %9s %10s  %s' % (row['metric'], '-', row['value'], '-', '-', unit))
+            continue
+        print('%-12s %14.4g %14.4g %+8.1f%% %9.1f%%  %s%s' % (
+            row['metric'], row['baseline'], row['value'], 100 * row['change'], 100 * row['threshold'], unit,
+            '  REGRESSION' if row['regressed'] else ''))
+
+    regressed = [row['metric'] for row in rows if row['regressed']]
+    if args.record == 'always' or (args.record == 'pass' and not regressed):
+        history['runs'].append(run)
+        save_history(args.history, history)
+    if regressed:
+        print('FAIL: %s regressed' % ', '.join(regressed))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,72 @@
+'''
+Import-time benchmark for hexgrid.
+
+Imports hexgrid in fresh interpreters and fails (exit code 1) if the import takes more than the budget
+on top of importing numpy, or if it pulls in any of the optional heavy modules.
+
+Usage: python benchmarks/import_time.py [--repeat N] [--budget-ms MS]
+'''
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Modules that must not be imported as a side effect of "import hexgrid"
+FORBIDDEN = ('matplotlib', 'numexpr', 'scipy', 'numba')
+
+PROBE = '''
+import sys, time, json
+t = time.perf_counter()
+import {module}
+t = time.perf_counter() - t
+print(json.dumps({{"seconds": t, "forbidden": [m for m in {forbidden!r} if m in sys.modules]}}))
+'''
+
+
+def measure(module, repeat=7):
+    '''
+    Imports a module in repeat fresh interpreters.
+
+    :return: (median import time in seconds, list of forbidden modules that were imported)
+    '''
+    times = []
+    forbidden = set()
+    for i in range(repeat):
+        out = subprocess.run([sys.executable, '-c', PROBE.format(module=module, forbidden=FORBIDDEN)],
+                             cwd=ROOT, capture_output=True, text=True, check=True).stdout
+        result = json.loads(out)
+        times.append(result['seconds'])
+        forbidden.update(result['forbidden'])
+    return statistics.median(times), sorted(forbidden)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--repeat', type=int, default=7, help='Number of fresh interpreters per module')
+    parser.add_argument('--budget-ms', type=float, default=50,
+                        help='Allowed import time of hexgrid on top of numpy, in milliseconds')
+    args = parser.parse_args(argv)
+
+    numpy_time, _ = measure('numpy', args.repeat)
+    hexgrid_time, forbidden = measure('hexgrid', args.repeat)
+    overhead_ms = (hexgrid_time - numpy_time) * 1e3
+    print('import numpy:   %7.1f ms' % (numpy_time * 1e3))
+    print('import hexgrid: %7.1f ms (%.1f ms on top of numpy, budget %.1f ms)'
+          % (hexgrid_time * 1e3, overhead_ms, args.budget_ms))
+
+    failed = False
+    if forbidden:
+        print('FAIL: import hexgrid imported %s' % ', '.join(forbidden))
+        failed = True
+    if overhead_ms > args.budget_ms:
+        print('FAIL: import time over budget')
+        failed = True
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,85 @@
+'''
+Benchmark of the memory layouts of Q_cj, Q_cbj and Q_o (see hexgrid.substate).
+
+Fills a square grid with a current in every cell and times the functions that access one sediment class
+or direction at a time (ma.calc_g_prime, ma.calc_rho_c, I_1, I_2) and the rules that work on all classes
+at once (T_2, I_3), with the class axis last ('cell') and first ('class'), for several numbers of
+sediment classes.
+
+Usage: python benchmarks/layout.py [--size N] [--classes NJ ...] [--repeat N]
+'''
+import argparse
+import os
+import statistics
+import sys
+import time
+import warnings
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np  # noqa: E402
+import mathfunk as ma  # noqa: E402
+import runner  # noqa: E402
+from hexgrid import LAYOUTS  # noqa: E402
+
+SCENARIO = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'scenarios', 'main.toml')
+
+FUNCTIONS = {
+    'calc_g_prime': lambda g: ma.calc_g_prime(g.Nj, g.Q_cj, g.rho_j, g.rho_a, g=g.g),
+    'calc_rho_c': lambda g: ma.calc_rho_c(g.Nj, g.Q_cj, g.rho_j, g.rho_a),
+    'I_1': lambda g: g.I_1(),
+    'I_2': lambda g: g.I_2(),
+    'T_2': lambda g: g.T_2(),
+    'I_3': lambda g: g.I_3(),
+}
+
+
+def grid(scenario, size, Nj, layout):
+    '''A grid with Nj sediment classes and a current in every cell.'''
+    rng = np.random.default_rng(0)
+    scenario = dict(scenario, grid=dict(scenario['grid'], Nx=size, Ny=size, layout=layout),
+                    bed=dict(scenario['bed'], Q_cbj=[0.4 / Nj] * Nj),
+                    sources=[dict(scenario['sources'][0], Q_cj=[0.3 / Nj] * Nj)],
+                    constants=dict(scenario['constants'], rho_j=[2650] * Nj,
+                                   D_sj=np.linspace(0.0001, 0.00012, Nj).tolist()))
+    g = runner.build_grid(scenario)
+    g.Q_th[1:-1, 1:-1] = rng.uniform(0.5, 1.5, (size - 2, size - 2))
+    g.Q_v[1:-1, 1:-1] = rng.uniform(0.1, 0.3, (size - 2, size - 2))
+    g.Q_cj[1:-1, 1:-1] = rng.uniform(0, 0.3 / Nj, (size - 2, size - 2, Nj))
+    g.dt = g.calc_dt()
+    g.I_1()  # Outflows for I_2 and I_3
+    return g
+
+
+def measure(function, g, repeat):
+    '''Returns the median time of a call in seconds.'''
+    times = []
+    for i in range(repeat):
+        t = time.perf_counter()
+        function(g)
+        times.append(time.perf_counter() - t)
+    return statistics.median(times)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--size', type=int, default=200, help='Grid size (Nx = Ny)')
+    parser.add_argument('--classes', type=int, nargs='+', default=[1, 4, 8, 16], help='Numbers of sediment classes')
+    parser.add_argument('--repeat', type=int, default=7, help='Calls per function and layout')
+    args = parser.parse_args(argv)
+    warnings.simplefilter('ignore')
+
+    scenario = runner.load_scenario(SCENARIO)
+    print('%4s %14s' % ('Nj', 'function') + ''.join('%12s' % ('%s [ms]' % layout) for layout in LAYOUTS)
+          + '%9s' % 'speedup')
+    for Nj in args.classes:
+        grids = {layout: grid(scenario, args.size, Nj, layout) for layout in LAYOUTS}
+        for name, function in FUNCTIONS.items():
+            times = [measure(function, grids[layout], args.repeat) for layout in LAYOUTS]
+            print('%4d %14s' % (Nj, name) + ''.join('%12.2f' % (t * 1e3) for t in times)
+                  + '%9.2f' % (times[0] / times[1]))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,58 @@
+'''
+Run-time benchmark of the engines on small calibration grids.
+
+Runs the scenario of main.py (a source in the corner of a flat basin) on square grids of a few sizes,
+with Hexgrid.run and with the compiled whole-run loop, and prints the time per step of each. The first
+compiled run, which includes compilation, is not timed.
+
+Usage: python benchmarks/small_grids.py [--sizes N ...] [--steps N] [--repeat N]
+'''
+import argparse
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import runner  # noqa: E402
+from compiled import run_compiled  # noqa: E402
+
+SCENARIO = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'scenarios', 'main.toml')
+
+
+def grid(scenario, size):
+    scenario = dict(scenario, grid=dict(scenario['grid'], Nx=size, Ny=size))
+    return runner.build_grid(scenario)
+
+
+def measure(function, scenario, size, steps, repeat):
+    '''Returns the median time per step in seconds.'''
+    times = []
+    for i in range(repeat):
+        g = grid(scenario, size)
+        t = time.perf_counter()
+        function(g, max_steps=steps)
+        times.append((time.perf_counter() - t) / steps)
+    return statistics.median(times)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10, 30, 60], help='Grid sizes (Nx = Ny)')
+    parser.add_argument('--steps', type=int, default=200, help='Time steps per run')
+    parser.add_argument('--repeat', type=int, default=5, help='Runs per size and engine')
+    args = parser.parse_args(argv)
+
+    scenario = runner.load_scenario(SCENARIO)
+    run_compiled(grid(scenario, args.sizes[0]), max_steps=1)  # Compile
+    print('%6s %14s %14s %8s' % ('size', 'numpy [ms]', 'compiled [ms]', 'speedup'))
+    for size in args.sizes:
+        numpy_time = measure(lambda g, **kwargs: g.run(**kwargs), scenario, size, args.steps, args.repeat)
+        compiled_time = measure(run_compiled, scenario, size, args.steps, args.repeat)
+        print('%6d %14.3f %14.3f %8.1f' % (size, numpy_time * 1e3, compiled_time * 1e3, numpy_time / compiled_time))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,45 @@
+'''
+Generation benchmark of the procedural terrains.
+
+Generates every terrain of terrain.py on square grids of a few sizes and prints the time per million
+cells and the peak memory of the temporaries (traced by tracemalloc, without the grid itself), which
+is bounded by the block size rather than by the grid.
+
+Usage: python benchmarks/terrain.py [--sizes N ...] [--kinds NAME ...] [--seed N]
+'''
+import argparse
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np  # noqa: E402
+
+from terrain import GENERATORS, add_terrain  # noqa: E402
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[500, 1000, 2000], help='Grid sizes (Nx = Ny)')
+    parser.add_argument('--kinds', nargs='+', default=list(GENERATORS), help='Terrains to generate')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the terrains')
+    args = parser.parse_args(argv)
+
+    print('%12s %6s %14s %18s' % ('terrain', 'size', 'time [s/Mcell]', 'temporaries [MB]'))
+    for kind in args.kinds:
+        for size in args.sizes:
+            Q_a = np.zeros((size, size))
+            tracemalloc.start()
+            t = time.perf_counter()
+            add_terrain(Q_a, 1.0, {'kind': kind, 'seed': args.seed})
+            elapsed = time.perf_counter() - t
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            print('%12s %6d %14.3f %18.1f' % (kind, size, elapsed / (size * size / 1e6), peak / 2 ** 20))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
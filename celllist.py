@@ -0,0 +1,301 @@
+'''
+Flat cell-list topology for irregular domains.
+
+Hexgrid stores every substate on the full rectangular (Ny, Nx) array, including land and cells outside
+the survey. Here only the active cells are stored, as flat 1-D arrays, together with a precomputed
+(Ncells, 6) neighbour index table. Missing neighbours (inactive cells and cells outside the array) point
+to a sentinel ghost cell with index Ncells, which is stored at the end of every substate array and
+behaves like the border cells of Hexgrid: infinite Q_a and Q_d, no current. The transition rules are
+written as gathers and scatters over the neighbour table, so memory and compute scale with the number
+of active cells rather than with the bounding box.
+
+Use:
+
+    grid = Hexgrid(Nx, Ny, ICstates=ICstates, terrain='river')
+    flat = FlatHexgrid.from_hexgrid(grid, mask=wet)  # mask: (Ny,Nx) bool, True for active cells
+    flat.run(max_steps=1000)
+    flat.to_hexgrid(grid)  # Write the state back for plotting and output
+'''
+import numpy as np
+
+import T1functions as T1
+import T2functions as T2
+import mathfunk as ma
+from hexgrid import Hexgrid
+
+# (row, column) offsets of the NW, NE, E, SE, SW and W neighbors. Same order as Hexgrid.NEIGHBOR.
+OFFSETS = ((-1, 0), (-1, 1), (0, 1), (1, 0), (1, -1), (0, -1))
+OPPOSITE = np.array([3, 4, 5, 0, 1, 2])  # Direction pointing back from neighbor i
+
+
+class CellList():
+    '''Active cells of a (Ny, Nx) hexagonal grid and their neighbour table.'''
+
+    def __init__(self, mask):
+        '''
+        :param mask: numpy.ndarray(Ny,Nx) of bool. True for active cells.
+        '''
+        mask = np.asarray(mask, dtype=bool)
+        self.shape = mask.shape
+        self.rows, self.cols = np.nonzero(mask)
+        self.N = self.rows.size
+        self.sentinel = self.N
+
+        # Padded map from (row, column) to flat index. Only needed while building the neighbour table.
+        index = np.full((self.shape[0] + 2, self.shape[1] + 2), self.sentinel, dtype=np.intp)
+        index[self.rows + 1, self.cols + 1] = np.arange(self.N)
+        self.neighbors = np.empty((self.N, 6), dtype=np.intp)
+        for i, (dy, dx) in enumerate(OFFSETS):
+            self.neighbors[:, i] = index[self.rows + 1 + dy, self.cols + 1 + dx]
+
+    def gather(self, full, ghost=0):
+        '''
+        Returns the values of a full (Ny,Nx,...) array in the active cells, followed by the ghost cell.
+
+        :param full: numpy.ndarray(Ny,Nx,...)
+        :param ghost: Value of the ghost cell
+        :return: numpy.ndarray(Ncells+1,...)
+        '''
+        values = np.asarray(full)[self.rows, self.cols]
+        ghost = np.full((1,) + values.shape[1:], ghost, dtype=values.dtype)
+        return np.concatenate((values, ghost))
+
+    def scatter(self, flat, out):
+        '''Writes the active-cell values of a flat array into a full (Ny,Nx,...) array.'''
+        out[self.rows, self.cols] = flat[:self.N]
+        return out
+
+    def coordinates(self, dx):
+        '''Returns the (Ncells, 2) x and y coordinates of the cell centers. Same convention as Hexgrid.X.'''
+        X = np.empty((self.N, 2))
+        X[:, 0] = self.rows * dx / 2 + self.cols * dx
+        X[:, 1] = -dx * np.sqrt(3) / 2 * self.rows
+        return X
+
+
+class FlatHexgrid(Hexgrid):
+    '''
+    Simulates a turbidity current on the active cells of a CellList.\
+    Substates have the same names as in Hexgrid, with the (Ny, Nx) axes replaced by one cell axis of\
+    length Ncells + 1, where the last entry is the ghost cell.
+    '''
+
+    layout = 'cell'  # The compiled kernels (see compiled.py) expect the class axis last
+    source = None  # Hexgrid the flat grid was created from (see notify)
+
+    CONSTANTS = ('g', 'f', 'a', 'rho_a', 'rho_j', 'D_sj', 'Nj', 'c_D', 'nu', 'porosity', 'v_sj', 'p_f',
+                 'p_adh', 'dx', 'reposeAngle', 'CellArea', 't', 'stepCount')
+
+    def __init__(self, cells, Q_th, Q_v, Q_cj, Q_cbj, Q_d, Q_a, constants):
+        '''
+        :param cells: CellList
+        :param Q_th, Q_v, Q_cj, Q_cbj, Q_d, Q_a: Flat substates of length Ncells + 1 (see CellList.gather)
+        :param constants: dict with the constants of Hexgrid (see FlatHexgrid.CONSTANTS)
+        '''
+        for name in self.CONSTANTS:
+            setattr(self, name, constants[name])
+        self.cells = cells
+        self.N = cells.N
+        self.NEIGHBOR = cells.neighbors
+        self.Q_th = Q_th
+        self.Q_v = Q_v
+        self.Q_cj = Q_cj
+        self.Q_cbj = Q_cbj
+        self.Q_d = Q_d
+        self.Q_a = Q_a
+        self.Q_o = np.zeros((self.N + 1, 6))  # Density current outflow
+        self.X = cells.coordinates(self.dx)
+        self.diff = np.zeros((self.N, 6))
+        self.calc_bathymetryDiff()
+        self.i = 0
+        self.Erosionrate = []
+        self.Depositionrate = []
+
+    @classmethod
+    def from_hexgrid(cls, grid, mask=None):
+        '''
+        Creates a FlatHexgrid holding the active cells of a Hexgrid.
+
+        :param grid: Hexgrid
+        :param mask: numpy.ndarray(Ny,Nx) of bool. Defaults to all interior cells with finite Q_d.
+        '''
+        active = np.zeros((grid.Ny, grid.Nx), dtype=bool)
+        active[1:-1, 1:-1] = np.isfinite(grid.Q_d[1:-1, 1:-1])
+        if mask is not None:
+            active &= mask
+        cells = CellList(active)
+        constants = {name: getattr(grid, name) for name in cls.CONSTANTS}
+        flat = cls(cells, cells.gather(grid.Q_th), cells.gather(grid.Q_v), cells.gather(grid.Q_cj),
+                   cells.gather(grid.Q_cbj), cells.gather(grid.Q_d, np.inf), cells.gather(grid.Q_a, np.inf),
+                   constants)
+        flat.source = grid
+        return flat
+
+    def to_hexgrid(self, grid):
+        '''Writes the state of the active cells back into a Hexgrid, and returns it.'''
+        for name in ('Q_th', 'Q_v', 'Q_cj', 'Q_cbj', 'Q_d', 'Q_a'):
+            self.cells.scatter(getattr(self, name), getattr(grid, name))
+        grid.t = self.t
+        grid.stepCount = self.stepCount
+        if hasattr(self, 'dt'):
+            grid.dt = self.dt
+        return grid
+
+    def notify(self):
+        '''
+        Calls the observers of the flat grid, and those of the Hexgrid it was created from with the state\
+        written back into it. A source with observers is so written back after every step.
+        '''
+        super().notify()
+        if self.source is not None and self.source.observers:
+            self.to_hexgrid(self.source).notify()
+
+    def interior(self, array):
+        return array[:self.N]
+
+    def T_1(self):
+        '''Water entrainment. See Hexgrid.T_1.'''
+        g_prime = ma.calc_g_prime(self.Nj, self.Q_cj, self.rho_j, self.rho_a, g=self.g)
+        Ri = T1.calc_RichardsonNo(g_prime, self.Q_th, self.Q_v)
+        E_wStar = T1.calc_dimlessIncorporationRate(Ri)
+        E_w = T1.calc_rateOfSeaWaterIncorp(self.Q_v, E_wStar)
+        nQ_th = self.Q_th + T1.calc_changeIn_q_th(E_w, self.dt)
+        tempQ_cj = T1.calc_new_qcj(self.Q_cj, self.Q_th, nQ_th)
+        self.Q_cj[:self.N] = tempQ_cj[:self.N]
+        self.Q_th[:self.N] = nQ_th[:self.N]
+
+    def T_2(self):
+        '''Erosion and deposition. See Hexgrid.T_2.'''
+        R_pj = T2.calc_Rpj(self.rho_j, self.rho_a, self.D_sj, self.nu, g=self.g)
+        f = T2.calc_fofR(R_pj)
+        kappa = T2.calc_kappa(self.D_sj)
+        Ustar = T2.calc_Ustar(self.c_D, self.Q_v)
+        D_sg = T2.calc_averageSedimentSize(self.Q_cj, self.D_sj)
+        c_nbj = T2.calc_nearBedConcentration_SusSed(self.D_sj, D_sg, self.Q_cj)
+        D_j = np.nan_to_num(T2.calc_depositionRate(self.v_sj, c_nbj))
+        Z_mj = T2.calc_Z_mj(kappa, Ustar, self.v_sj, f)
+        E_j = T2.calc_erotionRate(Z_mj)
+        n = self.N
+        D_j, E_j, change_qd, change_qcj, change_qcbj = T2.T2_exchange(
+            self.dt, D_j[:n], E_j[:n], self.porosity, self.Q_th[:n], self.Q_cj[:n], self.p_adh, self.Q_cbj[:n],
+            self.Q_d[:n])
+
+        self.Q_a[:n] += change_qd
+        self.Q_d[:n] += change_qd
+        self.Q_cj[:n] -= change_qcj
+        self.Q_cbj[:n] += change_qcbj
+        self.Q_cbj[self.Q_cbj > 1] = 1
+
+    def I_1(self):
+        '''Turbidity current outflows. See Hexgrid.I_1.'''
+        n = self.N
+        nb = self.NEIGHBOR
+        eligableCells = self.Q_th[:n] > 0
+        g_prime = ma.calc_g_prime(self.Nj, self.Q_cj, self.rho_j, self.rho_a)
+        h_k = self.calc_BFroudeNo(g_prime)
+        r = self.Q_th + h_k
+        central_cell_height = (self.Q_a + r)[:n]
+        q_i = self.Q_a + self.Q_th
+        q_nb = q_i[nb]
+        delta = central_cell_height[:, np.newaxis] - q_nb
+        delta[np.isinf(delta)] = 0
+
+        angle = np.arctan2(delta, self.dx)
+        indices = angle > self.p_f
+        indices *= eligableCells[:, np.newaxis]
+        p = (r - self.p_adh)[:n]
+        for ii in range(6):
+            NumberOfCellsInA = np.sum(indices, axis=1)
+            neighborValues = np.zeros(n)
+            for i in range(6):
+                neighborValues += np.nan_to_num(q_nb[:, i] * indices[:, i])
+            with np.errstate(divide='ignore', invalid='ignore'):
+                Average = (p + neighborValues) / NumberOfCellsInA
+            Average[np.isinf(Average)] = 0
+            Average[np.isnan(Average)] = 0
+            for i in range(6):
+                indices[q_nb[:, i] >= Average, i] = 0
+
+        nonNormalizedOutFlow = Average[:, np.newaxis] - np.nan_to_num(q_nb * indices)
+        nonNormalizedOutFlow *= indices
+        with np.errstate(divide='ignore', invalid='ignore'):
+            normalization = self.Q_th / r
+        with np.errstate(invalid='ignore'):
+            relaxation = np.sqrt(2 * r * g_prime) * self.dt / (0.5 * self.dx)
+        self.Q_o[:n] = np.nan_to_num((normalization * relaxation)[:n, np.newaxis] * nonNormalizedOutFlow)
+
+    def I_2(self):
+        '''Update thickness and concentration. See Hexgrid.I_2.'''
+        n = self.N
+        nb = self.NEIGHBOR
+        inflow = self.Q_o[nb, OPPOSITE]  # inflow[:, i] = outflow from neighbor i towards the cell
+        s = np.zeros(n)
+        for i in range(6):
+            s += (inflow[:, i] - self.Q_o[:n, i])
+        eps = 1e-13
+        newq_th = self.Q_th[:n] + np.nan_to_num(s)
+        newq_th[newq_th < eps] = 0
+        term1 = ((self.Q_th - np.sum(self.Q_o, axis=1))[:, np.newaxis] * self.Q_cj)[:n]
+        term2 = np.zeros((n, self.Nj))
+        for i in range(6):
+            term2 += inflow[:, i, np.newaxis] * self.Q_cj[nb[:, i]]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            newq_cj = (term1 + term2) / newq_th[:, np.newaxis]
+        newq_cj[np.isinf(newq_cj)] = 0
+        self.Q_th[:n] = np.nan_to_num(newq_th)
+        self.Q_cj[:n] = np.nan_to_num(newq_cj)
+
+    def I_3(self):
+        '''Update of turbidity flow velocity. See Hexgrid.I_3.'''
+        n = self.N
+        g_prime = ma.calc_g_prime(self.Nj, self.Q_cj, self.rho_j, self.rho_a)
+        sum_q_cj = np.sum(self.Q_cj, axis=1)
+        height = self.Q_a + self.Q_th
+        diff = height[:n, np.newaxis] - height[self.NEIGHBOR]
+        diff[np.isinf(diff)] = 0
+        comp1 = (8 * g_prime * sum_q_cj)[:n] / (self.f * (1 + self.a))
+        with np.errstate(invalid='ignore'):
+            U_k = np.sqrt(comp1[:, np.newaxis] * (self.Q_o[:n] * diff))
+        self.Q_v[:n] = np.nan_to_num(ma.average_speed_hexagon(U_k))
+
+    def I_4(self):
+        '''Toppling rule. See Hexgrid.I_4.'''
+        n = self.N
+        interiorH = self.Q_d[:n]
+        self.calc_Hdiff()
+        diff = self.diff
+        angle = np.arctan2(diff, self.dx)
+        indices = (angle > self.reposeAngle) & (interiorH > 0)[:, np.newaxis]
+        NoOfTrans = np.sum(indices, axis=1).astype(float)
+        NoOfTrans[NoOfTrans == 0] = np.inf
+
+        frac = np.zeros((n, 6))
+        deltaS = np.zeros((n, 6))
+        H = np.broadcast_to(interiorH[:, np.newaxis], (n, 6))
+        frac[indices] = 0.5 * (diff[indices] - self.dx * np.tan(self.reposeAngle)) / H[indices]
+        frac[frac > 0.5] = 0.5
+        deltaS[indices] = H[indices] * frac[indices] / np.broadcast_to(NoOfTrans[:, np.newaxis], (n, 6))[indices]
+
+        deltaSSum = -np.sum(deltaS, axis=1)
+        for i in range(6):  # Mass received from the cells that have this cell as neighbor i
+            deltaSSum += np.bincount(self.NEIGHBOR[:, i], weights=deltaS[:, i], minlength=n + 1)[:n]
+
+        oldQ_d = self.Q_d.copy()
+        self.Q_d[:n] += deltaSSum
+        self.Q_a[:n] += deltaSSum
+        with np.errstate(divide='ignore'):
+            prefactor = 1 / self.Q_d[:n, np.newaxis]
+        prefactor[np.isinf(prefactor)] = 0
+        self.Q_cbj[:n] = np.nan_to_num(prefactor * (oldQ_d[:n, np.newaxis] * self.Q_cbj[:n] + deltaSSum[:, np.newaxis]))
+        self.Q_cbj[self.Q_cbj < 1e-15] = 0
+        if (self.Q_d < -1e-7).sum() > 0:
+            raise RuntimeError('Negative sediment thickness!')
+
+    def calc_bathymetryDiff(self):
+        with np.errstate(invalid='ignore'):
+            temp = self.Q_a - self.Q_d
+            self.seaBedDiff = temp[:self.N, np.newaxis] - temp[self.NEIGHBOR]
+        self.seaBedDiff[np.isnan(self.seaBedDiff)] = 0
+
+    def calc_Hdiff(self):
+        self.diff[:] = self.Q_d[:self.N, np.newaxis] - self.Q_d[self.NEIGHBOR] + self.seaBedDiff
@@ -0,0 +1,511 @@
+'''
+Compiled whole-run loop for small grids.
+
+On the 10x10 to 60x60 grids used for calibration, most of the time in Hexgrid.time_step is spent
+in the interpreter: some 40 NumPy calls per step, the six-iteration loops of I_1 and the checks.
+run_compiled executes the complete loop of Hexgrid.run, including calc_dt, the stopping criteria
+and the bed-only mode, in one numba-compiled function that works cell by cell on the flat cell list
+of celllist.py. Only the requested per-step diagnostics are written out.
+
+The kernels follow the NumPy implementation operation by operation, including its handling of
+nan and inf, so every rule agrees with Hexgrid to rounding. They are not bit for bit the same: libm's pow
+differs from NumPy's SIMD pow in the last bit, and T_2 leaves a residue of an ulp of either sign in Q_cj
+of a class that is deposited completely. Whether I_1 then sends the current on depends on that sign,
+so runs can separate after some tens of steps (see verification.INEXACT). numba is imported on first use and
+the compiled functions are cached on disk. Without numba the same kernels run as plain Python,
+which is only useful for checking them.
+
+Use:
+
+    report = run_compiled(grid, max_steps=500, diagnostics=('t', 'current_volume'), every=10)
+    report['diagnostics']['current_volume']  # One value per 10 steps
+'''
+import warnings
+
+import numpy as np
+
+import T2functions as T2
+from celllist import FlatHexgrid, OPPOSITE
+from hexgrid import lazy_import
+
+MAX = np.finfo(np.float64).max  # What np.nan_to_num maps inf to
+G_DEFAULT = 9.81  # I_1 and I_3 call ma.calc_g_prime with its default g
+
+# Diagnostics that can be written out, one value per recorded step
+DIAGNOSTICS = ('t', 'dt', 'current_volume', 'suspended_volume', 'bed_volume', 'max_thickness', 'max_speed',
+               'wet_cells')
+
+# Stopping reasons returned by the kernel. PAUSE means the run is not finished yet.
+REASONS = ('max_steps', 'until', 'extinct', 'stable', 'pause')
+MAX_STEPS, UNTIL, EXTINCT, STABLE, PAUSE = range(5)
+
+# Layout of the constants and state vectors passed to the kernel
+CONSTANTS = ('g', 'f', 'a', 'rho_a', 'c_D', 'porosity', 'p_f', 'p_adh', 'dx', 'reposeAngle', 'dt_max',
+             'CellArea')
+G, F, A, RHO_A, C_D, POROSITY, P_F, P_ADH, DX, REPOSE, DT_MAX, AREA, KAPPA = range(13)
+T, DT, STEPS, BED_STEPS, STABLE_COUNT, BED_ONLY, ERROR = range(7)
+
+
+def nan_to_num(x):
+    if x != x:
+        return 0.0
+    if x == np.inf:
+        return MAX
+    if x == -np.inf:
+        return -MAX
+    return x
+
+
+def g_prime(cj, c, rho_j, rho_a, g):
+    '''Reduced gravity of cell c. See mathfunk.calc_g_prime.'''
+    s = 0.0
+    for j in range(cj.shape[1]):
+        s += cj[c, j] * (rho_j[j] - rho_a) / rho_a
+    return g * s
+
+
+def calc_dt(th, v, cj, N, k, rho_j):
+    '''See Hexgrid.calc_dt. Returns np.inf if no cell has a current.'''
+    dt = np.inf
+    for c in range(N):
+        gp = g_prime(cj, c, rho_j, k[RHO_A], k[G])
+        gz = gp if gp != 0 else np.inf
+        r = th[c] + 0.5 * (v[c] * v[c]) / gz
+        if r == 0:
+            r = np.inf
+        tau = (k[DX] / 2) / np.sqrt(2 * r * gz)
+        if np.isfinite(tau) and tau > 0 and tau < dt:
+            dt = tau
+    return 0.5 * dt
+
+
+def T_1(th, v, cj, N, k, rho_j, dt):
+    '''Water entrainment. See Hexgrid.T_1.'''
+    for c in range(N):
+        gp = g_prime(cj, c, rho_j, k[RHO_A], k[G])
+        Ri = gp * th[c] / (v[c] * v[c])
+        E_wStar = nan_to_num(0.075 / np.sqrt(1 + 718 * np.power(Ri, 2.4)))
+        nth = th[c] + nan_to_num(v[c] * E_wStar * dt)
+        ratio = th[c] / nth
+        for j in range(cj.shape[1]):
+            cj[c, j] = nan_to_num(cj[c, j] * ratio)
+        th[c] = nth
+
+
+def T_2(th, v, cj, cbj, qd, qa, N, k, D_sj, v_sj, f_j, dt):
+    '''Erosion and deposition. See Hexgrid.T_2.'''
+    Nj = cj.shape[1]
+    porosity = k[POROSITY]
+    factor = dt / (1 - porosity)
+    D_j = np.zeros(Nj)
+    E_j = np.zeros(Nj)
+    for c in range(N):
+        Ustar = k[C_D] * v[c]
+        prod = 1.0
+        scale = 0.0
+        for j in range(Nj):
+            prod *= cj[c, j] * D_sj[j]
+            scale += cj[c, j]
+        D_sg = np.power(nan_to_num(prod / scale), 1 / Nj)
+        for j in range(Nj):
+            c_nbj = (0.4 * np.power(D_sj[j] / D_sg, 1.64) + 1.64) * cj[c, j]
+            D_j[j] = nan_to_num(v_sj[j] * c_nbj)
+            Z_mj = k[KAPPA] * np.sqrt(Ustar * Ustar) * f_j[j] / v_sj[j]
+            Z5 = np.power(Z_mj, 5.0)
+            E_j[j] = 1.3e-07 * Z5 / (1 + 4.3e-07 * Z5)
+            # T2.rescale_Dj_E_j
+            available = th[c] * cj[c, j] - k[P_ADH]
+            if not D_j[j] * dt / (1 - porosity) <= available:
+                D_j[j] = available * (1 - porosity) / dt
+            if D_j[j] < 0:
+                D_j[j] = 0.0
+            if not cbj[c, j] * E_j[j] * dt / (1 - porosity) <= qd[c] * cbj[c, j]:
+                E_j[j] = qd[c] * (1 - porosity) / dt
+            if E_j[j] < 0 or np.isinf(E_j[j]):
+                E_j[j] = 0.0
+        total = 0.0
+        for j in range(Nj):
+            total += D_j[j] - cbj[c, j] * E_j[j]
+        change_qd = nan_to_num(factor * total)
+        var_sum = 0.0
+        for j in range(Nj):
+            var_sum += factor * (D_j[j] - cbj[c, j] * E_j[j])
+        var_sum = nan_to_num(var_sum)
+        for j in range(Nj):
+            var = factor * (D_j[j] - cbj[c, j] * E_j[j])
+            cj[c, j] -= nan_to_num(var / th[c])
+            cbj[c, j] += nan_to_num(var / qd[c] - cbj[c, j] / qd[c] * var_sum)
+            if cbj[c, j] > 1:
+                cbj[c, j] = 1.0
+        qa[c] += change_qd
+        qd[c] += change_qd
+
+
+def I_1(th, v, cj, qa, qo, nb, N, k, rho_j, dt):
+    '''Turbidity current outflows. See Hexgrid.I_1.'''
+    q_nb = np.zeros(6)
+    indices = np.zeros(6)  # 1 for the cells in the set A of I_1
+    for c in range(N):
+        gp = g_prime(cj, c, rho_j, k[RHO_A], G_DEFAULT)
+        r = th[c] + 0.5 * (v[c] * v[c]) / (gp if gp != 0 else np.inf)
+        central_cell_height = qa[c] + r
+        for i in range(6):
+            q_nb[i] = qa[nb[c, i]] + th[nb[c, i]]
+            delta = central_cell_height - q_nb[i]
+            if np.isinf(delta):
+                delta = 0.0
+            indices[i] = 1.0 if np.arctan2(delta, k[DX]) > k[P_F] and th[c] > 0 else 0.0
+        p = r - k[P_ADH]
+        Average = 0.0
+        for ii in range(6):
+            NumberOfCellsInA = 0
+            neighborValues = 0.0
+            for i in range(6):
+                NumberOfCellsInA += indices[i]
+                neighborValues += nan_to_num(q_nb[i] * indices[i])
+            Average = (p + neighborValues) / NumberOfCellsInA if NumberOfCellsInA > 0 else np.inf
+            if np.isinf(Average) or Average != Average:
+                Average = 0.0
+            for i in range(6):
+                if q_nb[i] >= Average:
+                    indices[i] = 0.0
+        normalization = th[c] / r
+        relaxation = np.sqrt(2 * r * gp) * dt / (0.5 * k[DX])
+        for i in range(6):
+            outflow = (Average - nan_to_num(q_nb[i] * indices[i])) * indices[i]
+            qo[c, i] = nan_to_num((normalization * relaxation) * outflow)
+
+
+def I_2(th, cj, qo, nb, N, new_th, new_cj):
+    '''Update thickness and concentration. See Hexgrid.I_2.'''
+    Nj = cj.shape[1]
+    for c in range(N):
+        s = 0.0
+        out = 0.0
+        for i in range(6):
+            s += qo[nb[c, i], OPPOSITE[i]] - qo[c, i]
+            out += qo[c, i]
+        newq_th = th[c] + nan_to_num(s)
+        if newq_th < 1e-13:
+            newq_th = 0.0
+        for j in range(Nj):
+            term2 = 0.0
+            for i in range(6):
+                term2 += qo[nb[c, i], OPPOSITE[i]] * cj[nb[c, i], j]
+            newq_cj = ((th[c] - out) * cj[c, j] + term2) / newq_th
+            if np.isinf(newq_cj):
+                newq_cj = 0.0
+            new_cj[c, j] = nan_to_num(newq_cj)
+        new_th[c] = nan_to_num(newq_th)
+    th[:N] = new_th
+    cj[:N] = new_cj
+
+
+def I_3(th, v, cj, qa, qo, nb, N, k, rho_j):
+    '''Update of turbidity flow velocity. See Hexgrid.I_3.'''
+    U_k = np.zeros(6)
+    for c in range(N):
+        gp = g_prime(cj, c, rho_j, k[RHO_A], G_DEFAULT)
+        sum_q_cj = 0.0
+        for j in range(cj.shape[1]):
+            sum_q_cj += cj[c, j]
+        comp1 = 8 * gp * sum_q_cj / (k[F] * (1 + k[A]))
+        for i in range(6):
+            diff = (qa[c] + th[c]) - (qa[nb[c, i]] + th[nb[c, i]])
+            if np.isinf(diff):
+                diff = 0.0
+            U_k[i] = np.sqrt(comp1 * (qo[c, i] * diff))
+        v0 = U_k[0] - U_k[3]
+        v1 = U_k[1] - U_k[4]
+        v2 = U_k[2] - U_k[5]
+        v[c] = nan_to_num(np.sqrt((0.5 * (v1 - v0) + v2) ** 2 + 3 / 4 * (v1 + v0) ** 2))
+
+
+def I_4(cbj, qd, qa, nb, seabed, N, k, deltaS, deltaSSum):
+    '''Toppling rule. See Hexgrid.I_4. Returns False if a cell gets a negative sediment thickness.'''
+    dx = k[DX]
+    tan_repose = np.tan(k[REPOSE])
+    for c in range(N):
+        H = qd[c]
+        NoOfTrans = 0
+        for i in range(6):
+            deltaS[c, i] = 0.0
+            diff = H - qd[nb[c, i]] + seabed[c, i]
+            if np.arctan2(diff, dx) > k[REPOSE] and H > 0:
+                NoOfTrans += 1
+                deltaS[c, i] = min(0.5 * (diff - dx * tan_repose) / H, 0.5)  # frac
+        for i in range(6):
+            if deltaS[c, i] != 0:
+                deltaS[c, i] = H * deltaS[c, i] / NoOfTrans
+    for c in range(N):
+        s = 0.0
+        for i in range(6):
+            s += deltaS[c, i]
+        deltaSSum[c] = -s
+        for i in range(6):  # Mass received from the neighbor on the opposite side, which sends it in direction i
+            deltaSSum[c] += deltaS[nb[c, OPPOSITE[i]], i]
+    ok = True
+    for c in range(N):
+        oldQ_d = qd[c]
+        qd[c] += deltaSSum[c]
+        qa[c] += deltaSSum[c]
+        prefactor = 1 / qd[c]
+        if np.isinf(prefactor):
+            prefactor = 0.0
+        for j in range(cbj.shape[1]):
+            cbj[c, j] = nan_to_num(prefactor * (oldQ_d * cbj[c, j] + deltaSSum[c]))
+            if cbj[c, j] < 1e-15:
+                cbj[c, j] = 0.0
+        if qd[c] < -1e-7:
+            ok = False
+    return ok
+
+
+def record(codes, out, th, v, cj, qd, N, k, t, dt, flow_eps):
+    '''Writes the requested diagnostics (indices into DIAGNOSTICS) of the current state into out.'''
+    for n in range(codes.size):
+        code = codes[n]
+        value = 0.0
+        if code == 0:
+            value = t
+        elif code == 1:
+            value = dt
+        else:
+            for c in range(N):
+                if code == 2:
+                    value += th[c] * k[AREA]
+                elif code == 3:
+                    for j in range(cj.shape[1]):
+                        value += th[c] * cj[c, j] * k[AREA]
+                elif code == 4:
+                    value += qd[c] * k[AREA]
+                elif code == 5:
+                    value = max(value, th[c])
+                elif code == 6:
+                    value = max(value, v[c])
+                elif code == 7 and th[c] > flow_eps:
+                    value += 1
+        out[n] = value
+
+
+def run_kernel(nb, th, v, cj, cbj, qd, qa, qo, seabed, k, rho_j, D_sj, v_sj, f_j, state, max_steps, until,
+               flow_eps, bed_eps, stable_steps, stop_on_extinction, pause_at, codes, every, diagnostics,
+               n_records):
+    '''
+    Advances the flat substates until a stopping criterion is met, or until pause_at steps have been made
+    or the diagnostics buffer is full. The run state (see T, DT, ...) is kept in state between calls.
+
+    :return: (reason, number of diagnostics records written)
+    '''
+    N = nb.shape[0]
+    Nj = cj.shape[1]
+    new_th = np.zeros(N)
+    new_cj = np.zeros((N, Nj))
+    deltaS = np.zeros((N + 1, 6))
+    deltaSSum = np.zeros(N)
+    oldQ_d = np.zeros(N)
+    while True:
+        steps = int(state[STEPS])
+        if max_steps >= 0 and steps >= max_steps:
+            return MAX_STEPS, n_records
+        if state[T] >= until:
+            return UNTIL, n_records
+        if steps >= pause_at or (codes.size > 0 and n_records >= diagnostics.shape[0]):
+            return PAUSE, n_records
+        if state[BED_ONLY] == 0:
+            max_th = -np.inf
+            for c in range(N):
+                max_th = max(max_th, th[c])
+            if N == 0 or max_th < flow_eps or not np.isfinite(state[DT]):
+                if stop_on_extinction:
+                    return EXTINCT, n_records
+                state[BED_ONLY] = 1
+        if state[BED_ONLY] != 0:
+            oldQ_d[:] = qd[:N]
+            if not I_4(cbj, qd, qa, nb, seabed, N, k, deltaS, deltaSSum):
+                state[ERROR] = 1
+            state[BED_STEPS] += 1
+            change = 0.0
+            for c in range(N):
+                change = max(change, abs(qd[c] - oldQ_d[c]))
+            state[STABLE_COUNT] = state[STABLE_COUNT] + 1 if change < bed_eps else 0
+        else:
+            dt = calc_dt(th, v, cj, N, k, rho_j)
+            state[DT] = dt
+            if not np.isfinite(dt):
+                if not I_4(cbj, qd, qa, nb, seabed, N, k, deltaS, deltaSSum):
+                    state[ERROR] = 1
+            else:
+                dt = min(dt, k[DT_MAX])
+                state[DT] = dt
+                state[T] += dt
+                T_1(th, v, cj, N, k, rho_j, dt)
+                T_2(th, v, cj, cbj, qd, qa, N, k, D_sj, v_sj, f_j, dt)
+                I_1(th, v, cj, qa, qo, nb, N, k, rho_j, dt)
+                I_2(th, cj, qo, nb, N, new_th, new_cj)
+                I_3(th, v, cj, qa, qo, nb, N, k, rho_j)
+                if not I_4(cbj, qd, qa, nb, seabed, N, k, deltaS, deltaSSum):
+                    state[ERROR] = 1
+        state[STEPS] += 1
+        if state[ERROR] != 0:
+            return PAUSE, n_records
+        if codes.size > 0 and int(state[STEPS]) % every == 0:
+            record(codes, diagnostics[n_records], th, v, cj, qd, N, k, state[T], state[DT], flow_eps)
+            n_records += 1
+        if state[BED_ONLY] != 0 and state[STABLE_COUNT] >= stable_steps:
+            return STABLE, n_records
+
+
+KERNELS = ('nan_to_num', 'g_prime', 'calc_dt', 'T_1', 'T_2', 'I_1', 'I_2', 'I_3', 'I_4', 'record', 'run_kernel')
+_kernel = []
+
+
+def kernel():
+    '''Returns run_kernel, compiled with numba on first use, or the plain Python version if numba is missing.'''
+    if not _kernel:
+        numba = lazy_import('numba')
+        if numba is None:
+            warnings.warn('numba is not installed. The compiled engine runs as (very slow) plain Python.',
+                          RuntimeWarning)
+            _kernel.append(run_kernel)
+        else:
+            # Compile the helpers first, so that run_kernel calls the compiled versions
+            jit = numba.njit(cache=True, nogil=True, error_model='numpy')
+            for name in KERNELS:
+                globals()[name] = jit(globals()[name])
+            _kernel.append(globals()['run_kernel'])
+    return _kernel[0]
+
+
+def parameters(flat):
+    '''
+    :param flat: celllist.FlatHexgrid
+    :return: (k, rho_j, D_sj, v_sj, f_j), the constants of a grid as passed to the kernels
+    '''
+    k = np.array([getattr(flat, name) for name in CONSTANTS] + [T2.calc_kappa(flat.D_sj)], dtype=float)
+    rho_j, D_sj, v_sj = (np.asarray(getattr(flat, name), dtype=float) for name in ('rho_j', 'D_sj', 'v_sj'))
+    f_j = np.asarray(T2.calc_fofR(T2.calc_Rpj(rho_j, flat.rho_a, D_sj, flat.nu, g=flat.g)), dtype=float)
+    return k, rho_j, D_sj, v_sj, f_j
+
+
+class CompiledHexgrid(FlatHexgrid):
+    '''
+    FlatHexgrid whose rules run the compiled kernels, one call per rule. Much slower than run_compiled for\
+    whole runs, but lets the kernels be checked rule by rule against Hexgrid (see verification.py).
+    '''
+
+    def calc_dt(self):
+        kernel()
+        k, rho_j = parameters(self)[:2]
+        return calc_dt(self.Q_th, self.Q_v, self.Q_cj, self.N, k, rho_j)
+
+    def T_1(self):
+        kernel()
+        k, rho_j = parameters(self)[:2]
+        T_1(self.Q_th, self.Q_v, self.Q_cj, self.N, k, rho_j, self.dt)
+
+    def T_2(self):
+        kernel()
+        k, rho_j, D_sj, v_sj, f_j = parameters(self)
+        T_2(self.Q_th, self.Q_v, self.Q_cj, self.Q_cbj, self.Q_d, self.Q_a, self.N, k, D_sj, v_sj, f_j, self.dt)
+
+    def I_1(self):
+        kernel()
+        k, rho_j = parameters(self)[:2]
+        I_1(self.Q_th, self.Q_v, self.Q_cj, self.Q_a, self.Q_o, self.NEIGHBOR, self.N, k, rho_j, self.dt)
+
+    def I_2(self):
+        kernel()
+        I_2(self.Q_th, self.Q_cj, self.Q_o, self.NEIGHBOR, self.N, np.zeros(self.N), np.zeros((self.N, self.Nj)))
+
+    def I_3(self):
+        kernel()
+        k, rho_j = parameters(self)[:2]
+        I_3(self.Q_th, self.Q_v, self.Q_cj, self.Q_a, self.Q_o, self.NEIGHBOR, self.N, k, rho_j)
+
+    def I_4(self):
+        kernel()
+        k = parameters(self)[0]
+        if not I_4(self.Q_cbj, self.Q_d, self.Q_a, self.NEIGHBOR, self.seaBedDiff, self.N, k,
+                   np.zeros((self.N + 1, 6)), np.zeros(self.N)):
+            raise RuntimeError('Negative sediment thickness!')
+
+
+def run_compiled(grid, max_steps=None, until=None, flow_eps=1e-6, bed_eps=1e-9, stable_steps=10,
+                 on_extinction='bed', callback=None, callback_every=0, diagnostics=(), every=1):
+    '''
+    Same as Hexgrid.run, but the whole loop runs in one compiled function.
+
+    :param grid: Hexgrid or celllist.FlatHexgrid. A Hexgrid is run on its active cells and updated in place.\
+    Its observers are notified after every step, which makes the loop return to Python after every step.
+    :param max_steps, until, flow_eps, bed_eps, stable_steps, on_extinction: See Hexgrid.run
+    :param callback: Called as callback(grid) once per step, as in Hexgrid.run. Stops the run if it returns True.\
+    The calls are made in batches every callback_every steps, and the grid holds the state at the end of the batch.
+    :param callback_every: Steps between batches of callbacks. 0 makes them all when the run stops.
+    :param diagnostics: Names of the diagnostics to write out (see DIAGNOSTICS)
+    :param every: Write out the diagnostics every every steps
+    :return: dict with keys 'reason', 'steps', 'bed_steps' and 't' as from Hexgrid.run, and\
+    'diagnostics', a dict with an array per requested diagnostic and 'step', the step numbers.
+    '''
+    if max_steps is None and until is None and on_extinction != 'bed':
+        raise ValueError('run() needs max_steps, until or on_extinction=\'bed\' to terminate')
+    if on_extinction not in ('bed', 'stop'):
+        raise ValueError('on_extinction must be \'bed\' or \'stop\'')
+    unknown = set(diagnostics) - set(DIAGNOSTICS)
+    if unknown:
+        raise ValueError('Unknown diagnostics: %s. Choose from %s' % (', '.join(sorted(unknown)), ', '.join(DIAGNOSTICS)))
+    if every < 1:
+        raise ValueError('every must be >= 1')
+
+    flat = grid if isinstance(grid, FlatHexgrid) else FlatHexgrid.from_hexgrid(grid)
+    flat.dt_max = grid.dt_max
+    # Observers see every step, so the kernel then returns to Python after each one (see FlatHexgrid.notify)
+    observed = bool(flat.observers) or (flat.source is not None and bool(flat.source.observers))
+    first = flat.stepCount
+    k, rho_j, D_sj, v_sj, f_j = parameters(flat)
+    state = np.zeros(7)
+    state[T] = flat.t
+    state[DT] = getattr(grid, 'dt', 0)
+    codes = np.array([DIAGNOSTICS.index(name) for name in diagnostics], dtype=np.int64)
+    size = min(max_steps // every, 1024) if max_steps is not None else 1024
+    buffer = np.zeros((max(size, 1), codes.size))
+    n_records = 0
+    run = kernel()
+
+    reason = PAUSE
+    called = 0  # Steps for which the callback has been called
+    while reason == PAUSE:
+        pause_at = state[STEPS] + callback_every if callback is not None and callback_every else np.inf
+        if observed:
+            pause_at = state[STEPS] + 1
+        if codes.size and n_records == buffer.shape[0]:
+            buffer = np.concatenate((buffer, np.zeros_like(buffer)))
+        with np.errstate(all='ignore'):
+            reason, n_records = run(flat.NEIGHBOR, flat.Q_th, flat.Q_v, flat.Q_cj, flat.Q_cbj, flat.Q_d, flat.Q_a,
+                                    flat.Q_o, flat.seaBedDiff, k, rho_j, D_sj, v_sj, f_j, state,
+                                    -1 if max_steps is None else max_steps, np.inf if until is None else until,
+                                    flow_eps, bed_eps, stable_steps, on_extinction == 'stop',
+                                    float(pause_at), codes, every, buffer, n_records)
+        flat.t = state[T]
+        flat.dt = state[DT]
+        if state[ERROR]:
+            raise RuntimeError('Negative sediment thickness!')
+        stepped = first + state[STEPS] > flat.stepCount
+        flat.stepCount = first + int(state[STEPS])
+        if observed and stepped:
+            flat.notify()
+        if callback is not None and state[STEPS] > called:
+            view = flat if flat is grid else flat.to_hexgrid(grid)
+            while called < state[STEPS]:
+                called += 1
+                if callback(view):
+                    reason = len(REASONS)
+                    break
+
+    if flat is not grid:
+        flat.to_hexgrid(grid)
+    report = {'reason': REASONS[reason] if reason < len(REASONS) else 'callback', 'steps': int(state[STEPS]),
+              'bed_steps': int(state[BED_STEPS]), 't': flat.t}
+    report['diagnostics'] = {name: buffer[:n_records, n].copy() for n, name in enumerate(diagnostics)}
+    report['diagnostics']['step'] = every * np.arange(1, n_records + 1)
+    return report
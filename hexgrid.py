@@ -1,19 +1,142 @@
-import matplotlib.pyplot as plt
+import atexit
+import copy
+from concurrent.futures import ThreadPoolExecutor
 
-plt.style.use('bmh')
 import numpy as np
-import numexpr as ne
-from datetime import datetime
 # from scipy.ndimage import imread
 import mathfunk as ma
 import T1functions as T1
 import T2functions as T2
 
+# Optional backends are imported on first use (see lazy_import), so that importing this module stays
+# cheap for headless worker processes. Plotting lives in plotting.py.
+_backends = {}
+
+
+def lazy_import(name):
+    '''
+    Imports an optional backend on first use.
+
+    :param name: Module name, e.g. 'numexpr'
+    :return: The module, or None if it is not installed.
+    '''
+    if name not in _backends:
+        try:
+            _backends[name] = __import__(name)
+        except ImportError:
+            _backends[name] = None
+    return _backends[name]
+
+
+_pools = {}
+
+
+def thread_pool(threads):
+    '''
+    :param threads: Number of threads
+    :return: A thread pool shared by all grids, created on first use. See close_thread_pools.
+    '''
+    if threads not in _pools:
+        _pools[threads] = ThreadPoolExecutor(threads, thread_name_prefix='hexgrid')
+    return _pools[threads]
+
+
+@atexit.register
+def close_thread_pools():
+    '''
+    Shuts the thread pools down and waits for their threads. Later calls of thread_pool create new ones.\
+    Called at exit, and e.g. by long-lived processes that no longer run threaded grids.
+    '''
+    while _pools:
+        _pools.popitem()[1].shutdown()
+
+
+def class_blocks(Nj, threads):
+    '''
+    Splits the sediment classes into contiguous blocks, one for each thread.
+
+    :param Nj: Number of sediment classes
+    :param threads: Number of threads
+    :return: List of slices
+    '''
+    bounds = np.linspace(0, Nj, min(max(threads, 1), Nj) + 1).round().astype(int).tolist()
+    return [slice(start, stop) for start, stop in zip(bounds[:-1], bounds[1:])]
+
+
+LAYOUTS = ('cell', 'class')
+
+
+class Shared():
+    '''
+    A substate held by several forked grids (see Hexgrid.fork). Each holder but the last gets a copy when it\
+    first uses the substate, and the last one takes the array itself.
+    '''
+    __slots__ = ('array', 'holders')
+
+    def __init__(self, array, holders):
+        self.array = array
+        self.holders = holders
+
+    def take(self):
+        self.holders -= 1
+        return self.array if self.holders == 0 else self.array.copy()
+
+
+def substate(name, doc, classAxis=False):
+    '''
+    Property for a substate. A substate shared with forked grids is copied when it is first used.\
+    For substates with a classAxis, of shape (..., Nj) or (..., 6), the layout of the grid applies: in the\
+    'cell' layout they are stored as they are, in the 'class' layout the last axis is stored first, e.g. Q_cj\
+    as (Nj, Ny, Nx), so that Q_cj[..., j] is contiguous. The property always returns the shape (..., Nj).
+
+    :param name: Name of the substate
+    :param doc: Description of the substate
+    :param classAxis: True if the last axis is the sediment class or direction
+    :return: property
+    '''
+    key = '_' + name
+
+    def get(self):
+        value = self.__dict__[key]
+        if type(value) is Shared:
+            value = self.__dict__[key] = value.take()
+        if classAxis and self.layout == 'class':
+            return np.moveaxis(value, 0, -1)
+        return value
+
+    def set(self, value):
+        if classAxis and self.layout == 'class':
+            value = np.ascontiguousarray(np.moveaxis(value, -1, 0))  # No copy if value came from get
+        self.__dict__[key] = value
+
+    return property(get, set, doc=doc)
+
 
 class Hexgrid():
     '''Simulates a turbidity current using a CA. '''
 
-    def __init__(self, Nx, Ny, ICstates=None, reposeAngle=np.deg2rad(0), dx=1, terrain=None):
+    dt_max = np.inf  # Upper limit on the time step. Used when subcycling a grid to a given time.
+    classThreads = 1  # Threads over which T_2 splits the sediment classes
+    layout = 'cell'  # Memory layout of Q_cj, Q_cbj and Q_o, one of LAYOUTS (see substate)
+
+    observers = ()  # Called as observer(grid) at the end of every time step (see addObserver)
+    stepCount = 0  # Time steps made by the grid, flow and bed-only, by any engine
+
+    SUBSTATES = ('Q_th', 'Q_v', 'Q_cj', 'Q_cbj', 'Q_d', 'Q_a', 'Q_o')
+    Q_th = substate('Q_th', 'Turbidity current thickness')
+    Q_v = substate('Q_v', 'Turbidity current speed (scalar)')
+    Q_cj = substate('Q_cj', 'jth current sediment volume concentration', classAxis=True)
+    Q_cbj = substate('Q_cbj', 'jth bed sediment volume fraction', classAxis=True)
+    Q_d = substate('Q_d', 'Thickness of soft sediment')
+    Q_a = substate('Q_a', 'Bathymetry plus soft sediment')
+    Q_o = substate('Q_o', 'Density current outflow', classAxis=True)
+
+    def __init__(self, Nx, Ny, ICstates=None, reposeAngle=np.deg2rad(0), dx=1, terrain=None, cache=None,
+                 shared=None, layout=None):
+        if layout is not None:
+            if layout not in LAYOUTS:
+                raise ValueError('Unknown layout %r. Choose from %s' % (layout, ', '.join(LAYOUTS)))
+            self.layout = layout
         ################ Constants ######################
         self.g = 9.81  # Gravitational acceleration
         self.f = 0.04  # Darcy-Weisbach coeff
@@ -37,12 +160,6 @@ class Hexgrid():
         self.reposeAngle = reposeAngle
         
 
-        ################     Grid       ###################
-        self.X = np.zeros((Ny, Nx, 2))  # X[:,:,0] = X coords, X[:,:,1] = Y coords
-        for j in range(Ny):
-            self.X[j, :, 0] = j * dx / 2 + np.arange(Nx) * dx
-            self.X[j, :, 1] = -np.ones(Nx) * dx * np.sqrt(3) / 2 * j
-
         ################# Cell substate storage ####################
         #         self.Q_a   = np.zeros((self.Ny,self.Nx)) # Cell altitude (bathymetry at t = 0)
         self.Q_th = np.zeros((self.Ny, self.Nx))  # Turbidity current thickness
@@ -57,15 +174,21 @@ class Hexgrid():
         ################### Set Initial conditions #####################
         if ICstates is not None: self.setIC(ICstates)
         self.CellArea = ma.calc_hexagon_area(dx)
-        self.setBathymetry(terrain)
-        self.diff = np.zeros((self.Ny - 2, self.Ny - 2, 6))
-        self.seaBedDiff = np.zeros((self.Ny - 2, self.Nx - 2, 6))
-        self.calc_bathymetryDiff()
+        self.diff = np.zeros((self.Ny - 2, self.Nx - 2, 6))
+        self.diffHeight = None  # Q_d for which self.diff is up to date (see update_Hdiff)
+        self.toppleParameters = None  # (reposeAngle, dx) used for self.deltaS
+        if shared is not None:  # Q_a, Q_d, X and seaBedDiff from a sharedterrain.SharedTerrain
+            shared.attach(self)
+        else:
+            self.setBathymetry(terrain)
+            self.precomputeTerrain(cache)
 
         #         self.totalheight = self.Q_d + self.Q_a
 
         self.defineNeighbors()
         
+        self.t = 0  # Simulated time
+
         # FOR DEBUGGING
         self.i = 0
         self.Erosionrate =[]
@@ -75,6 +198,40 @@ class Hexgrid():
         ##########################  Methods ############################
         ################################################################
 
+    def fork(self):
+        '''
+        Returns an independent copy of the grid, to be run on from the current state, e.g. with other sources\
+        or parameters. Forking is cheap: the substates are shared and only copied when a grid first uses them\
+        (see Shared), and the terrain arrays X and seaBedDiff, which the rules only read, are shared for good\
+        and made read-only.
+
+        :return: Hexgrid
+        '''
+        child = copy.copy(self)
+        for name in self.SUBSTATES:
+            key = '_' + name
+            value = self.__dict__[key]
+            if type(value) is Shared:
+                value.holders += 1
+            else:
+                value = self.__dict__[key] = Shared(value, 2)
+            child.__dict__[key] = value
+        for name in ('X', 'seaBedDiff'):
+            getattr(self, name).flags.writeable = False
+        # I_4 updates these in place (see update_Hdiff)
+        child.diff = np.empty_like(self.diff)
+        child.diffHeight = None
+        child.observers = ()
+        child.Erosionrate = list(self.Erosionrate)
+        child.Depositionrate = list(self.Depositionrate)
+        return child
+
+    def classZeros(self, shape):
+        '''Zeros of shape (..., Nj) or (..., 6), stored in the layout of the grid (see substate).'''
+        if self.layout == 'class':
+            return np.moveaxis(np.zeros(shape[-1:] + shape[:-1]), 0, -1)
+        return np.zeros(shape)
+
     def setIC(self, ICstates):
         self.Q_th = ICstates[0].copy()
         self.Q_v = ICstates[1].copy()
@@ -84,6 +241,33 @@ class Hexgrid():
         self.Q_o = ICstates[5].copy()
         self.Q_a = self.Q_d.copy()
 
+    def precomputeTerrain(self, cache=None):
+        '''
+        Computes the cell coordinates X and the bathymetry differences seaBedDiff.\
+        If a terraincache.TerrainCache is given, they are memory-mapped from the cache when the\
+        bathymetry has been seen before, and stored in the cache otherwise.
+        '''
+        key = None
+        if cache is not None:
+            key = cache.key(self.Q_a, self.Q_d, self.Nx, self.Ny, self.dx)
+            arrays = cache.load(key)
+            if arrays is not None:
+                self.X = arrays['X']
+                self.seaBedDiff = arrays['seaBedDiff']
+                return
+        self.calc_coordinates()
+        self.seaBedDiff = np.zeros((self.Ny - 2, self.Nx - 2, 6))
+        self.calc_bathymetryDiff()
+        if cache is not None:
+            cache.store(key, {'X': self.X, 'seaBedDiff': self.seaBedDiff})
+
+    def calc_coordinates(self):
+        ''' X[:,:,0] = X coords, X[:,:,1] = Y coords of the cell centers.'''
+        self.X = np.zeros((self.Ny, self.Nx, 2))
+        rows = np.arange(self.Ny)[:, np.newaxis]
+        self.X[:, :, 0] = rows * self.dx / 2 + np.arange(self.Nx) * self.dx
+        self.X[:, :, 1] = -self.dx * np.sqrt(3) / 2 * rows
+
     def defineNeighbors(self): # Note to self: This works as intended. See testfile in "Testing of functions"
         '''
         This function defines indices that can be used to reference the neighbors of a cell.\
@@ -100,6 +284,11 @@ class Hexgrid():
     def time_step(self):
         #         g_prime = self.calc_g_prime()
         self.dt = self.calc_dt()  # Works as long as all ICs are given
+        if not np.isfinite(self.dt):  # The current has died out. Only the toppling rule does anything.
+            self.step_bed()
+            return
+        self.dt = min(self.dt, self.dt_max)
+        self.t += self.dt
         #         print("dt = ", self.dt)
         # The order comes from the article
 
@@ -126,6 +315,96 @@ class Hexgrid():
         self.I_4()  # Toppling rule
         # print("Post T_2 \n")
         # self.printCA()
+        self.stepCount += 1
+        self.notify()
+
+    def step_bed(self):
+        '''
+        Cheap time step used once the turbidity current has died out.\
+        Only the toppling rule is applied, and the simulated time is not advanced.
+        '''
+        self.I_4()
+        self.stepCount += 1
+        self.notify()
+
+    def addObserver(self, observer):
+        '''Calls observer(grid) at the end of every time step, e.g. a probes.Probes.'''
+        self.observers = tuple(self.observers) + (observer,)
+
+    def removeObserver(self, observer):
+        self.observers = tuple(o for o in self.observers if o is not observer)
+
+    def notify(self):
+        for observer in self.observers:
+            observer(self)
+
+    def run(self, max_steps=None, until=None, flow_eps=1e-6, bed_eps=1e-9, stable_steps=10,
+            on_extinction='bed', callback=None):
+        '''
+        Advances the CA until one of the stopping criteria is met, and returns a report of why it stopped.
+
+        :param max_steps: Maximum number of time steps (flow and bed-only steps combined).
+        :param until: Simulated time at which to stop.
+        :param flow_eps: The flow is considered extinct when max(Q_th) < flow_eps.
+        :param bed_eps: The bed is considered stable in a step when max(abs(change in Q_d)) < bed_eps.
+        :param stable_steps: Number of consecutive stable bed-only steps before stopping.
+        :param on_extinction: 'bed' switches to the cheap bed-only mode when the flow is extinct,\
+        'stop' stops immediately.
+        :param callback: Called as callback(self) after every step. Stops the run if it returns True.
+        :return: dict with keys 'reason', 'steps', 'bed_steps' and 't'.
+        '''
+        if max_steps is None and until is None and on_extinction != 'bed':
+            raise ValueError('run() needs max_steps, until or on_extinction=\'bed\' to terminate')
+        if on_extinction not in ('bed', 'stop'):
+            raise ValueError('on_extinction must be \'bed\' or \'stop\'')
+        steps = 0
+        bed_steps = 0
+        stable = 0
+        bed_only = False
+        reason = None
+        while reason is None:
+            if max_steps is not None and steps >= max_steps:
+                reason = 'max_steps'
+                break
+            if until is not None and self.t >= until:
+                reason = 'until'
+                break
+            if not bed_only and (self.is_flow_extinct(flow_eps) or not np.isfinite(getattr(self, 'dt', 0))):
+                if on_extinction == 'stop':
+                    reason = 'extinct'
+                    break
+                bed_only = True
+            if bed_only:
+                oldQ_d = self.interior(self.Q_d).copy()
+                self.step_bed()
+                bed_steps += 1
+                change = np.abs(self.interior(self.Q_d) - oldQ_d)
+                stable = stable + 1 if (change.size == 0 or np.amax(change) < bed_eps) else 0
+            else:
+                self.time_step()
+            steps += 1
+            if callback is not None and callback(self):
+                reason = 'callback'
+            elif bed_only and stable >= stable_steps:
+                reason = 'stable'
+        return {'reason': reason, 'steps': steps, 'bed_steps': bed_steps, 't': self.t}
+
+    def run_compiled(self, max_steps=None, until=None, diagnostics=(), every=1, **kwargs):
+        '''
+        Fast path of run() for small grids: the whole loop runs in one compiled function (needs numba).\
+        Only the requested diagnostics are written out. See compiled.run_compiled.
+        '''
+        from compiled import run_compiled
+        return run_compiled(self, max_steps=max_steps, until=until, diagnostics=diagnostics, every=every, **kwargs)
+
+    def is_flow_extinct(self, flow_eps=1e-6):
+        '''Returns True when the turbidity current thickness is below flow_eps in all interior cells.'''
+        interior = self.interior(self.Q_th)
+        return interior.size == 0 or np.amax(interior) < flow_eps
+
+    def interior(self, array):
+        '''Returns the interior (non-border) cells of a substate.'''
+        return array[1:-1, 1:-1]
 
     def T_1(self):  # Water entrainment. IN: Q_a,Q_th,Q_cj,Q_v. OUT: Q_vj,Q_th
         '''
@@ -171,49 +450,70 @@ class Hexgrid():
         # Z_mj = numpy.ndarray(Ny,Nx,Nj)
         # E_j = numpy.ndarray(Ny,Nx,Nj)
 
+        # Deposition and erosion rates are zero where there is neither current speed nor suspended sediment, so only
+        # the other cells are computed, as (n,Nj) arrays of the active cells.
+        active = (self.Q_v[1:-1, 1:-1] != 0) | np.any(self.Q_cj[1:-1, 1:-1] != 0, axis=2)
+        dt = self.dt
+        if np.ndim(dt):  # One time step per cell (see multirate.py). Cells with dt = 0 are left as they are.
+            active &= dt[1:-1, 1:-1] != 0
+        if active.mean() > 0.5 and not np.ndim(dt):
+            cells = np.s_[1:-1, 1:-1]  # Cheaper to compute all cells than to gather most of them
+        else:
+            cells = tuple(index + 1 for index in np.nonzero(active))
+        Q_th, Q_v, Q_cj, Q_cbj, Q_d = (self.Q_th[cells], self.Q_v[cells], self.Q_cj[cells], self.Q_cbj[cells],
+                                       self.Q_d[cells])
+        if np.ndim(dt):
+            dt = dt[cells]
+
         R_pj = T2.calc_Rpj(self.rho_j, self.rho_a, self.D_sj, self.nu, g=self.g)  # Assume rho = rho_ambient.
         #         print("R_pj=\n",R_pj)
         f = T2.calc_fofR(R_pj)
         kappa = T2.calc_kappa(self.D_sj)
-        Ustar = T2.calc_Ustar(self.c_D, self.Q_v)
+        Ustar = T2.calc_Ustar(self.c_D, Q_v)
         g_reduced = T2.calc_g_reduced(self.rho_j, self.rho_a, g=self.g)
         # v_sjSTARold = T2.calc_dimless_sphere_settlingVel(self.v_sj, g_reduced, self.nu)
         # v_sjSTAR = T2.calc_sphere_settlingVel(self.rho_j, self.rho_a, self.g, self.D_sj, self.nu)
         v_sjSTAR = self.v_sj # Use this according to Salles' email
-        D_sg = T2.calc_averageSedimentSize(self.Q_cj, self.D_sj)
-        c_nbj = T2.calc_nearBedConcentration_SusSed(self.D_sj, D_sg, self.Q_cj)
-
-        D_j = np.nan_to_num(T2.calc_depositionRate(v_sjSTAR, c_nbj))
-        Z_mj = T2.calc_Z_mj(kappa, Ustar, v_sjSTAR, f)
-        E_j = T2.calc_erotionRate(Z_mj)
-
-        # Use old values in equations!
-        oldQ_th = self.Q_th
-        oldQ_cj = self.Q_cj.copy()
-        oldQ_d = self.Q_d.copy()
+        D_sg = T2.calc_averageSedimentSize(Q_cj, self.D_sj)
+
+        def exchange(js):  # Everything that is independent for each sediment class
+            c_nbj = T2.calc_nearBedConcentration_SusSed(self.D_sj[js], D_sg, Q_cj[..., js])
+            D_j = np.nan_to_num(T2.calc_depositionRate(v_sjSTAR[js], c_nbj))
+            Z_mj = T2.calc_Z_mj(kappa, Ustar, v_sjSTAR[js], f[js])
+            E_j = T2.calc_erotionRate(Z_mj)
+            # Rescale D_j and E_j to prevent too much material being moved, and find the changes. All changes use
+            # the old values.
+            return T2.T2_class_exchange(dt, D_j, E_j, self.porosity, Q_th, Q_cj[..., js], self.p_adh,
+                                        Q_cbj[..., js], Q_d)
+
+        # The sediment classes are split into blocks that run on separate threads. The sums over the classes
+        # are done afterwards in class order, so the results do not depend on the number of threads.
+        blocks = class_blocks(self.Nj, self.classThreads)
+        mapBlocks = thread_pool(len(blocks)).map if len(blocks) > 1 else map
+        D_j, E_j, net, var, change_qcj = (np.concatenate(parts, axis=-1)
+                                          for parts in zip(*mapBlocks(exchange, blocks)))
+        change_qd, total = T2.T2_sum_exchange(dt, self.porosity, net, var)
+        change_qcbj = np.concatenate(list(mapBlocks(
+            lambda js: T2.T2_class_change_qcbj(var[..., js], Q_cbj[..., js], Q_d, total), blocks)), axis=-1)
 
-        #Rescale D_j and E_j to prevent too much material being moved
-        D_j, E_j = T2.rescale_Dj_E_j(D_j,self.dt,self.porosity,self.Q_th,self.Q_cj,self.p_adh,self.Q_cbj,E_j,self.Q_d)
-        
-        
         # IF Q_cj = 1 increase the deposition rate D_j to compensate?
-#         temp_delta_qa = T2.T2_calc_change_qd(self.dt,D_j,self.Q_cbj,E_j,self.porosity, oldQ_th, oldQ_cj)
-        
 #         D_j = np.where(self.Q_cj>=0.85, D_j*100,D_j)
-        
-        
-        
-        
-        
+
         #DEBUGGING!
-        self.Erosionrate.append(np.amax(E_j.flatten()))
-        self.Depositionrate.append(np.amax(D_j.flatten()))
+        self.Erosionrate.append(np.amax(E_j, initial=0))
+        self.Depositionrate.append(np.amax(D_j, initial=0))
         #######
 
-        self.Q_a[1:-1,1:-1] += T2.T2_calc_change_qd(self.dt,D_j,self.Q_cbj,E_j,self.porosity, oldQ_th, oldQ_cj)
-        self.Q_d[1:-1,1:-1] += T2.T2_calc_change_qd(self.dt,D_j,self.Q_cbj,E_j,self.porosity, oldQ_th, oldQ_cj)
-        self.Q_cj[1:-1,1:-1,:] -= T2.T2calc_change_qcj(self.dt, D_j, self.Q_cbj, E_j, self.porosity, oldQ_th, oldQ_cj)
-        self.Q_cbj[1:-1,1:-1,:] += T2.T2_calc_change_qCBJ(self.dt, D_j, self.Q_cbj, E_j, self.porosity, oldQ_d, oldQ_th, oldQ_cj)
+        # Only cells that change are written, so that the pages of a shared terrain stay shared (see sharedterrain.py)
+        changed = change_qd != 0
+        if isinstance(cells[0], slice):
+            bed = tuple(index + 1 for index in np.nonzero(changed))
+        else:
+            bed = tuple(index[changed] for index in cells)
+        self.Q_a[bed] += change_qd[changed]
+        self.Q_d[bed] += change_qd[changed]
+        self.Q_cj[cells] -= change_qcj
+        self.Q_cbj[cells] += change_qcbj
 
         # Fail-safe
         self.Q_cbj[self.Q_cbj>1] = 1 # TODO Testing
@@ -313,7 +613,7 @@ class Hexgrid():
         outflowNo = np.array([3, 4, 5, 0, 1, 2])  # Used to find "inflow" to cell from neighbors
         s = np.zeros((self.Ny - 2, self.Nx - 2))
         #         term1 =np.zeros((self.Ny-2,self.Nx-2,self.Nj))
-        term2 = np.zeros((self.Ny - 2, self.Nx - 2, self.Nj))
+        term2 = self.classZeros((self.Ny - 2, self.Nx - 2, self.Nj))
         for i in range(6):
             inn = (self.Q_o[self.NEIGHBOR[i] + (outflowNo[i],)])
             out = self.Q_o[1:-1, 1:-1, i]
@@ -384,45 +684,57 @@ class Hexgrid():
 
     def I_4(self):  # Toppling rule
         interiorH = self.Q_d[1:self.Ny - 1, 1:self.Nx - 1]
-
-        angle = np.zeros((self.Ny - 2, self.Ny - 2, 6))
-        indices = np.zeros((self.Ny - 2, self.Ny - 2, 6))
-        NoOfTrans = np.zeros((self.Ny - 2, self.Nx - 2))
-        frac = np.zeros((self.Ny - 2, self.Nx - 2, 6))
-        deltaS = np.zeros((self.Ny - 2, self.Nx - 2, 6))
         deltaSSum = np.zeros((self.Ny - 2, self.Nx - 2))
 
-        self.calc_Hdiff()
-        diff = self.diff
+        if self.toppleParameters != (self.reposeAngle, self.dx):
+            self.diffHeight = None  # Test all cells again
+            self.toppleParameters = (self.reposeAngle, self.dx)
+        # Only the cells whose height differences changed since the last call are tested. The other cells
+        # transfer the same mass as in the last call, which is kept in self.deltaS.
+        dirty = self.update_Hdiff()
+        if dirty.mean() > 0.5:
+            cells = slice(None)  # Cheaper to test all cells than to gather most of them
+        else:
+            cells = np.flatnonzero(dirty)
+        diff = self.diff.reshape(-1, 6)[cells]
+        H = interiorH.reshape(-1)[cells]
+
+        indices = np.zeros((H.size, 6))
+        NoOfTrans = np.zeros(H.size)
+        frac = np.zeros((H.size, 6))
+        deltaS = np.zeros((H.size, 6))
 
         # Find angles
         dx = self.dx
-        angle = ne.evaluate('arctan2(diff,dx)')
+        ne = lazy_import('numexpr')
+        if ne is not None:
+            angle = ne.evaluate('arctan2(diff,dx)')
+        else:
+            angle = np.arctan2(diff, dx)
 
         # (Checks if cell (i,j) has angle > repose angle and that it has mass > 0. For all directions.)
         # Find cells (i,j) for which to transfer mass in the direction given
         for i in np.arange(6):
-            indices[:, :, i] = np.logical_and(angle[:, :, i] > self.reposeAngle, (
-                    interiorH > 0))  # Gives indices (i,j) where the current angle > repose angle and where height is > 0
+            indices[:, i] = np.logical_and(angle[:, i] > self.reposeAngle, (
+                    H > 0))  # Gives indices (i,j) where the current angle > repose angle and where height is > 0
 
         # Count up the number of cells (i,j) will be transfering mass to. If none, set (i,j) to infinity so that division works.
-        #         NoOfTrans = np.sum(indices,axis=2)  # Gir tregere resultat?
         for i in np.arange(6):
-            NoOfTrans += indices[:, :, i]
+            NoOfTrans += indices[:, i]
         NoOfTrans[NoOfTrans == 0] = np.inf
 
         # Calculate fractions of mass to be transfered
         for i in np.arange(6):
-            frac[(indices[:, :, i] > 0), i] = (
-                    0.5 * (diff[(indices[:, :, i] > 0), i] - self.dx * np.tan(self.reposeAngle)) / (
-                interiorH[(indices[:, :, i] > 0)]))
+            transfer = indices[:, i] > 0
+            frac[transfer, i] = 0.5 * (diff[transfer, i] - self.dx * np.tan(self.reposeAngle)) / H[transfer]
         frac[frac > 0.5] = 0.5
-        #         print("frac.shape=",frac.shape)
 
         for i in np.arange(6):
-            deltaS[(indices[:, :, i] > 0), i] = interiorH[(indices[:, :, i] > 0)] * frac[(indices[:, :, i] > 0), i] / \
-                                                NoOfTrans[(indices[:, :,
-                                                           i] > 0)]  # Mass to be transfered from index [i,j] to index [i-1,j]
+            transfer = indices[:, i] > 0
+            deltaS[transfer, i] = H[transfer] * frac[transfer, i] / NoOfTrans[transfer]  # Mass to be transfered from index [i,j] to index [i-1,j]
+
+        self.deltaS.reshape(-1, 6)[cells] = deltaS  # Also used for the interface corrections in refinement.py
+        deltaS = self.deltaS
 
         # Lag en endringsmatrise deltaSSum som kan legges til self.Q_d
         # Trekk fra massen som skal sendes ut fra celler
@@ -437,8 +749,9 @@ class Hexgrid():
         deltaSSum += np.roll(np.roll(deltaS[:, :, 5], 0, 0), -1, 1)
         
         oldQ_d = self.Q_d.copy()
-        self.Q_d[1:-1, 1:-1] += deltaSSum
-        self.Q_a[1:-1, 1:-1] += deltaSSum
+        changed = deltaSSum != 0  # Only cells that change are written (see T_2)
+        self.Q_d[1:-1, 1:-1][changed] += deltaSSum[changed]
+        self.Q_a[1:-1, 1:-1][changed] += deltaSSum[changed]
         # Legg inn endring i volum fraksjon Q_cbj
         prefactor = 1 / self.Q_d[1:-1, 1:-1, np.newaxis]
         prefactor[np.isinf(prefactor)] = 0
@@ -451,20 +764,30 @@ class Hexgrid():
             raise RuntimeError('Negative sediment thickness!')
 
     def setBathymetry(self, terrain):
-        if terrain is not None:
+        '''
+        Adds a terrain to Q_a: 'river', 'pit', or a generator of terrain.py, given by its name or a dict of\
+        its name ('kind') and options.
+        '''
+        if terrain is not None and terrain not in ('river', 'pit'):
+            from terrain import add_terrain
+            add_terrain(self.Q_a, self.dx, terrain)
+        elif terrain is not None:
             x = np.linspace(0, 100, self.Nx)
             y = np.linspace(0, 100, self.Ny)
             X = np.array(np.meshgrid(x, y))
             temp = np.zeros((self.Ny, self.Nx))
-            if terrain is 'river':
+            if terrain == 'river':
                 temp = -2 * X[1, :] + 5 * np.abs(X[0, :] - 50 + 10 * np.sin(X[1, :] / 10))
                 #                 temp = 2*self.X[:,:,1] + 5*np.abs(self.X[:,:,0] + 10*np.sin(self.X[:,:,1]/10))
                 self.Q_a += temp  # BRUK MED RIVER
-            elif terrain is 'pit':
+            elif terrain == 'pit':
                 temp = np.sqrt((X[0, :] - 50) * (X[0, :] - 50) + (X[1, :] - 50) * (X[1, :] - 50))
                 self.Q_a += 10 * temp
 
     def calc_bathymetryDiff(self):
+        self.diffHeight = None  # self.diff has to be recomputed
+        if not self.seaBedDiff.flags.writeable:  # Shared with forked grids, or read from a cache
+            self.seaBedDiff = np.empty_like(self.seaBedDiff)
         temp = self.Q_a - self.Q_d
         self.seaBedDiff[:, :, 0] = temp[1:-1, 1:-1] - temp[0:self.Ny - 2, 1:self.Nx - 1]
         self.seaBedDiff[:, :, 1] = temp[1:-1, 1:-1] - temp[0:self.Ny - 2, 2:self.Nx]
@@ -487,6 +810,31 @@ class Hexgrid():
         self.diff[:, :, 4] = interiorH - old_height[2:self.Ny, 0:self.Nx - 2] + self.seaBedDiff[:, :, 4]
         self.diff[:, :, 5] = interiorH - old_height[1:self.Ny - 1, 0:self.Nx - 2] + self.seaBedDiff[:, :, 5]
 
+    def update_Hdiff(self):
+        '''
+        Brings self.diff up to date with Q_d. Only the cells where Q_d of the cell or of a neighbor changed\
+        since the last call are recomputed. Returns a bool (Ny-2,Nx-2) array of those cells.
+        '''
+        if self.diffHeight is None:
+            self.calc_Hdiff()
+            self.diffHeight = self.Q_d.copy()
+            self.deltaS = np.zeros((self.Ny - 2, self.Nx - 2, 6))
+            return np.ones((self.Ny - 2, self.Nx - 2), dtype=bool)
+        moved = self.Q_d != self.diffHeight
+        dirty = moved[1:-1, 1:-1].copy()
+        for i in range(6):
+            dirty |= moved[self.NEIGHBOR[i]]
+        self.diffHeight[moved] = self.Q_d[moved]
+        if dirty.mean() > 0.5:
+            self.calc_Hdiff()
+            return dirty
+        rows, cols = np.nonzero(dirty)
+        for i in range(6):
+            neighborRows, neighborCols = self.NEIGHBOR[i][0][rows, 0], self.NEIGHBOR[i][1][0, cols]
+            self.diff[rows, cols, i] = (self.Q_d[rows + 1, cols + 1] - self.Q_d[neighborRows, neighborCols]
+                                        + self.seaBedDiff[rows, cols, i])
+        return dirty
+
     def calc_BFroudeNo(self, g_prime):  # out: Bulk Froude No matrix
         U = self.Q_v
         g: np.ndarray = g_prime.copy()
@@ -506,8 +854,12 @@ class Hexgrid():
         return (self.dx / 2) / np.sqrt(2 * r_j * g_prime)
 
     def calc_dt(self):
+        '''Returns the time step, or np.inf if no cell has a current (i.e. the current has died out).'''
         temp = self.calc_MaxRelaxationTime()
-        dt = 0.5 * np.amin(temp[np.isfinite(temp) & (~np.isnan(temp)) & (temp > 0)])
+        temp = temp[np.isfinite(temp) & (~np.isnan(temp)) & (temp > 0)]
+        if temp.size == 0:
+            return np.inf
+        dt = 0.5 * np.amin(temp)
         return dt
 
     def printCA(self):
@@ -0,0 +1,171 @@
+'''
+Sparse delta-encoded history output.
+
+DeltaHistoryWriter stores a full keyframe every keyframe_every frames. In between, it only stores the
+cells that changed since the previous frame, as flat indices plus values. With a tolerance > 0 a
+cell only counts as changed when it differs by more than the tolerance from the value the reader
+will reconstruct, and the stored values are quantised to multiples of the tolerance, so every
+reconstructed value is within the tolerance of the true value.
+DeltaHistoryReader reconstructs any frame by replaying the deltas from the preceding keyframe.
+
+The index (INDEX) is a JSON Lines file: a header with the settings, then one line per frame, appended
+and flushed once the frame is written. A run that is killed leaves a history that can be read up to
+its last complete frame; a line cut off by the kill is ignored.
+
+Use:
+
+    with DeltaHistoryWriter('out/history', keyframe_every=20, tolerance=1e-6) as writer:
+        for i in range(n):
+            grid.time_step()
+            writer.record(grid, step=i + 1)
+
+    history = DeltaHistoryReader('out/history')
+    frame = history.frame(37)  # {'Q_th': ..., 'Q_cj': ..., 'Q_d': ...}
+'''
+import json
+import os
+
+import numpy as np
+
+FIELDS = ('Q_th', 'Q_cj', 'Q_d')
+INDEX = 'history.jsonl'
+
+
+def frame_file(path, n):
+    return os.path.join(path, 'frame_%06d.npz' % n)
+
+
+class DeltaHistoryWriter():
+    '''Writes the changed cells of selected substates between output steps.'''
+
+    def __init__(self, path, fields=FIELDS, keyframe_every=10, tolerance=0.0):
+        '''
+        :param path: Output directory
+        :param fields: Names of the Hexgrid substates to record
+        :param keyframe_every: Store a full frame every keyframe_every frames
+        :param tolerance: Changes smaller than or equal to the tolerance are not stored, and stored\
+        values are quantised to multiples of it. 0 stores every change exactly.
+        '''
+        if keyframe_every < 1:
+            raise ValueError('keyframe_every must be >= 1')
+        self.path = path
+        self.fields = tuple(fields)
+        self.keyframe_every = keyframe_every
+        self.tolerance = tolerance
+        self.frames = []
+        self.reference = {}  # What the reader reconstructs for the last written frame
+        os.makedirs(path, exist_ok=True)
+        self.index = open(os.path.join(path, INDEX), 'w')
+        self.append({'fields': self.fields, 'keyframe_every': self.keyframe_every, 'tolerance': self.tolerance})
+
+    def append(self, entry):
+        '''Appends a line to the index and flushes it.'''
+        self.index.write(json.dumps(entry) + '\n')
+        self.index.flush()
+
+    def record(self, grid, step=None):
+        '''Writes the current state of grid as the next frame.'''
+        n = len(self.frames)
+        keyframe = n % self.keyframe_every == 0
+        data = {}
+        for name in self.fields:
+            current = getattr(grid, name)
+            if keyframe:
+                self.reference[name] = np.array(current)
+                data[name] = current
+            else:
+                data.update(self.encode(name, current))
+        np.savez(frame_file(self.path, n), **data)
+        self.frames.append({'step': n if step is None else int(step), 't': float(grid.t), 'keyframe': keyframe})
+        self.append(self.frames[-1])  # Only after the frame, so that every frame in the index is complete
+
+    def encode(self, name, current):
+        reference = self.reference[name]
+        with np.errstate(invalid='ignore'):
+            if self.tolerance > 0:
+                changed = ~(np.abs(current - reference) <= self.tolerance)
+            else:
+                changed = current != reference
+        changed &= ~(np.isnan(current) & np.isnan(reference))
+        changed &= ~(np.isinf(current) & (current == reference))
+        index = np.flatnonzero(changed)
+        index = index.astype(np.int32) if current.size < 2 ** 31 else index
+        values = current.ravel()[index]
+        if self.tolerance > 0 and np.all(np.isfinite(values)):
+            quantised = np.round(values / self.tolerance)
+            if quantised.size == 0 or np.amax(np.abs(quantised)) < 2 ** 31:
+                values = quantised.astype(np.int32)
+        reference.ravel()[index] = decode(values, self.tolerance)
+        return {name + '_index': index, name + '_values': values}
+
+    def close(self):
+        '''Closes the index. The frames are in it as soon as they are recorded.'''
+        self.index.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def decode(values, tolerance):
+    if values.dtype.kind == 'i':
+        return values * tolerance
+    return values
+
+
+class DeltaHistoryReader():
+    '''Reconstructs frames written by DeltaHistoryWriter.'''
+
+    def __init__(self, path):
+        '''
+        :param path: Directory of the history. It may still be written, or be left by a run that was killed:\
+        the frames are those in the index when it is read.
+        '''
+        self.path = path
+        with open(os.path.join(path, INDEX)) as file:
+            lines = file.read().split('\n')
+        entries = []
+        for line in lines:
+            try:
+                entries.append(json.loads(line))
+            except ValueError:  # The end of the file, or a last line cut off while it was written
+                break
+        header = entries[0]
+        self.fields = tuple(header['fields'])
+        self.keyframe_every = header['keyframe_every']
+        self.tolerance = header['tolerance']
+        self.frames = entries[1:]
+        self.steps = np.array([frame['step'] for frame in self.frames])
+        self.times = np.array([frame['t'] for frame in self.frames])
+        self._last = None  # (n, state) of the last reconstructed frame
+
+    def __len__(self):
+        return len(self.frames)
+
+    def __iter__(self):
+        for n in range(len(self)):
+            yield self.frame(n)
+
+    def frame(self, n):
+        '''
+        :param n: Frame number (not the time step number, see self.steps)
+        :return: dict of substate name -> array
+        '''
+        if not 0 <= n < len(self):
+            raise IndexError('frame %d out of range' % n)
+        keyframe = n - n % self.keyframe_every
+        if self._last is not None and keyframe <= self._last[0] <= n:
+            start, state = self._last
+            state = {name: value.copy() for name, value in state.items()}
+        else:
+            with np.load(frame_file(self.path, keyframe)) as data:
+                state = {name: data[name] for name in self.fields}
+            start = keyframe
+        for i in range(start + 1, n + 1):
+            with np.load(frame_file(self.path, i)) as data:
+                for name in self.fields:
+                    state[name].ravel()[data[name + '_index']] = decode(data[name + '_values'], self.tolerance)
+        self._last = (n, state)
+        return {name: value.copy() for name, value in state.items()}
@@ -0,0 +1,451 @@
+'''
+Local simulation job server.
+
+Every notebook or script that runs scenarios itself pays for the imports and initialisation, and competes
+for the cores with the others. The job server keeps a warm pool of worker processes that have hexgrid and
+the runner already imported, takes scenario jobs from any number of clients over a Unix socket, runs them
+in order of priority, and streams per-step diagnostics back to the client that submitted them.
+When there are more small jobs waiting than free workers, those with the same engine are spread over the
+free workers in batches, so that they share one round trip to the pool; while workers are idle, every job
+gets one to itself. A worker that dies is replaced, together with the rest of the pool. Occupancy and throughput of the pool can be queried at any time.
+
+The protocol is one JSON object per line, in both directions:
+
+    {"op": "submit", "scenario": {...} or "path": "scenario.toml", "steps": 500, "until": null,
+     "engine": "numpy", "priority": 0, "diagnostics": ["t", "current_volume"], "every": 10, "output": null}
+        -> {"event": "queued", "job": 3}, then {"event": "progress", "job": 3, "step": 10, "values": {...}}
+           every "every" steps, and finally {"event": "done", "job": 3, "report": {...}}
+           or {"event": "error", "job": 3, "error": "..."}
+    {"op": "cancel", "job": 3}   -> {"event": "cancelled", "job": 3, "ok": true} (queued jobs only)
+    {"op": "stats"}              -> {"event": "stats", "workers": 8, "busy": 2, "queued": 5, ...}
+
+Jobs with a higher priority run first. The diagnostics are those of compiled.DIAGNOSTICS.
+
+Usage:
+
+    python -m jobserver serve [--socket PATH] [--workers N] [--warm-compiled]
+    python -m jobserver submit scenario.toml [--steps N] [--priority P] [--diagnostics t current_volume]
+    python -m jobserver stats
+
+From Python:
+
+    client = JobClient()
+    for event in client.submit(path='scenarios/main.toml', steps=100, diagnostics=['t', 'max_speed']):
+        print(event)
+'''
+import argparse
+import asyncio
+import concurrent.futures
+import itertools
+import json
+import multiprocessing
+import os
+import signal
+import socket
+import sys
+import tempfile
+import time
+from concurrent.futures.process import BrokenProcessPool
+
+DIAGNOSTICS = ('t', 'dt', 'current_volume', 'suspended_volume', 'bed_volume', 'max_thickness', 'max_speed',
+               'wet_cells')  # Same as compiled.DIAGNOSTICS
+SUBMIT_OPTIONS = ('steps', 'until', 'engine', 'diagnostics', 'every', 'output')
+
+
+def default_socket():
+    return os.environ.get('HEXGRID_SOCKET', os.path.join(tempfile.gettempdir(), 'hexgrid-%d.sock' % os.getuid()))
+
+
+################################ Worker processes ################################
+
+_events = None  # Queue to the server, set in every worker by warm_up
+
+
+def warm_up(events, engines):
+    '''Initialises a worker process: imports the simulation modules (and compiles the compiled engine).'''
+    global _events
+    _events = events
+    import hexgrid  # noqa: F401
+    import runner  # noqa: F401
+    if 'compiled' in engines:
+        import compiled
+        compiled.kernel()
+
+
+def ping():
+    return os.getpid()
+
+
+def diagnose(grid, names, flow_eps=1e-6):
+    '''Returns the diagnostics of compiled.DIAGNOSTICS of a Hexgrid as a dict of floats.'''
+    import numpy as np
+    Q_th = grid.interior(grid.Q_th)
+    values = {
+        't': lambda: grid.t,
+        'dt': lambda: getattr(grid, 'dt', np.nan),
+        'current_volume': lambda: np.sum(Q_th) * grid.CellArea,
+        'suspended_volume': lambda: np.sum(Q_th[..., np.newaxis] * grid.interior(grid.Q_cj)) * grid.CellArea,
+        'bed_volume': lambda: np.sum(grid.interior(grid.Q_d)) * grid.CellArea,
+        'max_thickness': lambda: np.amax(Q_th, initial=0),
+        'max_speed': lambda: np.amax(grid.interior(grid.Q_v), initial=0),
+        'wet_cells': lambda: np.count_nonzero(Q_th > flow_eps),
+    }
+    return {name: float(values[name]()) for name in names}
+
+
+def run_batch(jobs):
+    '''
+    Runs jobs one after the other in a worker. Progress, results and errors are sent to the server as
+    ('progress', job, step, values), ('done', job, report) and ('error', job, message).
+
+    :param jobs: list of (job id, scenario, options)
+    :return: Number of time steps made
+    '''
+    import runner
+    total = 0
+    for job, scenario, options in jobs:
+        names = options.get('diagnostics') or ()
+        try:
+            grid, report = runner.run_scenario(
+                scenario, steps=options.get('steps'), until=options.get('until'),
+                engine=options.get('engine') or 'numpy', output=options.get('output'),
+                on_step=lambda grid, step: _events.put(('progress', job, step, diagnose(grid, names))),
+                on_step_every=options.get('every', 1) if names else 0)
+        except Exception as error:
+            _events.put(('error', job, '%s: %s' % (type(error).__name__, error)))
+            continue
+        total += report['steps']
+        _events.put(('done', job, report))
+    return total
+
+
+################################ Server ################################
+
+class Job():
+    def __init__(self, id, priority, scenario, options, writer):
+        self.id = id
+        self.priority = priority
+        self.scenario = scenario
+        self.options = options
+        self.writer = writer
+        self.state = 'queued'
+        self.submitted = time.monotonic()
+        self.cells = scenario.get('grid', {}).get('Nx', 0) * scenario.get('grid', {}).get('Ny', 0)
+
+
+class JobServer():
+    '''Runs scenario jobs from several clients on a warm pool of worker processes.'''
+
+    def __init__(self, path=None, workers=None, batch_cells=3600, batch_size=8, engines=('numpy',)):
+        '''
+        :param path: Unix socket to listen on. Defaults to $HEXGRID_SOCKET or a socket in the temporary directory.
+        :param workers: Number of worker processes. Defaults to the number of cores.
+        :param batch_cells: Jobs on grids with at most batch_cells cells are batched
+        :param batch_size: Maximum number of jobs in a batch
+        :param engines: Engines to prepare in the workers. 'compiled' compiles the compiled engine at start-up.
+        '''
+        self.path = path or default_socket()
+        self.workers = workers or os.cpu_count()
+        self.batch_cells = batch_cells
+        self.batch_size = batch_size
+        self.engines = tuple(engines)
+        self.jobs = {}
+        self.ids = itertools.count(1)
+        self.order = itertools.count()  # Keeps jobs with the same priority in submission order
+        self.stats = {'submitted': 0, 'completed': 0, 'failed': 0, 'cancelled': 0, 'batches': 0, 'steps': 0,
+                      'restarts': 0}
+        self.busy = 0
+        self.busy_seconds = 0.0
+        self.started = time.monotonic()
+
+    async def serve(self):
+        '''Starts the worker pool and serves until cancelled.'''
+        self.context = multiprocessing.get_context('spawn')
+        self.events = self.context.Queue()
+        self.pool = self.start_pool()
+        loop = asyncio.get_running_loop()
+        loop.add_signal_handler(signal.SIGTERM, asyncio.current_task().cancel)  # Shut the pool down cleanly
+        # Start and warm up all workers before accepting jobs
+        await asyncio.gather(*(loop.run_in_executor(self.pool, ping) for i in range(self.workers)))
+        self.queue = asyncio.PriorityQueue()
+        self.slots = asyncio.Semaphore(self.workers)
+        self.started = time.monotonic()
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        server = await asyncio.start_unix_server(self.handle, path=self.path)
+        tasks = [asyncio.create_task(self.dispatch()), asyncio.create_task(self.forward())]
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            for task in tasks:
+                task.cancel()
+            self.events.put(None)
+            self.pool.shutdown(cancel_futures=True)
+            if os.path.exists(self.path):
+                os.unlink(self.path)
+
+    def start_pool(self):
+        '''Starts a pool of worker processes. Each worker warms up when it starts (see warm_up).'''
+        return concurrent.futures.ProcessPoolExecutor(self.workers, mp_context=self.context, initializer=warm_up,
+                                                      initargs=(self.events, self.engines))
+
+    def restart_pool(self, broken):
+        '''Replaces a pool in which a worker died. The other workers of a broken pool have been stopped.'''
+        if broken is self.pool:  # Not replaced yet by another batch of the same pool
+            broken.shutdown(wait=False, cancel_futures=True)
+            self.pool = self.start_pool()
+            self.stats['restarts'] += 1
+
+    async def handle(self, reader, writer):
+        '''Serves one client connection.'''
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                try:
+                    request = json.loads(line)
+                    reply = self.request(request, writer)
+                except (ValueError, KeyError, TypeError, OSError) as error:
+                    reply = {'event': 'error', 'error': '%s: %s' % (type(error).__name__, error)}
+                await self.send(writer, reply)
+        finally:
+            for job in list(self.jobs.values()):  # Nobody is listening for the queued jobs of this client any more
+                if job.writer is writer and job.state == 'queued':
+                    self.cancel(job)
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except ConnectionError:
+                pass
+
+    def request(self, request, writer):
+        op = request.get('op')
+        if op == 'submit':
+            return self.submit(request, writer)
+        if op == 'cancel':
+            job = self.jobs.get(request['job'])
+            ok = job is not None and job.state == 'queued'
+            if ok:
+                self.cancel(job)
+            return {'event': 'cancelled', 'job': request['job'], 'ok': ok}
+        if op == 'stats':
+            return dict(event='stats', **self.statistics())
+        raise ValueError('Unknown op %r' % op)
+
+    def submit(self, request, writer):
+        import runner
+        scenario = request['scenario'] if 'scenario' in request else runner.load_scenario(request['path'])
+        options = {name: request[name] for name in SUBMIT_OPTIONS if request.get(name) is not None}
+        options['engine'] = options.get('engine', 'numpy')  # So that jobs with the default engine are batched together
+        if options['engine'] not in runner.ENGINES:
+            raise ValueError('Unknown engine %r' % options['engine'])
+        unknown = set(options.get('diagnostics', ())) - set(DIAGNOSTICS)
+        if unknown:
+            raise ValueError('Unknown diagnostics: %s' % ', '.join(sorted(unknown)))
+        job = Job(next(self.ids), request.get('priority', 0), scenario, options, writer)
+        self.jobs[job.id] = job
+        self.queue.put_nowait((-job.priority, next(self.order), job))
+        self.stats['submitted'] += 1
+        return {'event': 'queued', 'job': job.id}
+
+    def cancel(self, job):
+        '''Cancels a queued job. It stays in the queue, where dispatch skips it.'''
+        job.state = 'cancelled'
+        self.stats['cancelled'] += 1
+        del self.jobs[job.id]
+
+    async def send(self, writer, message):
+        '''Sends a message and waits until the client has taken up enough of what was sent before.'''
+        if writer.is_closing():
+            return
+        writer.write((json.dumps(message) + '\n').encode())
+        try:
+            await writer.drain()
+        except ConnectionError:  # The client went away. handle cancels its queued jobs.
+            pass
+
+    async def dispatch(self):
+        '''
+        Takes jobs from the queue by priority and hands them to free workers. Small jobs are batched when there\
+        are more jobs waiting than free workers, spread evenly over the free workers.
+        '''
+        loop = asyncio.get_running_loop()
+        while True:
+            await self.slots.acquire()
+            batch = [await self.next_job()]
+            free = self.workers - self.busy  # Including the worker of this batch
+            waiting = sum(job.state == 'queued' for job in self.jobs.values())
+            size = min(self.batch_size, -(-waiting // free))
+            if batch[0].cells <= self.batch_cells and size > 1:
+                skipped = []
+                while len(batch) < size and not self.queue.empty():
+                    item = self.queue.get_nowait()
+                    job = item[2]
+                    if job.state != 'queued':
+                        continue
+                    if job.cells <= self.batch_cells and job.options['engine'] == batch[0].options['engine']:
+                        batch.append(job)
+                    else:
+                        skipped.append(item)
+                for item in skipped:
+                    self.queue.put_nowait(item)
+            for job in batch:
+                job.state = 'running'
+            self.busy += 1
+            self.stats['batches'] += 1
+            jobs = [(job.id, job.scenario, job.options) for job in batch]
+            try:
+                future = loop.run_in_executor(self.pool, run_batch, jobs)
+            except BrokenProcessPool:  # A worker died before the batch that used it has finished
+                self.restart_pool(self.pool)
+                future = loop.run_in_executor(self.pool, run_batch, jobs)
+            future.add_done_callback(lambda future, batch=batch, start=time.monotonic(), pool=self.pool:
+                                     self.finished(future, batch, start, pool))
+
+    async def next_job(self):
+        while True:
+            job = (await self.queue.get())[2]
+            if job.state == 'queued':
+                return job
+
+    def finished(self, future, batch, start, pool):
+        self.busy -= 1
+        self.busy_seconds += time.monotonic() - start
+        self.slots.release()
+        if future.cancelled():
+            return
+        if future.exception() is not None:  # The worker died. Jobs that did not report are failed.
+            for job in batch:
+                if job.state == 'running':
+                    asyncio.ensure_future(self.event(('error', job.id, 'Worker failed: %s' % future.exception())))
+            if isinstance(future.exception(), BrokenProcessPool):
+                self.restart_pool(pool)
+        else:
+            self.stats['steps'] += future.result()
+
+    async def forward(self):
+        '''Forwards the events from the workers to the clients.'''
+        loop = asyncio.get_running_loop()
+        with concurrent.futures.ThreadPoolExecutor(1) as reader:
+            while True:
+                event = await loop.run_in_executor(reader, self.events.get)
+                if event is None:
+                    return
+                await self.event(event)
+
+    async def event(self, event):
+        kind, id = event[:2]
+        job = self.jobs.get(id)
+        if job is None:
+            return
+        if kind == 'progress':
+            await self.send(job.writer, {'event': 'progress', 'job': id, 'step': event[2], 'values': event[3]})
+            return
+        del self.jobs[id]  # Before sending, so that a job is only finished once
+        if kind == 'done':
+            job.state = 'done'
+            self.stats['completed'] += 1
+            await self.send(job.writer, {'event': 'done', 'job': id, 'report': event[2]})
+        else:
+            job.state = 'failed'
+            self.stats['failed'] += 1
+            await self.send(job.writer, {'event': 'error', 'job': id, 'error': event[2]})
+
+    def statistics(self):
+        '''Occupancy and throughput of the pool since the server started.'''
+        uptime = time.monotonic() - self.started
+        queued = sum(job.state == 'queued' for job in self.jobs.values())
+        running = sum(job.state == 'running' for job in self.jobs.values())
+        return dict(self.stats, workers=self.workers, busy=self.busy, queued=queued, running=running,
+                    uptime=uptime, occupancy=self.busy_seconds / (self.workers * uptime) if uptime > 0 else 0.0,
+                    jobs_per_second=self.stats['completed'] / uptime if uptime > 0 else 0.0,
+                    steps_per_second=self.stats['steps'] / uptime if uptime > 0 else 0.0)
+
+
+################################ Client ################################
+
+class JobClient():
+    '''Blocking client for the job server. Usable from scripts and notebooks.'''
+
+    def __init__(self, path=None):
+        self.path = path or default_socket()
+
+    def request(self, message):
+        '''Sends a request and yields the events sent back, until the request is finished.'''
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection:
+            connection.connect(self.path)
+            connection.sendall((json.dumps(message) + '\n').encode())
+            with connection.makefile() as replies:
+                for line in replies:
+                    event = json.loads(line)
+                    yield event
+                    if event['event'] != 'queued' and event['event'] != 'progress':
+                        return
+
+    def submit(self, scenario=None, path=None, priority=0, **options):
+        '''
+        Submits a job and yields its events: queued, progress (if diagnostics are requested), then done or error.
+
+        :param scenario: Scenario dict (see runner.load_scenario), or
+        :param path: Path of a scenario file, read by the server
+        :param priority: Jobs with a higher priority run first
+        :param options: steps, until, engine, diagnostics, every, output
+        '''
+        message = dict(op='submit', priority=priority, **options)
+        if scenario is not None:
+            message['scenario'] = scenario
+        else:
+            message['path'] = os.path.abspath(path)
+        return self.request(message)
+
+    def stats(self):
+        return next(self.request({'op': 'stats'}))
+
+    def cancel(self, job):
+        return next(self.request({'op': 'cancel', 'job': job}))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m jobserver', description='Local simulation job server.')
+    parser.add_argument('--socket', help='Unix socket of the server')
+    commands = parser.add_subparsers(dest='command', required=True)
+    serve = commands.add_parser('serve', help='Run the server')
+    serve.add_argument('--workers', type=int, help='Number of worker processes')
+    serve.add_argument('--warm-compiled', action='store_true', help='Compile the compiled engine in the workers')
+    submit = commands.add_parser('submit', help='Submit a scenario and print its events')
+    submit.add_argument('scenario', help='Scenario file (.toml or .json)')
+    submit.add_argument('--steps', type=int)
+    submit.add_argument('--until', type=float)
+    submit.add_argument('--engine')
+    submit.add_argument('--priority', type=int, default=0)
+    submit.add_argument('--diagnostics', nargs='+', choices=DIAGNOSTICS)
+    submit.add_argument('--every', type=int, default=1)
+    submit.add_argument('--output', metavar='DIR')
+    commands.add_parser('stats', help='Print occupancy and throughput')
+    args = parser.parse_args(argv)
+
+    if args.command == 'serve':
+        engines = ('numpy', 'compiled') if args.warm_compiled else ('numpy',)
+        server = JobServer(args.socket, args.workers, engines=engines)
+        try:
+            asyncio.run(server.serve())
+        except (KeyboardInterrupt, asyncio.CancelledError):
+            pass
+        return 0
+    client = JobClient(args.socket)
+    if args.command == 'stats':
+        print(json.dumps(client.stats()))
+        return 0
+    status = 0
+    for event in client.submit(path=args.scenario, priority=args.priority, steps=args.steps, until=args.until,
+                               engine=args.engine, diagnostics=args.diagnostics, every=args.every,
+                               output=args.output):
+        print(json.dumps(event), flush=True)
+        status = 1 if event['event'] == 'error' else status
+    return status
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -38,7 +38,7 @@ def calc_g_prime(Nj, Q_cj, rho_j, rho_a, g = 9.81):
     sum = 0
     try:
         for j in range(Nj):
-            sum += Q_cj[:,:,j]*(rho_j[j]-rho_a)/rho_a
+            sum += Q_cj[...,j]*(rho_j[j]-rho_a)/rho_a
         return g*sum
     except:
         print("Error: Could not calculate reduced gravity!")
@@ -69,13 +69,12 @@ def average_speed_hexagon(U_k): # Testet: 18.10.18
 
     '''
 #     print( U_k[0,:,0].size )
-    Ny= Nx = U_k[0,:,0].size
-    v = np.zeros((Ny,Nx,3))
-    v[:,:,0] = U_k[:,:,0] - U_k[:,:,3]
-    v[:,:,1] = U_k[:,:,1] - U_k[:,:,4]
-    v[:,:,2] = U_k[:,:,2] - U_k[:,:,5]
+    v = np.zeros(U_k.shape[:-1] + (3,))
+    v[...,0] = U_k[...,0] - U_k[...,3]
+    v[...,1] = U_k[...,1] - U_k[...,4]
+    v[...,2] = U_k[...,2] - U_k[...,5]
 
-    return np.sqrt( (0.5*(v[:,:,1]-v[:,:,0])+v[:,:,2])**2 + 3/4*(v[:,:,1]+v[:,:,0])**2 )
+    return np.sqrt( (0.5*(v[...,1]-v[...,0])+v[...,2])**2 + 3/4*(v[...,1]+v[...,0])**2 )
         
 def calc_rho_c(Nj, Q_cj, rho_j, rho_a): # out: current density rho_c matrix (all cells)
     '''
@@ -118,8 +117,8 @@ def calc_rho_c(Nj, Q_cj, rho_j, rho_a): # out: current density rho_c matrix (all
     '''
     sum = 0
     for j in range(Nj):
-        sum += rho_j[j]*Q_cj[:,:,j]
-    return rho_a*(1-np.sum(Q_cj,axis=2))+sum
+        sum += rho_j[j]*Q_cj[...,j]
+    return rho_a*(1-np.sum(Q_cj,axis=-1))+sum
 
 def calc_potEnergy(Q_th, g_prime, rho_c, A): # out: 
     '''
@@ -142,6 +141,35 @@ def calc_potEnergy(Q_th, g_prime, rho_c, A): # out:
     '''
     return rho_c*g_prime*A/2*(Q_th)**2
 
+def calc_settling_speed(D_sj, rho_a, rho_j, g, nu):
+    '''
+    This function calculates the settling (fall) velocity of the sediment\
+    particles using the formula of Ferguson & Church (2004). For fine grains\
+    it reduces to Stokes' law.
+
+    :type D_sj: numpy.ndarray(Nj)
+    :param D_sj: Sediment-particle diameters. Unit = m
+
+    :type rho_a: float
+    :param rho_a: Density of ambient fluid. Unit = kg/m^3
+
+    :type rho_j: numpy.ndarray(Nj)
+    :param rho_j: Density of sediment type no j. Unit = kg/m^3
+
+    :type g: float
+    :param g: Gravitational acceleration. Unit = m/s^2
+
+    :type nu: float
+    :param nu: Kinematic viscosity of ambient fluid. Unit = m^2/s
+
+    :rtype: numpy.ndarray(Nj)
+    :return: Settling velocity of sediment type no j. Unit = m/s
+    '''
+    C1 = 18  # Stokes' law constant
+    C2 = 1  # Asymptotic drag coefficient for natural grains
+    R = (rho_j - rho_a) / rho_a  # Submerged specific gravity
+    return R * g * D_sj ** 2 / (C1 * nu + np.sqrt(0.75 * C2 * R * g * D_sj ** 3))
+
 def calc_hexagon_area(apothem):
     return 2*np.sqrt(3)*(apothem/2)**2 # Area of hexagon = 2sqrt(3)*apothem
 
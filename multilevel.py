@@ -0,0 +1,174 @@
+'''
+Coarse-to-fine warm start.
+
+The first phase of a run, in which the toppling rule relaxes the bathymetry and the current starts to
+spread, takes many steps on a fine grid. warm_start runs it on a coarsened copy of the grid instead,
+with spacing dx * ratio, in which every coarse cell is the parent of ratio x ratio fine cells (see
+refinement.py). The fine substates are restricted onto the coarse grid, the coarse grid is run, and
+Q_th, Q_v, Q_cj, Q_cbj and Q_d are prolonged back onto the fine grid, which then continues at full
+resolution. Both transfers are conservative: the current volume (Q_th), the suspended sediment
+(Q_th * Q_cj) and the soft sediment (Q_d, Q_d * Q_cbj) of every coarse cell are those of its children.
+The hard bed (Q_a - Q_d) of the fine grid is kept, so its detail is not lost.
+
+compare_warm_start runs a warm-started grid and a fine-only fork of it to the same time and reports how
+far they differ.
+
+Use:
+
+    report = warm_start(grid, ratio=2, until=30)
+    grid.run(until=600)
+
+    print(compare_warm_start(grid, ratio=2, until=30, total=100))
+'''
+import numpy as np
+
+from hexgrid import Hexgrid
+from refinement import CONSTANTS, prolong, restrict
+
+SUBSTATES = ('Q_th', 'Q_v', 'Q_cj', 'Q_cbj', 'Q_d')  # Substates handed from the coarse to the fine grid
+LINEAR = ('Q_th', 'Q_d')  # Prolonged with a limited linear reconstruction, the others piecewise constant
+
+
+def coarse_shape(grid, ratio):
+    '''
+    :return: (Ny, Nx) of the grid coarsened by ratio, including the border
+    :raises ValueError: If the interior of the grid can not be split into ratio x ratio blocks
+    '''
+    if (grid.Ny - 2) % ratio or (grid.Nx - 2) % ratio:
+        raise ValueError('The interior of the grid (%d x %d cells) is not divisible by the ratio %d'
+                         % (grid.Ny - 2, grid.Nx - 2, ratio))
+    return (grid.Ny - 2) // ratio + 2, (grid.Nx - 2) // ratio + 2
+
+
+def bordered(interior, border):
+    '''Pads the interior cells of a substate with a one-cell border of the value border.'''
+    full = np.full((interior.shape[0] + 2, interior.shape[1] + 2) + interior.shape[2:], border, dtype=float)
+    full[1:-1, 1:-1] = interior
+    return full
+
+
+def coarsen(grid, ratio):
+    '''
+    Creates a coarse Hexgrid with spacing grid.dx * ratio from the restriction of a grid.
+
+    :param grid: Fine Hexgrid
+    :param ratio: Coarsening ratio. The interior of the grid has to be divisible by it.
+    :return: Hexgrid
+    '''
+    Ny, Nx = coarse_shape(grid, ratio)
+    inner = np.s_[1:-1, 1:-1]
+    th = grid.Q_th[inner]
+    d = grid.Q_d[inner]
+    Q_th = bordered(restrict(th, ratio), 0)
+    Q_v = bordered(restrict(grid.Q_v[inner], ratio, weights=th), 0)
+    Q_cj = bordered(restrict(grid.Q_cj[inner], ratio, weights=th), 0)
+    Q_cbj = bordered(restrict(grid.Q_cbj[inner], ratio, weights=d), 0)
+    Q_d = bordered(restrict(d, ratio), np.inf)
+    coarse = Hexgrid(Nx, Ny, ICstates=[Q_th, Q_v, Q_cj, Q_cbj, Q_d, np.zeros((Ny, Nx, 6))],
+                     reposeAngle=grid.reposeAngle, dx=grid.dx * ratio, layout=grid.layout)
+    for name in CONSTANTS:
+        setattr(coarse, name, getattr(grid, name))
+    coarse.classThreads = grid.classThreads
+    coarse.Q_a = bordered(restrict(grid.Q_a[inner], ratio), np.inf)
+    coarse.calc_bathymetryDiff()
+    coarse.t = grid.t
+    return coarse
+
+
+def prolong_onto(coarse, grid, ratio, linear=True):
+    '''
+    Overwrites Q_th, Q_v, Q_cj, Q_cbj and Q_d of a fine grid with the prolongation of a coarse grid\
+    created by coarsen, and sets its time to that of the coarse grid. Q_a follows the change of Q_d.
+
+    :param coarse: Coarse Hexgrid
+    :param grid: Fine Hexgrid
+    :param ratio: Coarsening ratio used for coarse
+    :param linear: Use a limited linear reconstruction for Q_th and Q_d (see refinement.prolong)
+    '''
+    inner = np.s_[1:-1, 1:-1]
+    bed = grid.Q_a[inner] - grid.Q_d[inner]  # Hard bed, which the coarse grid does not change
+    for name in SUBSTATES:
+        values = getattr(grid, name)
+        values[inner] = prolong(getattr(coarse, name), ratio, linear and name in LINEAR)
+    grid.Q_v[grid.Q_th <= 0] = 0  # No speed without a current (as in Hexgrid)
+    grid.Q_a[inner] = bed + grid.Q_d[inner]
+    grid.calc_bathymetryDiff()
+    grid.t = coarse.t
+
+
+def warm_start(grid, ratio=2, until=None, max_steps=None, linear=True, **kwargs):
+    '''
+    Advances a grid by running the first phase on a coarsened copy of it (see coarsen) and prolonging\
+    the result back onto it.
+
+    :param grid: Fine Hexgrid. Its substates and time are updated in place.
+    :param ratio: Coarsening ratio
+    :param until: Simulated time at which the coarse phase stops
+    :param max_steps: Maximum number of coarse time steps
+    :param linear: See prolong_onto
+    :param kwargs: Other arguments of Hexgrid.run for the coarse phase
+    :return: The report of the coarse run (see Hexgrid.run)
+    '''
+    coarse = coarsen(grid, ratio)
+    report = coarse.run(max_steps=max_steps, until=until, **kwargs)
+    prolong_onto(coarse, grid, ratio, linear)
+    return report
+
+
+def totals(grid):
+    '''
+    :return: dict of the current volume, suspended sediment and soft sediment in the interior of a grid,\
+    per unit cell area
+    '''
+    inner = np.s_[1:-1, 1:-1]
+    area = grid.dx ** 2
+    return {'current': float(grid.Q_th[inner].sum() * area),
+            'suspended': float((grid.Q_th[inner][..., np.newaxis] * grid.Q_cj[inner]).sum() * area),
+            'bed': float(grid.Q_d[inner].sum() * area)}
+
+
+def difference(grid, reference, fields=SUBSTATES):
+    '''
+    Compares the interior cells of two grids of the same shape.
+
+    :param grid: Hexgrid
+    :param reference: Hexgrid
+    :param fields: Substates to compare
+    :return: dict with, for every field, the maximum and root mean square absolute difference and the\
+    difference relative to the root mean square of the reference, and the totals of both grids (see totals)
+    '''
+    report = {}
+    for name in fields:
+        a = getattr(grid, name)[1:-1, 1:-1]
+        b = getattr(reference, name)[1:-1, 1:-1]
+        rms = float(np.sqrt(np.mean((a - b) ** 2)))
+        scale = float(np.sqrt(np.mean(b ** 2)))
+        report[name] = {'max': float(np.amax(np.abs(a - b))), 'rms': rms,
+                        'relative': rms / scale if scale > 0 else rms}
+    report['totals'] = {'grid': totals(grid), 'reference': totals(reference)}
+    return report
+
+
+def compare_warm_start(grid, ratio=2, until=None, total=None, max_steps=None, **kwargs):
+    '''
+    Runs a fork of a grid fine-only to the time total, and another fork with a warm start up to the time\
+    until, then fine to the time total, and reports how far they differ. The grid itself is not changed.
+
+    :param grid: Fine Hexgrid in its initial state
+    :param ratio: Coarsening ratio
+    :param until: Simulated time at which the coarse phase stops
+    :param total: Simulated time at which both runs stop
+    :param max_steps: Maximum number of steps of each phase
+    :param kwargs: Other arguments of Hexgrid.run
+    :return: dict of difference (see difference), the simulated times 't' and 't_reference', and the\
+    reports of the runs 'coarse', 'fine' and 'reference'
+    '''
+    reference = grid.fork()
+    warm = grid.fork()
+    report = {'coarse': warm_start(warm, ratio, until=until, max_steps=max_steps, **kwargs)}
+    report['fine'] = warm.run(max_steps=max_steps, until=total, **kwargs)
+    report['reference'] = reference.run(max_steps=max_steps, until=total, **kwargs)
+    report.update(difference(warm, reference))
+    report['t'] = float(warm.t)
+    report['t_reference'] = float(reference.t)
+    return report
@@ -0,0 +1,268 @@
+'''
+Multirate time stepping.
+
+Hexgrid.calc_dt takes the smallest relaxation time of all cells, so one fast, thick cell near the source
+sets the time step of the whole basin. MultirateHexgrid groups the cells into rate levels instead: a cell
+of level l advances with the time step dt0 * 2**l, where dt0 is the time step of Hexgrid. l is the largest
+level with which the time step of the cell is at most half its relaxation time (the criterion of calc_dt)
+and the cell sends at most MAX_OUTFLOW of its current to its neighbors in I_1. The outflows are proportional
+to the time step, so the second condition is found from I_1 with dt0 at the start of every macro step.
+Cells without a current get the top level. Levels of neighbors differ by at most one.
+
+A macro step of length dt0 * 2**L, with L the highest level in use, is made of 2**L substeps of length dt0.
+In substep k the cells of the levels l with k % 2**l == 0 start a step of length dt0 * 2**l, and are the
+only ones for which the rules are evaluated. The other cells have a time step of 0: they send no outflow,
+and entrainment, erosion and deposition leave them as they are, but they receive the outflows of their
+neighbors in I_2 within the same substep. So every flux leaves one cell and enters the other at once, and
+current and sediment are conserved across the interfaces between the levels. Q_v of the cells that do
+not start a step is kept. I_3 finds the speed from the outflows, which grow with the time step, so the
+speed of a cell is scaled by sqrt(dt0 / dt) to the speed Hexgrid would find with dt0. A cell whose
+relaxation time has dropped below twice its time step when it starts a step, e.g. because it received a
+thick current, is moved down to a lower level. After the first substep dt0 may itself be too long for the
+fastest cells: these take a step of half their relaxation time instead, as Hexgrid would, and from then on
+the outflows of every cell are limited to MAX_OUTFLOW of its current.
+
+The rules of a substep are evaluated on a window of the grid around the cells that start a step, with
+their neighbors as the only other cells and walls around them. The toppling rule I_4 has no time step and
+keeps state between calls, so it is applied to the whole grid in every substep, as Hexgrid does in every
+step; it only tests the cells whose bed changed. Every cell starts a step in substep 0, so every cell is
+updated at least once per macro step. Away from the source most cells are updated 2**L times less often
+than with Hexgrid.
+
+A macro step is never longer than dt_max, nor does it go beyond the time until given to run: fewer levels
+are used, and dt0 is shortened if needed. Hexgrid switches to the bed-only mode once calc_dt is not finite
+(no cell has a current that moves), so the macro step is ended after the substep in which that happens.
+
+A macro step is as long as the slow levels allow, however short the steps of the fast cells are. Once the
+cells of the levels above 0 hold less than SLOW_LOAD of the peak suspended load, the flow is dying out and
+the macro step is a single step of dt0, as in Hexgrid; otherwise one macro step of 8 * dt0 with a thin,
+nearly deposited current can jump the time by thousands of seconds.
+
+With levels=1 the results are those of Hexgrid. With more levels they are not: the cells that do not start
+a step keep their speed, and cells take fewer, longer steps, so the flow spreads and dies out differently.
+In scenarios/main.toml with levels=4 the suspended load falls to 1e-3 of its peak at t = 31 rather than 22,
+and is used up at t = 43 rather than 34 (verification.accuracy checks this against MULTIRATE_BOUND); at
+40x40 at t = 19 rather than 17 and t = 31 rather than 33. The current on the 'river' terrain may not get
+going at all, which is also what Hexgrid does with a shorter time step. In both, the time at which run
+stops means little: with the load used up, calc_dt follows residues of rounding in Q_cj.
+
+Use:
+
+    multirate = MultirateHexgrid(grid, levels=4)
+    multirate.run(until=600)
+    multirate.cellUpdates  # Cell updates made, against grid.Ny * grid.Nx per step of Hexgrid
+'''
+import numpy as np
+
+from hexgrid import Hexgrid
+from refinement import CONSTANTS
+
+SUBSTATES = ('Q_th', 'Q_v', 'Q_cj', 'Q_cbj', 'Q_d', 'Q_a', 'Q_o')
+MAX_OUTFLOW = 0.5  # Largest fraction of its current a cell may send in one step
+SLOW_LOAD = 1e-3  # Fraction of the peak suspended load below which the slow levels are not used
+
+
+def rate_levels(dtMax, dt0, levels, neighbors):
+    '''
+    Assigns every cell the largest level l < levels with dt0 * 2**l <= dtMax, where the levels of neighbors\
+    differ by at most one.
+
+    :param dtMax: numpy.ndarray(Ny,Nx) of the largest time step of every cell. Cells where it is not finite\
+    and positive get the top level.
+    :param dt0: Base time step
+    :param levels: Number of levels
+    :param neighbors: Hexgrid.NEIGHBOR of the grid
+    :return: numpy.ndarray(Ny,Nx) of int. The border gets the top level.
+    '''
+    with np.errstate(divide='ignore', invalid='ignore'):
+        level = np.floor(np.log2(dtMax / dt0))
+    level[~(np.isfinite(level))] = levels - 1
+    level = np.clip(level, 0, levels - 1).astype(int)
+    level[[0, -1], :] = level[:, [0, -1]] = levels - 1
+    for n in range(levels - 1):
+        lowest = np.minimum.reduce([level[nb] for nb in neighbors]) + 1
+        if not (lowest < level[1:-1, 1:-1]).any():
+            break
+        np.minimum(level[1:-1, 1:-1], lowest, out=level[1:-1, 1:-1])
+    return level
+
+
+def bounds(mask, margin, shape):
+    '''
+    :return: (r0, r1, c0, c1), the bounding box of the True cells of a (Ny-2,Nx-2) mask of interior cells,\
+    grown by margin cells and clipped to a grid of the given shape, in indices of the full grid
+    '''
+    rows = np.flatnonzero(mask.any(axis=1)) + 1
+    cols = np.flatnonzero(mask.any(axis=0)) + 1
+    return (max(rows[0] - margin, 0), min(rows[-1] + margin + 1, shape[0]),
+            max(cols[0] - margin, 0), min(cols[-1] + margin + 1, shape[1]))
+
+
+class MultirateHexgrid():
+    '''Runs a Hexgrid with a time step per rate level of the cells.'''
+
+    def __init__(self, grid, levels=4, window=0.5):
+        '''
+        :param grid: Hexgrid. Its substates and time are updated in place.
+        :param levels: Number of rate levels. levels=1 is the time stepping of Hexgrid.
+        :param window: Substeps whose cells cover less than this fraction of the grid are evaluated on a\
+        window around the cells, the others on the whole grid
+        '''
+        self.grid = grid
+        self.levels = levels
+        self.window = window
+        self.level = None  # Level of every cell in the current macro step
+        self.steps = 0
+        self.substeps = 0
+        self.cellUpdates = 0  # Number of times a cell started a step
+        self.limited = 0  # Number of times the outflows of a cell were limited to MAX_OUTFLOW
+        self.until = None  # Time the macro steps may not go beyond (see run)
+        self.peakLoad = 0.0  # Largest suspended load of the grid at the start of a macro step
+
+    def __getattr__(self, name):
+        # Substates, time and time step are those of the grid
+        return getattr(self.__dict__['grid'], name)
+
+    def run(self, max_steps=None, until=None, **kwargs):
+        '''Hexgrid.run. Macro steps are shortened so that they do not go beyond until.'''
+        self.until = until
+        try:
+            return Hexgrid.run(self, max_steps=max_steps, until=until, **kwargs)
+        finally:
+            self.until = None
+
+    notify = Hexgrid.notify  # Observers are those of the grid
+    is_flow_extinct = Hexgrid.is_flow_extinct
+    interior = Hexgrid.interior
+
+    def time_step(self):
+        '''Advances the grid by one macro step. grid.dt is set to the length of the macro step.'''
+        grid = self.grid
+        dt0 = grid.calc_dt()
+        if not np.isfinite(dt0):
+            grid.dt = dt0
+            self.step_bed()
+            return
+        # A macro step of 2**(levels - 1) substeps may not be longer than dt_max or reach beyond until
+        horizon = grid.dt_max if self.until is None else min(grid.dt_max, self.until - grid.t)
+        levels = self.levels
+        while levels > 1 and dt0 * 2 ** (levels - 1) > horizon:
+            levels -= 1
+        dt0 = min(dt0, horizon)
+        grid.dt = dt0
+        grid.I_1()  # Outflows for dt0. I_1 is evaluated again before they are used.
+        with np.errstate(all='ignore'):
+            outflow = np.sum(grid.Q_o, axis=2) / grid.Q_th  # Fraction of the current sent with dt0
+            dtMax = np.fmin(grid.calc_MaxRelaxationTime() / 2, MAX_OUTFLOW * dt0 / outflow)
+            level = rate_levels(dtMax, dt0, levels, grid.NEIGHBOR)
+        # Once the slow levels hold almost no current they would only stretch the macro step: it is a
+        # single step of dt0, as in Hexgrid
+        load = np.sum(grid.Q_th[1:-1, 1:-1, np.newaxis] * grid.Q_cj[1:-1, 1:-1], axis=2)
+        self.peakLoad = max(self.peakLoad, float(load.sum()))
+        if load[level[1:-1, 1:-1] > 0].sum() <= SLOW_LOAD * self.peakLoad:
+            level[...] = 0
+        top = int(level[1:-1, 1:-1].max()) if level.size else 0
+        substeps = 0
+        for k in range(2 ** top):
+            # Hexgrid switches to the bed once no cell has a current that moves (calc_dt is not finite).
+            # The macro step ends there too, rather than carrying the kept Q_v of the slow cells on.
+            if k > 0 and not np.isfinite(grid.calc_dt()):
+                break
+            starting = (k % (2 ** level[1:-1, 1:-1])) == 0
+            self.substep(level, starting, dt0, limit=k > 0)
+            grid.t += dt0
+            substeps += 1
+        self.level = level
+        grid.dt = dt0 * substeps
+        self.steps += 1
+        grid.stepCount += 1
+        self.notify()
+
+    def step_bed(self):
+        self.grid.step_bed()  # Notifies the observers
+
+    def substep(self, level, starting, dt0, limit=True):
+        '''
+        Evaluates the rules for the cells that start a step.
+
+        :param level: numpy.ndarray(Ny,Nx) of levels. Levels of cells that are moved down are updated.
+        :param starting: numpy.ndarray(Ny-2,Nx-2) of bool, True for the cells that start a step
+        :param dt0: Base time step
+        :param limit: Limit the outflows to MAX_OUTFLOW of the current (see limit)
+        '''
+        grid = self.grid
+        if not starting.any():
+            return
+        r0, r1, c0, c1 = bounds(starting, 2, (grid.Ny, grid.Nx))
+        if (r1 - r0) * (c1 - c0) >= self.window * grid.Ny * grid.Nx:
+            part, inner = grid, np.s_[1:-1, 1:-1]
+        else:
+            part, inner = self.part(r0, r1, c0, c1), np.s_[r0 + 1:r1 - 1, c0 + 1:c1 - 1]
+        start = np.zeros((part.Ny, part.Nx), dtype=bool)
+        start[1:-1, 1:-1] = starting[r0:r1 - 2, c0:c1 - 2] if part is not grid else starting
+        partLevel = level[1:-1, 1:-1][r0:r1 - 2, c0:c1 - 2] if part is not grid else level[1:-1, 1:-1]
+
+        dt = np.zeros((part.Ny, part.Nx))
+        with np.errstate(all='ignore'):
+            tau = part.calc_MaxRelaxationTime()[1:-1, 1:-1]
+            dtStart = dt0 * 2.0 ** partLevel
+            # Cells whose current has become too fast for their level move down
+            slow = start[1:-1, 1:-1] & np.isfinite(tau) & (tau > 0) & (dtStart > tau / 2)
+            if slow.any():
+                partLevel[slow] = np.clip(np.floor(np.log2(tau[slow] / (2 * dt0))), 0, None).astype(int)
+                # Cells too fast even for dt0 take the step Hexgrid would give them
+                dtStart = np.where(slow, np.minimum(dt0 * 2.0 ** partLevel, tau / 2), dt0 * 2.0 ** partLevel)
+        dt[1:-1, 1:-1] = np.where(start[1:-1, 1:-1], dtStart, 0)
+        part.dt = dt
+        self.substeps += 1
+        self.cellUpdates += int(starting.sum())
+
+        Q_v = part.Q_v.copy()
+        part.T_1()
+        part.T_2()
+        part.I_1()
+        if limit:
+            self.limit(part)
+        part.I_2()
+        part.I_3()
+        with np.errstate(all='ignore'):
+            part.Q_v[1:-1, 1:-1][start[1:-1, 1:-1]] *= np.sqrt(np.minimum(dt0 / dtStart, 1)[start[1:-1, 1:-1]])
+        part.Q_v[~start] = Q_v[~start]
+        if part is not grid:
+            for name in SUBSTATES:
+                getattr(grid, name)[inner] = getattr(part, name)[1:-1, 1:-1]
+        grid.I_4()
+
+    def limit(self, part):
+        '''Scales down the outflows of cells that send more than MAX_OUTFLOW of their current.'''
+        with np.errstate(all='ignore'):
+            outflow = np.sum(part.Q_o[1:-1, 1:-1], axis=2)
+            allowed = MAX_OUTFLOW * part.Q_th[1:-1, 1:-1]
+            over = outflow > allowed
+        if over.any():
+            part.Q_o[1:-1, 1:-1][over] *= (allowed[over] / outflow[over])[:, np.newaxis]
+            self.limited += int(over.sum())
+
+    def part(self, r0, r1, c0, c1):
+        '''
+        A Hexgrid holding the cells [r0:r1, c0:c1] of the grid, whose outermost cells are made walls\
+        (as the border of Hexgrid).
+        '''
+        grid = self.grid
+        window = np.s_[r0:r1, c0:c1]
+        states = {name: getattr(grid, name)[window].copy() for name in SUBSTATES}
+        for name in SUBSTATES:
+            edge = states[name]
+            value = np.inf if name in ('Q_d', 'Q_a') else 0
+            edge[[0, -1]] = value
+            edge[:, [0, -1]] = value
+        part = Hexgrid(c1 - c0, r1 - r0, ICstates=[states['Q_th'], states['Q_v'], states['Q_cj'], states['Q_cbj'],
+                                                   states['Q_d'], states['Q_o']],
+                       reposeAngle=grid.reposeAngle, dx=grid.dx, layout=grid.layout)
+        for name in CONSTANTS:
+            setattr(part, name, getattr(grid, name))
+        part.classThreads = grid.classThreads
+        part.Q_a = states['Q_a']
+        part.calc_bathymetryDiff()
+        part.t = grid.t
+        return part
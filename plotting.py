@@ -0,0 +1,70 @@
+'''
+Plotting helpers for Hexgrid. Kept separate from hexgrid.py so that the simulation core does not
+import matplotlib.
+'''
+import matplotlib.pyplot as plt
+import numpy as np
+
+plt.style.use('bmh')
+
+
+def plot_substate(grid, name='Q_a', j=0, ax=None, title=None):
+    '''
+    Scatter plot of a substate on the hexagonal grid.
+
+    :param grid: Hexgrid
+    :param name: Name of the substate, e.g. 'Q_a', 'Q_th' or 'Q_cj'
+    :param j: Sediment type to plot for substates with one value per sediment type
+    :param ax: Axes to plot in. A new figure is created if None.
+    :param title: Title of the plot. Defaults to the substate name.
+    :return: The axes
+    '''
+    values = getattr(grid, name)
+    if values.ndim == 3:
+        values = values[:, :, j]
+    if ax is None:
+        fig = plt.figure(figsize=(9, 9))
+        ax = fig.add_subplot(111, aspect='equal')
+    points = ax.scatter(grid.X[:, :, 0].flatten(), grid.X[:, :, 1].flatten(), marker='h',
+                        c=np.where(np.isfinite(values), values, np.nan).flatten())
+    ax.figure.colorbar(points, ax=ax, fraction=0.026)
+    ax.set_title(title or name)
+    return ax
+
+
+def plot_pyramid(pyramid, name='Q_th', n=-1, window=None, max_cells=250000, j=0, ax=None, title=None):
+    '''
+    Scatter plot of a window of a frame stored as a pyramid (see pyramid.py), on the finest level that has\
+    at most max_cells cells in the window, so that only that level of the window is read from disk.
+
+    :param pyramid: pyramid.PyramidReader
+    :param name: Name of the substate
+    :param n: Frame number
+    :param window: (r0, r1, c0, c1): rows r0:r1 and columns c0:c1 of the interior cells. None plots all.
+    :param max_cells: Largest number of cells to plot
+    :param j: Sediment type to plot for substates with one value per sediment type
+    :param ax: Axes to plot in. A new figure is created if None.
+    :param title: Title of the plot. Defaults to the substate name and level.
+    :return: The axes
+    '''
+    level = pyramid.finest_level(window, max_cells)
+    box = pyramid.window_on(window, level) if window is not None else None
+    values = pyramid.read(name, n, level, box)
+    if values.ndim == 3:
+        values = values[:, :, j]
+    X = pyramid.centers(level, box)
+    if ax is None:
+        fig = plt.figure(figsize=(9, 9))
+        ax = fig.add_subplot(111, aspect='equal')
+    points = ax.scatter(X[:, :, 0].flatten(), X[:, :, 1].flatten(), marker='h', s=20 * pyramid.ratio ** level,
+                        c=np.where(np.isfinite(values), values, np.nan).flatten())
+    ax.figure.colorbar(points, ax=ax, fraction=0.026)
+    ax.set_title(title or '%s (level %d)' % (name, level))
+    return ax
+
+
+def plotCA(grid):
+    '''Plots the terrain of a grid.'''
+    ax = plot_substate(grid, 'Q_a', title='Terrain(x,y)')
+    plt.ion()
+    return ax
@@ -0,0 +1,181 @@
+'''
+Virtual gauges and transects.
+
+Probes samples substates at a fixed set of points given in world coordinates (the convention of
+Hexgrid.X). The cell centers form a triangular lattice, so every point lies in a triangle of three
+neighboring cells, and its value is interpolated with the barycentric weights of that triangle. The
+cells and weights are computed once. Every sample then only reads 3 cells per point and substate into
+preallocated ring buffers. When a buffer is full it is handed to on_flush in one piece (e.g.
+ChunkWriter), or, without on_flush, the oldest samples are overwritten.
+
+Use:
+
+    points = np.concatenate((gauges, transect((0, -5), (40, -5), 100)))
+    probes = Probes(grid, points, on_flush=ChunkWriter('out/probes'))
+    probes.attach(grid)  # Samples at the end of every time step
+    grid.run(max_steps=1000)
+    probes.flush()
+'''
+import os
+
+import numpy as np
+
+FIELDS = ('Q_th', 'Q_v', 'Q_cj', 'Q_d')
+
+
+def transect(start, end, n):
+    '''
+    :param start: (x, y) of the first point
+    :param end: (x, y) of the last point
+    :param n: Number of points
+    :return: (n, 2) array of evenly spaced points from start to end
+    '''
+    return np.linspace(np.asarray(start, dtype=float), np.asarray(end, dtype=float), n)
+
+
+def barycentric(points, dx, Ny, Nx):
+    '''
+    Finds the triangle of cell centers around each point and its barycentric weights.
+
+    :param points: (n, 2) world coordinates
+    :param dx: Cell size
+    :param Ny, Nx: Grid shape
+    :return: rows, cols and weights, each of shape (n, 3)
+    '''
+    rows, cols, weights, inside = triangles(points, dx, Ny, Nx)
+    if not inside.all():
+        points = np.asarray(points, dtype=float).reshape(-1, 2)
+        raise ValueError('%d of %d points are outside the interior cells, e.g. (%g, %g)'
+                         % ((~inside).sum(), len(points), *points[np.argmin(inside)]))
+    return rows, cols, weights
+
+
+def triangles(points, dx, Ny, Nx):
+    '''
+    As barycentric, but points outside the interior cells are returned with inside = False instead of\
+    raising an error.
+
+    :return: rows, cols and weights, each of shape (n, 3), and the (n,) bool array inside
+    '''
+    points = np.asarray(points, dtype=float).reshape(-1, 2)
+    # Fractional lattice coordinates, inverting X[r, c] = (r*dx/2 + c*dx, -r*dx*sqrt(3)/2)
+    r = -points[:, 1] / (dx * np.sqrt(3) / 2)
+    c = points[:, 0] / dx - r / 2
+    r = np.where(np.isclose(r, np.round(r), rtol=0, atol=1e-9), np.round(r), r)
+    c = np.where(np.isclose(c, np.round(c), rtol=0, atol=1e-9), np.round(c), c)
+    r0 = np.floor(r).astype(int)
+    c0 = np.floor(c).astype(int)
+    fr = r - r0
+    fc = c - c0
+
+    # The short diagonal from (r0+1, c0) to (r0, c0+1) splits the lattice cell into two triangles
+    lower = fr + fc <= 1
+    rows = np.stack((np.where(lower, r0, r0 + 1), r0, r0 + 1), axis=1)
+    cols = np.stack((np.where(lower, c0, c0 + 1), c0 + 1, c0), axis=1)
+    weights = np.stack((np.where(lower, 1 - fr - fc, fr + fc - 1),
+                        np.where(lower, fc, 1 - fr),
+                        np.where(lower, fr, 1 - fc)), axis=1)
+
+    # Corners with weight 0, e.g. of points on the edge of the interior, may lie on the border
+    outside = np.any(((rows < 1) | (rows > Ny - 2) | (cols < 1) | (cols > Nx - 2)) & (weights > 0), axis=1)
+    return np.clip(rows, 1, Ny - 2), np.clip(cols, 1, Nx - 2), weights, ~outside
+
+
+class ChunkWriter():
+    '''Writes every flushed chunk of samples to its own .npz file in a directory.'''
+
+    def __init__(self, path):
+        self.path = path
+        self.chunks = 0
+        os.makedirs(path, exist_ok=True)
+
+    def __call__(self, samples):
+        np.savez(os.path.join(self.path, 'chunk_%06d.npz' % self.chunks), **samples)
+        self.chunks += 1
+
+
+def read_chunks(path):
+    '''
+    :param path: Directory written by ChunkWriter
+    :return: dict of the samples of all chunks, in order
+    '''
+    names = sorted(name for name in os.listdir(path) if name.startswith('chunk_') and name.endswith('.npz'))
+    chunks = [np.load(os.path.join(path, name)) for name in names]
+    if not chunks:
+        return {}
+    return {key: np.concatenate([chunk[key] for chunk in chunks]) for key in chunks[0].files}
+
+
+class Probes():
+    '''Samples substates at fixed points into ring buffers.'''
+
+    def __init__(self, grid, points, fields=FIELDS, capacity=1024, every=1, on_flush=None):
+        '''
+        :param grid: Hexgrid (or AdaptiveHexgrid) to sample
+        :param points: (n, 2) world coordinates of the probes (see transect)
+        :param fields: Substates to sample
+        :param capacity: Number of samples kept in the ring buffers
+        :param every: Sample every every-th call
+        :param on_flush: Called as on_flush(samples) with a dict of 't', 'step' (Hexgrid.stepCount) and the\
+        fields, each with one row per sample, whenever the buffers are full and on flush(). If None, old samples\
+        are overwritten.
+        '''
+        self.points = np.asarray(points, dtype=float).reshape(-1, 2)
+        self.rows, self.cols, self.weights = barycentric(self.points, grid.dx, grid.Ny, grid.Nx)
+        self.fields = tuple(fields)
+        self.capacity = capacity
+        self.every = every
+        self.on_flush = on_flush
+        self.calls = 0
+        self.count = 0  # Samples taken since the last flush
+        self.t = np.zeros(capacity)
+        self.step = np.zeros(capacity, dtype=np.int64)
+        self.buffers = {name: np.zeros((capacity, len(self.points)) + getattr(grid, name).shape[2:])
+                        for name in self.fields}
+
+    def interpolate(self, values):
+        '''
+        :param values: (Ny, Nx, ...) substate
+        :return: (n, ...) values at the probes
+        '''
+        corners = values[self.rows, self.cols]
+        return np.einsum('pk,pk...->p...', self.weights, corners)
+
+    def sample(self, grid):
+        '''Records the fields of grid at the probes. Can be used as callback of Hexgrid.run.'''
+        self.calls += 1
+        if self.calls % self.every:
+            return
+        i = self.count % self.capacity
+        self.t[i] = grid.t
+        self.step[i] = grid.stepCount
+        for name in self.fields:
+            self.buffers[name][i] = self.interpolate(getattr(grid, name))
+        self.count += 1
+        if self.on_flush is not None and self.count == self.capacity:
+            self.flush()
+
+    __call__ = sample
+
+    def read(self):
+        '''
+        :return: dict of 't', 'step' and the fields with the samples in the buffers, oldest first
+        '''
+        n = min(self.count, self.capacity)
+        order = (np.arange(n) + max(self.count - self.capacity, 0)) % self.capacity
+        samples = {'t': self.t[order], 'step': self.step[order]}
+        samples.update((name, self.buffers[name][order]) for name in self.fields)
+        return samples
+
+    def flush(self):
+        '''Hands the samples in the buffers to on_flush and empties the buffers.'''
+        if self.count and self.on_flush is not None:
+            self.on_flush(self.read())
+        self.count = 0
+
+    def attach(self, grid):
+        '''Samples grid at the end of each of its time steps.'''
+        grid.addObserver(self)
+
+    def detach(self, grid):
+        grid.removeObserver(self)
@@ -0,0 +1,253 @@
+'''
+Multi-resolution overview pyramids of output frames.
+
+Looking at one frame of a large run means loading every substate at full resolution. PyramidWriter
+stores every frame as a pyramid of levels instead: level 0 holds the interior cells of the grid, and every
+cell of level k + 1 is the parent of ratio x ratio cells of level k, which tile it exactly on the sheared
+layout of Hexgrid (see refinement.py). The down-sampling is conservative where it can be: thicknesses
+(Q_th, Q_d, Q_a) are averaged, so the volume of a parent is that of its children, concentrations are
+averaged weighted by the volume they are in (Q_cj by Q_th, Q_cbj by Q_d), so sediment is conserved too,
+and speeds (Q_v) take the maximum, so that fast currents stay visible. At the lower and right edges
+parents may have fewer children, of which they take the mean (or maximum) of those that exist.
+
+Every level of every substate is a .npy file, which PyramidReader memory-maps, so reading a window of a
+level only reads that window from disk. A viewer can show the coarsest level of a frame at once and load
+finer levels of the visible window only as it zooms in (see plotting.plot_pyramid).
+
+Use:
+
+    with PyramidWriter('out/pyramid', fields=('Q_th', 'Q_v', 'Q_d')) as writer:
+        for i in range(n):
+            grid.time_step()
+            writer.record(grid, step=i + 1)
+
+    pyramid = PyramidReader('out/pyramid')
+    overview = pyramid.read('Q_d', -1, level=pyramid.levels - 1)
+    detail = pyramid.read('Q_d', -1, level=0, window=(2000, 2256, 3000, 3256))  # rows r0:r1, columns c0:c1
+'''
+import json
+import os
+
+import numpy as np
+
+from refinement import blocks
+
+FIELDS = ('Q_th', 'Q_v', 'Q_cj', 'Q_d')
+INDEX = 'pyramid.json'
+
+# How the cells of a level are combined into their parent: ('mean', None), ('max', None), or
+# ('mean', name) for a mean weighted by the substate name, which has to be stored as well.
+COMBINE = {'Q_th': ('mean', None), 'Q_d': ('mean', None), 'Q_a': ('mean', None), 'Q_v': ('max', None),
+           'Q_cj': ('mean', 'Q_th'), 'Q_cbj': ('mean', 'Q_d')}
+
+
+def frame_dir(path, n):
+    return os.path.join(path, 'frame_%06d' % n)
+
+
+def level_file(path, n, name, level):
+    return os.path.join(frame_dir(path, n), '%s_%d.npy' % (name, level))
+
+
+def level_shapes(shape, ratio, min_size):
+    '''
+    :param shape: (rows, columns) of level 0
+    :param ratio: Down-sampling ratio between levels
+    :param min_size: The last level is the first with at most min_size rows and columns
+    :return: List of the (rows, columns) of every level
+    :raises ValueError: If ratio < 2 or min_size < 1, for which the levels would never get small enough
+    '''
+    if ratio < 2 or min_size < 1:
+        raise ValueError('ratio must be >= 2 and min_size >= 1')
+    shapes = [tuple(shape)]
+    while max(shapes[-1]) > min_size:
+        shapes.append(tuple(-(-n // ratio) for n in shapes[-1]))
+    return shapes
+
+
+def downsample(values, ratio, how='mean', weights=None):
+    '''
+    Combines the ratio x ratio children of every parent cell (see refinement.restrict), of which those of\
+    the parents at the lower and right edges may be missing.
+
+    :param values: numpy.ndarray(ny, nx, ...)
+    :param ratio: Down-sampling ratio
+    :param how: 'mean' or 'max'
+    :param weights: Optional numpy.ndarray(ny, nx) of weights for the mean. Parents whose children all have\
+    zero weight get the unweighted mean.
+    :return: numpy.ndarray(ceil(ny / ratio), ceil(nx / ratio), ...)
+    '''
+    ny, nx = values.shape[:2]
+    pad = ((0, -ny % ratio), (0, -nx % ratio)) + ((0, 0),) * (values.ndim - 2)
+    children = blocks(np.pad(np.asarray(values, dtype=float), pad, constant_values=np.nan), ratio)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        if how == 'max':
+            return np.fmax.reduce(np.fmax.reduce(children, axis=3), axis=1)
+        exists = ~np.isnan(children)
+        mean = np.where(exists, children, 0).sum(axis=(1, 3)) / exists.sum(axis=(1, 3))
+        if weights is None:
+            return mean
+        w = blocks(np.pad(np.asarray(weights, dtype=float), pad[:2], constant_values=0), ratio)
+        w = w.reshape(w.shape + (1,) * (values.ndim - 2))
+        total = w.sum(axis=(1, 3))
+        weighted = (np.where(exists, children, 0) * w).sum(axis=(1, 3)) / total
+    return np.where(total > 0, weighted, mean)
+
+
+class PyramidWriter():
+    '''Writes frames of selected substates as multi-resolution pyramids.'''
+
+    def __init__(self, path, fields=FIELDS, ratio=2, min_size=256):
+        '''
+        :param path: Output directory
+        :param fields: Names of the Hexgrid substates to store. Q_cj and Q_cbj need Q_th and Q_d (see COMBINE),\
+        which are stored as well.
+        :param ratio: Down-sampling ratio between levels
+        :param min_size: The coarsest level is the first with at most min_size rows and columns
+        '''
+        if ratio < 2:
+            raise ValueError('ratio must be >= 2')
+        if min_size < 1:
+            raise ValueError('min_size must be >= 1')
+        fields = tuple(fields)
+        unknown = set(fields) - set(COMBINE)
+        if unknown:
+            raise ValueError('No down-sampling defined for %s' % ', '.join(sorted(unknown)))
+        weights = tuple(COMBINE[name][1] for name in fields if COMBINE[name][1] not in fields + (None,))
+        self.path = path
+        self.fields = fields + tuple(dict.fromkeys(weights))
+        self.ratio = ratio
+        self.min_size = min_size
+        self.frames = []
+        self.shapes = None
+        self.dx = None
+        os.makedirs(path, exist_ok=True)
+
+    def record(self, grid, step=None):
+        '''Writes the pyramid of the current state of grid as the next frame.'''
+        n = len(self.frames)
+        if self.shapes is None:
+            self.shapes = level_shapes((grid.Ny - 2, grid.Nx - 2), self.ratio, self.min_size)
+            self.dx = float(grid.dx)
+        os.makedirs(frame_dir(self.path, n), exist_ok=True)
+        level = {name: np.asarray(getattr(grid, name))[1:-1, 1:-1] for name in self.fields}
+        for k in range(len(self.shapes)):
+            if k > 0:
+                level = {name: downsample(values, self.ratio, COMBINE[name][0],
+                                          None if COMBINE[name][1] is None else level[COMBINE[name][1]])
+                         for name, values in level.items()}
+            for name, values in level.items():
+                np.save(level_file(self.path, n, name, k), values)
+        self.frames.append({'step': n if step is None else int(step), 't': float(grid.t)})
+        self.write_index()
+
+    def write_index(self):
+        with open(os.path.join(self.path, INDEX + '.tmp'), 'w') as file:
+            json.dump({'fields': self.fields, 'ratio': self.ratio, 'dx': self.dx,
+                       'shapes': [list(shape) for shape in self.shapes or ()], 'frames': self.frames}, file)
+        os.replace(os.path.join(self.path, INDEX + '.tmp'), os.path.join(self.path, INDEX))
+
+    def close(self):
+        self.write_index()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class PyramidReader():
+    '''Reads levels and windows of the frames written by PyramidWriter, loading only what is asked for.'''
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, INDEX)) as file:
+            index = json.load(file)
+        self.fields = tuple(index['fields'])
+        self.ratio = index['ratio']
+        self.dx = index['dx']
+        self.shapes = [tuple(shape) for shape in index['shapes']]
+        self.levels = len(self.shapes)
+        self.frames = index['frames']
+        self.steps = np.array([frame['step'] for frame in self.frames])
+        self.times = np.array([frame['t'] for frame in self.frames])
+
+    def __len__(self):
+        return len(self.frames)
+
+    def level(self, name, n, level=0):
+        '''
+        :param name: Substate name
+        :param n: Frame number (not the time step number, see self.steps). Negative numbers count from the end.
+        :param level: Level, 0 being the full resolution
+        :return: Read-only memory map of the whole level
+        '''
+        if name not in self.fields:
+            raise KeyError('%s is not stored. Stored: %s' % (name, ', '.join(self.fields)))
+        if not -len(self) <= n < len(self):
+            raise IndexError('frame %d out of range' % n)
+        if not 0 <= level < self.levels:
+            raise IndexError('level %d out of range (%d levels)' % (level, self.levels))
+        return np.load(level_file(self.path, n % len(self), name, level), mmap_mode='r')
+
+    def read(self, name, n, level=0, window=None):
+        '''
+        Reads a window of a level of a frame.
+
+        :param name: Substate name
+        :param n: Frame number (see level)
+        :param level: Level, 0 being the full resolution
+        :param window: (r0, r1, c0, c1): the rows r0:r1 and columns c0:c1 of the level. None reads all.
+        :return: numpy.ndarray. Indices of level 0 are those of the interior cells, so row r is row r + 1\
+        of the grid.
+        '''
+        values = self.level(name, n, level)
+        if window is not None:
+            r0, r1, c0, c1 = window
+            values = values[r0:r1, c0:c1]
+        return np.array(values)
+
+    def window_on(self, window, level, fromLevel=0):
+        '''
+        :param window: (r0, r1, c0, c1) on the level fromLevel
+        :return: The smallest window on level that covers it
+        '''
+        scale = self.ratio ** (level - fromLevel)
+        r0, r1, c0, c1 = window
+        if scale >= 1:
+            shape = self.shapes[level]
+            return (r0 // scale, min(-(-r1 // scale), shape[0]), c0 // scale, min(-(-c1 // scale), shape[1]))
+        scale = self.ratio ** (fromLevel - level)
+        return r0 * scale, r1 * scale, c0 * scale, c1 * scale
+
+    def finest_level(self, window=None, max_cells=250000):
+        '''
+        :param window: (r0, r1, c0, c1) on level 0. None is the whole grid.
+        :param max_cells: Largest number of cells to read
+        :return: The finest level on which the window has at most max_cells cells
+        '''
+        if window is None:
+            window = (0, self.shapes[0][0], 0, self.shapes[0][1])
+        for level in range(self.levels):
+            r0, r1, c0, c1 = self.window_on(window, level)
+            if (r1 - r0) * (c1 - c0) <= max_cells:
+                return level
+        return self.levels - 1
+
+    def centers(self, level=0, window=None):
+        '''
+        :param level: Level
+        :param window: (r0, r1, c0, c1) on the level. None is the whole level.
+        :return: numpy.ndarray(rows, columns, 2) of the x and y coordinates of the cell centers (as Hexgrid.X),\
+        those of a parent being the mean of those of its ratio x ratio children
+        '''
+        shape = self.shapes[level]
+        r0, r1, c0, c1 = window if window is not None else (0, shape[0], 0, shape[1])
+        scale = self.ratio ** level
+        rows = 1 + (np.arange(r0, r1) + 0.5) * scale - 0.5  # Mean row of the children, in rows of the grid
+        cols = 1 + (np.arange(c0, c1) + 0.5) * scale - 0.5
+        X = np.zeros((r1 - r0, c1 - c0, 2))
+        X[:, :, 0] = rows[:, np.newaxis] * self.dx / 2 + cols * self.dx
+        X[:, :, 1] = -self.dx * np.sqrt(3) / 2 * rows[:, np.newaxis]
+        return X
@@ -0,0 +1,185 @@
+'''
+Export of substates as regular rasters.
+
+The cells of a Hexgrid lie on a sheared hexagonal lattice (see Hexgrid.X). RasterExporter resamples
+substates onto a regular raster, with the barycentric interpolation of probes.py: the value at every
+raster cell center is a weighted sum of three neighboring hex cells. The weights form a sparse matrix
+from the Ny*Nx hex cells to the raster cells, which is built once per geometry and cached, in memory
+(the last MAX_OPERATORS geometries) and optionally on disk. Resampling a substate is then one sparse
+matrix-vector product. Raster cells outside the interior hex cells are nodata. Rasters are written as
+ESRI ASCII grids (.asc) in blocks of BLOCK_ROWS rows: each block is resampled with the rows of the
+operator for its raster cells, so a raster never has to be held in memory as a whole. Needs scipy.
+
+Use:
+
+    exporter = RasterExporter(grid, cellsize=grid.dx / 2)
+    exporter.export(grid, 'out/rasters', step=100)  # out/rasters/Q_th_000100.asc, ...
+'''
+import hashlib
+import os
+
+import numpy as np
+
+from probes import triangles
+
+FIELDS = ('Q_th', 'Q_d')
+NODATA = -9999
+BLOCK_ROWS = 256  # Raster rows resampled and written at a time
+MAX_OPERATORS = 4  # Resampling operators kept in memory
+
+_operators = {}  # In-memory cache of resampling operators, keyed by geometry, least recently used first
+
+
+def grid_extent(grid):
+    '''
+    :return: (xmin, ymin, xmax, ymax) of the centers of the interior cells of a grid
+    '''
+    X = grid.X[1:-1, 1:-1].reshape(-1, 2)
+    return X[:, 0].min(), X[:, 1].min(), X[:, 0].max(), X[:, 1].max()
+
+
+def resampling_operator(Ny, Nx, dx, xllcorner, yllcorner, cellsize, nrows, ncols, cache_dir=None):
+    '''
+    Builds the sparse matrix that resamples (Ny, Nx) hex values onto the cell centers of a raster, or returns\
+    it from the cache.
+
+    :param Ny, Nx, dx: Hex grid geometry
+    :param xllcorner, yllcorner: Lower left corner of the raster
+    :param cellsize: Raster cell size
+    :param nrows, ncols: Raster shape. Row 0 is the northernmost row, as in ESRI grids.
+    :param cache_dir: Directory in which operators are stored between runs. None keeps them in memory only.
+    :return: (operator, inside). operator is a scipy.sparse CSR matrix of shape (nrows*ncols, Ny*Nx),\
+    inside is the (nrows, ncols) bool array of raster cells within the interior hex cells.
+    '''
+    key = (Ny, Nx, float(dx), float(xllcorner), float(yllcorner), float(cellsize), nrows, ncols)
+    if key in _operators:
+        _operators[key] = _operators.pop(key)  # Most recently used
+        return _operators[key]
+    import scipy.sparse
+
+    path = None
+    if cache_dir is not None:
+        path = os.path.join(cache_dir, 'raster-%s.npz' % hashlib.sha256(repr(key).encode()).hexdigest()[:32])
+        if os.path.exists(path):
+            operator = scipy.sparse.load_npz(path).tocsr()
+            return remember(key, (operator, np.diff(operator.indptr).reshape(nrows, ncols) > 0))
+
+    x = xllcorner + (np.arange(ncols) + 0.5) * cellsize
+    y = yllcorner + (nrows - np.arange(nrows) - 0.5) * cellsize
+    points = np.stack(np.broadcast_arrays(x[None, :], y[:, None]), axis=-1).reshape(-1, 2)
+    rows, cols, weights, inside = triangles(points, dx, Ny, Nx)
+    raster = np.repeat(np.flatnonzero(inside), 3)
+    operator = scipy.sparse.csr_matrix(
+        (weights[inside].ravel(), (raster, (rows[inside] * Nx + cols[inside]).ravel())),
+        shape=(nrows * ncols, Ny * Nx))
+    if path is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        scipy.sparse.save_npz(path + '.tmp.npz', operator)
+        os.replace(path + '.tmp.npz', path)
+    return remember(key, (operator, inside.reshape(nrows, ncols)))
+
+
+def remember(key, entry):
+    '''Adds an entry to the in-memory cache of operators, dropping the least recently used beyond MAX_OPERATORS.'''
+    _operators[key] = entry
+    while len(_operators) > MAX_OPERATORS:
+        del _operators[next(iter(_operators))]
+    return entry
+
+
+class RasterExporter():
+    '''Resamples substates of a Hexgrid onto a regular raster and writes them as ESRI ASCII grids.'''
+
+    def __init__(self, grid, cellsize=None, extent=None, cache_dir=None):
+        '''
+        :param grid: Hexgrid whose geometry (Ny, Nx, dx) is used
+        :param cellsize: Raster cell size. Defaults to grid.dx.
+        :param extent: (xmin, ymin, xmax, ymax) covered by the raster. Defaults to the interior cells.
+        :param cache_dir: Directory in which resampling operators are stored between runs
+        '''
+        self.Ny, self.Nx = grid.Ny, grid.Nx
+        self.cellsize = float(cellsize if cellsize is not None else grid.dx)
+        xmin, ymin, xmax, ymax = extent if extent is not None else grid_extent(grid)
+        self.ncols = max(int(np.ceil((xmax - xmin) / self.cellsize)), 1)
+        self.nrows = max(int(np.ceil((ymax - ymin) / self.cellsize)), 1)
+        self.xllcorner = xmin
+        self.yllcorner = ymin
+        self.operator, self.inside = resampling_operator(self.Ny, self.Nx, grid.dx, self.xllcorner, self.yllcorner,
+                                                         self.cellsize, self.nrows, self.ncols, cache_dir)
+
+    def resample(self, values, rows=None):
+        '''
+        :param values: (Ny, Nx) array, e.g. a substate or one sediment class of Q_cj
+        :param rows: slice of raster rows to resample. Defaults to the whole raster.
+        :return: (nrows, ncols) raster, or the given rows of it, NaN outside the interior cells
+        '''
+        rows = slice(*(rows or slice(None)).indices(self.nrows))
+        operator = self.operator
+        if (rows.start, rows.stop) != (0, self.nrows):
+            # The rows of a CSR matrix for a block of raster rows are contiguous: slicing them copies only those
+            operator = operator[rows.start * self.ncols:rows.stop * self.ncols]
+        # The operator has no entries for the border cells, so their values (inf for Q_d) are never used
+        raster = (operator @ np.asarray(values, dtype=float).reshape(-1)).reshape(-1, self.ncols)
+        raster[~self.inside[rows]] = np.nan
+        return raster
+
+    def write_asc(self, path, values, nodata=NODATA, fmt='%.6g'):
+        '''
+        Resamples values and writes them to an ESRI ASCII grid, BLOCK_ROWS rows at a time.
+
+        :param path: Output file (.asc)
+        :param values: (Ny, Nx) array
+        :param nodata: Value written outside the interior cells
+        :param fmt: Number format
+        '''
+        with open(path, 'w') as file:
+            file.write('ncols %d\nnrows %d\nxllcorner %.10g\nyllcorner %.10g\ncellsize %.10g\nNODATA_value %s\n'
+                       % (self.ncols, self.nrows, self.xllcorner, self.yllcorner, self.cellsize, nodata))
+            line = ' '.join([fmt] * self.ncols) + '\n'
+            for start in range(0, self.nrows, BLOCK_ROWS):
+                rows = slice(start, min(start + BLOCK_ROWS, self.nrows))
+                block = self.resample(values, rows)
+                block[~self.inside[rows]] = nodata
+                file.write(''.join([line % tuple(row) for row in block]))
+
+    def export(self, grid, directory, fields=FIELDS, step=None):
+        '''
+        Writes substates of grid as <field>[_<class>][_<step>].asc. Substates with sediment classes are\
+        written one file per class.
+
+        :param grid: Hexgrid with the geometry of the exporter
+        :param directory: Output directory
+        :param fields: Substates to write
+        :param step: Step number added to the file names
+        :return: List of the files written
+        '''
+        if (grid.Ny, grid.Nx) != (self.Ny, self.Nx):
+            raise ValueError('Grid of shape (%d, %d) does not match the exporter (%d, %d)'
+                             % (grid.Ny, grid.Nx, self.Ny, self.Nx))
+        os.makedirs(directory, exist_ok=True)
+        suffix = '' if step is None else '_%06d' % step
+        paths = []
+        for name in fields:
+            values = getattr(grid, name)
+            layers = [(name, values)] if values.ndim == 2 else \
+                [('%s_%d' % (name, j), values[..., j]) for j in range(values.shape[-1])]
+            for layer, layerValues in layers:
+                path = os.path.join(directory, layer + suffix + '.asc')
+                self.write_asc(path, layerValues)
+                paths.append(path)
+        return paths
+
+
+def read_asc(path):
+    '''
+    :param path: ESRI ASCII grid
+    :return: (raster, header). raster has NaN for nodata, header is a dict of the header values.
+    '''
+    header = {}
+    with open(path) as file:
+        for i in range(6):
+            name, value = file.readline().split()
+            header[name.lower()] = float(value)
+        raster = np.loadtxt(file, ndmin=2)
+    raster[raster == header['nodata_value']] = np.nan
+    return raster, header
@@ -0,0 +1,173 @@
+'''
+In-situ reducers of a run.
+
+Most analyses of a run need a few maps rather than every frame: when the current first reached each cell,
+the largest speed and thickness it had there, how much of each grain class was deposited and how deep the
+bed was eroded. Reducers keeps these maps and updates them in place after every time step, so a run only
+has to write them once at the end instead of writing frames to reduce afterwards.
+
+Every reducer has the shape of the grid (with one value per sediment class for the deposit) and leaves the
+border as it started. The cells with a current (Q_th > threshold) are found once per step and shared by
+the reducers, which only update those cells where they can: the arrival time and the peaks only change
+where there is a current, the bed also changes elsewhere through the toppling rule.
+
+The deposit and erosion are found from the change of the bed between two updates, so they are net over
+the steps between updates (erosion and deposition of the same step cancel out, as in Q_d).
+
+Use:
+
+    reducers = Reducers(grid, ('arrival_time', 'peak_Q_v', 'deposit'))
+    reducers.attach(grid)  # Updates at the end of every time step
+    grid.run(max_steps=1000)
+    reducers.write('out/reducers.npz')
+'''
+import numpy as np
+
+THRESHOLD = 1e-6  # Smallest Q_th counted as a current
+
+
+class ArrivalTime():
+    '''Time at which the current first reached each cell. NaN where it never did.'''
+
+    name = 'arrival_time'
+
+    def start(self, grid, active):
+        self.values = np.full((grid.Ny, grid.Nx), np.nan)
+        self.update(grid, active)
+
+    def update(self, grid, active):
+        interior = self.values[1:-1, 1:-1]
+        interior[active & np.isnan(interior)] = grid.t
+
+    def result(self):
+        return {self.name: self.values}
+
+
+class Peak():
+    '''Largest value of a substate in each cell while the current was there.'''
+
+    def __init__(self, field):
+        '''
+        :param field: Name of a Hexgrid substate of shape (Ny, Nx), e.g. 'Q_v' or 'Q_th'
+        '''
+        self.field = field
+        self.name = 'peak_' + field
+
+    def start(self, grid, active):
+        self.values = np.zeros((grid.Ny, grid.Nx))
+        self.update(grid, active)
+
+    def update(self, grid, active):
+        interior = self.values[1:-1, 1:-1]
+        np.maximum(interior, getattr(grid, self.field)[1:-1, 1:-1], out=interior, where=active)
+
+    def result(self):
+        return {self.name: self.values}
+
+
+def bed_volumes(grid):
+    '''
+    :return: numpy.ndarray(Ny-2, Nx-2, Nj) of the soft sediment of every class per unit area of the\
+    interior cells
+    '''
+    return grid.Q_d[1:-1, 1:-1, np.newaxis] * grid.Q_cbj[1:-1, 1:-1]
+
+
+class CumulativeDeposit():
+    '''Sediment of every class deposited in each cell, as a thickness, not counting what was eroded.'''
+
+    name = 'deposit'
+
+    def start(self, grid, active):
+        self.last = bed_volumes(grid)
+        self.values = np.zeros((grid.Ny, grid.Nx, self.last.shape[2]))
+
+    def update(self, grid, active):
+        bed = bed_volumes(grid)
+        change = np.subtract(bed, self.last, out=self.last)
+        self.values[1:-1, 1:-1] += np.maximum(change, 0, out=change)
+        self.last = bed
+
+    def result(self):
+        return {self.name: self.values}
+
+
+class ErosionDepth():
+    '''Largest depth to which the bed of each cell was eroded below its initial height.'''
+
+    name = 'erosion_depth'
+
+    def start(self, grid, active):
+        self.initial = grid.Q_d[1:-1, 1:-1].copy()
+        self.values = np.zeros((grid.Ny, grid.Nx))
+
+    def update(self, grid, active):
+        interior = self.values[1:-1, 1:-1]
+        np.maximum(interior, self.initial - grid.Q_d[1:-1, 1:-1], out=interior)
+
+    def result(self):
+        return {self.name: self.values}
+
+
+# Reducers by the names used in scenario files
+REDUCERS = {'arrival_time': ArrivalTime, 'peak_Q_v': lambda: Peak('Q_v'), 'peak_Q_th': lambda: Peak('Q_th'),
+            'deposit': CumulativeDeposit, 'erosion_depth': ErosionDepth}
+
+
+class Reducers():
+    '''Updates a set of reducers in place after every time step.'''
+
+    def __init__(self, grid, reducers=tuple(REDUCERS), threshold=THRESHOLD):
+        '''
+        :param grid: Hexgrid in its initial state
+        :param reducers: Names of REDUCERS, or reducer objects with the methods start, update and result
+        :param threshold: Smallest Q_th counted as a current
+        :raises KeyError: For unknown names
+        '''
+        unknown = [name for name in reducers if isinstance(name, str) and name not in REDUCERS]
+        if unknown:
+            raise KeyError('Unknown reducers %s. Choose from %s' % (', '.join(unknown), ', '.join(REDUCERS)))
+        self.reducers = [REDUCERS[r]() if isinstance(r, str) else r for r in reducers]
+        self.threshold = threshold
+        self.steps = 0
+        self.t = grid.t
+        active = self.active(grid)
+        for reducer in self.reducers:
+            reducer.start(grid, active)
+
+    def active(self, grid):
+        '''
+        :return: numpy.ndarray(Ny-2, Nx-2) of bool, True for the interior cells with a current
+        '''
+        return grid.Q_th[1:-1, 1:-1] > self.threshold
+
+    def update(self, grid):
+        '''Updates the reducers with the state of grid. Can be used as callback of Hexgrid.run.'''
+        active = self.active(grid)
+        for reducer in self.reducers:
+            reducer.update(grid, active)
+        self.steps += 1
+        self.t = grid.t
+
+    __call__ = update
+
+    def results(self):
+        '''
+        :return: dict of the maps of all reducers, and the number of updates 'steps' and the time 't' of the\
+        last one
+        '''
+        results = {'steps': self.steps, 't': self.t}
+        for reducer in self.reducers:
+            results.update(reducer.result())
+        return results
+
+    def write(self, path):
+        '''Writes the results to a .npz file.'''
+        np.savez(path, **self.results())
+
+    def attach(self, grid):
+        '''Updates at the end of each time step of grid.'''
+        grid.addObserver(self)
+
+    def detach(self, grid):
+        grid.removeObserver(self)
@@ -0,0 +1,419 @@
+'''
+Block-structured adaptive refinement around the turbidity current.
+
+The coarse Hexgrid is divided into blocks of block x block cells. Blocks containing current, or a bed
+steeper than a threshold, are flagged, grown by a buffer of blocks, and merged into rectangular patches.
+Each patch is simulated on a fine Hexgrid with spacing dx / ratio, in which every coarse cell (i, j) is
+split into the ratio x ratio fine cells (ratio*i + a, ratio*j + b). On the sheared layout of Hexgrid
+these children tile the parent cell exactly, so restriction (averaging the children) and prolongation
+(a slope-limited linear reconstruction whose children average to the parent) are conservative.
+
+A coarse step advances the whole coarse grid. Each patch is then subcycled with its own calc_dt until
+it reaches the coarse time. The patch boundary is a wall, and the exchange of current, sediment and bed
+across it is taken from the coarse step (coarse fluxes are authoritative at the interface) and applied
+to the fine cells of the boundary blocks. The patch is then restricted back onto the coarse cells it
+covers. Patches are rebuilt every regrid_every steps, so quiescent regions are coarsened again.
+
+Use:
+
+    grid = Hexgrid(Nx, Ny, ICstates=ICstates, terrain='river')
+    amr = AdaptiveHexgrid(grid, ratio=2, block=8)
+    amr.run(until=600)
+'''
+import numpy as np
+
+from hexgrid import Hexgrid
+
+OPPOSITE = np.array([3, 4, 5, 0, 1, 2])
+SUBSTATES = ('Q_th', 'Q_v', 'Q_cj', 'Q_cbj', 'Q_d', 'Q_a')
+CONSTANTS = ('g', 'f', 'a', 'rho_a', 'rho_j', 'D_sj', 'Nj', 'c_D', 'nu', 'porosity', 'v_sj', 'p_f', 'p_adh')
+
+
+def blocks(array, r):
+    '''Returns a (ny, r, nx, r, ...) view of a (ny*r, nx*r, ...) array, grouping the children of each coarse cell.'''
+    ny, nx = array.shape[0] // r, array.shape[1] // r
+    return array.reshape((ny, r, nx, r) + array.shape[2:])
+
+
+def restrict(fine, r, weights=None):
+    '''
+    Averages the r x r children of every coarse cell.
+
+    :param fine: numpy.ndarray(ny*r, nx*r, ...)
+    :param r: Refinement ratio
+    :param weights: Optional numpy.ndarray(ny*r, nx*r) of weights, e.g. Q_th for concentrations.\\
+    Cells whose children all have zero weight get the unweighted mean.
+    :return: numpy.ndarray(ny, nx, ...)
+    '''
+    fine = blocks(fine, r)
+    mean = fine.mean(axis=(1, 3))
+    if weights is None:
+        return mean
+    w = blocks(weights, r)
+    w = w.reshape(w.shape + (1,) * (fine.ndim - 4))
+    total = w.sum(axis=(1, 3))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        weighted = (fine * w).sum(axis=(1, 3)) / total
+    return np.where(total > 0, weighted, mean)
+
+
+def minmod(a, b):
+    return np.where(a * b > 0, np.sign(a) * np.minimum(np.abs(a), np.abs(b)), 0)
+
+
+def prolong(coarse, r, linear=True):
+    '''
+    Prolongs coarse cell values onto their r x r children.
+
+    :param coarse: numpy.ndarray(ny+2, nx+2, ...). Coarse values including a one-cell halo, which is only\\
+    used for the slopes.
+    :param r: Refinement ratio
+    :param linear: Use a minmod-limited linear reconstruction. Otherwise piecewise constant.\\
+    Both are conservative: the children average to the parent.
+    :return: numpy.ndarray(ny*r, nx*r, ...)
+    '''
+    centre = coarse[1:-1, 1:-1]
+    ny, nx = centre.shape[:2]
+    rest = centre.shape[2:]
+    fine = np.broadcast_to(centre[:, np.newaxis, :, np.newaxis], (ny, r, nx, r) + rest).copy()
+    if linear and r > 1:
+        with np.errstate(invalid='ignore'):
+            slope_y = minmod(centre - coarse[:-2, 1:-1], coarse[2:, 1:-1] - centre)
+            slope_x = minmod(centre - coarse[1:-1, :-2], coarse[1:-1, 2:] - centre)
+        slope_y[~np.isfinite(slope_y)] = 0
+        slope_x[~np.isfinite(slope_x)] = 0
+        offset = (np.arange(r) - (r - 1) / 2) / r
+        shape = (1,) * len(rest)
+        fine += slope_y[:, np.newaxis, :, np.newaxis] * offset.reshape((1, r, 1, 1) + shape)
+        fine += slope_x[:, np.newaxis, :, np.newaxis] * offset.reshape((1, 1, 1, r) + shape)
+    return fine.reshape((ny * r, nx * r) + rest)
+
+
+class Patch():
+    '''A fine Hexgrid covering the coarse cells [r0:r1, c0:c1] (coarse array indices, interior cells only).'''
+
+    def __init__(self, r0, r1, c0, c1, grid):
+        self.r0, self.r1, self.c0, self.c1 = r0, r1, c0, c1
+        self.grid = grid
+
+    @property
+    def window(self):
+        return np.s_[self.r0:self.r1, self.c0:self.c1]
+
+    def children(self, name):
+        '''(ny, r, nx, r, ...) view of the fine cells of a substate, grouped by coarse parent.'''
+        return blocks(getattr(self.grid, name)[1:-1, 1:-1], self.ratio)
+
+    @property
+    def ratio(self):
+        return (self.grid.Ny - 2) // (self.r1 - self.r0)
+
+
+class AdaptiveHexgrid():
+    '''Runs a Hexgrid with fine patches around the turbidity current and steep bed.'''
+
+    def __init__(self, grid, ratio=2, block=8, buffer=1, flow_eps=1e-6, slope=None, regrid_every=4,
+                 max_subcycles=1000):
+        '''
+        :param grid: The coarse Hexgrid
+        :param ratio: Refinement ratio. Every coarse cell is split into ratio x ratio fine cells.
+        :param block: Size of the refinement blocks in coarse cells
+        :param buffer: Number of blocks added around flagged blocks
+        :param flow_eps: Blocks with Q_th > flow_eps are refined
+        :param slope: Blocks with a bed slope (height difference / dx) above slope are refined. None disables it.
+        :param regrid_every: Rebuild the patches every regrid_every steps
+        :param max_subcycles: Maximum number of fine steps per coarse step
+        '''
+        self.grid = grid
+        self.ratio = ratio
+        self.block = block
+        self.buffer = buffer
+        self.flow_eps = flow_eps
+        self.slope = slope
+        self.regrid_every = regrid_every
+        self.max_subcycles = max_subcycles
+        self.patches = []
+        self.steps = 0
+        self.regrid()
+
+    def __getattr__(self, name):
+        # Substates, time and time step are those of the coarse grid
+        return getattr(self.__dict__['grid'], name)
+
+    run = Hexgrid.run
+    notify = Hexgrid.notify  # Observers are those of the coarse grid
+    is_flow_extinct = Hexgrid.is_flow_extinct
+    interior = Hexgrid.interior
+
+    ################################ Regridding ################################
+
+    def flag(self):
+        '''Returns the (nby, nbx) bool array of blocks to refine.'''
+        grid = self.grid
+        b = self.block
+        ny, nx = grid.Ny - 2, grid.Nx - 2
+        nby, nbx = -(-ny // b), -(-nx // b)
+        cells = grid.Q_th[1:-1, 1:-1] > self.flow_eps
+        if self.slope is not None:
+            grid.calc_Hdiff()
+            with np.errstate(invalid='ignore'):
+                cells |= np.any(np.abs(np.where(np.isfinite(grid.diff), grid.diff, 0)) / grid.dx > self.slope, axis=2)
+        padded = np.zeros((nby * b, nbx * b), dtype=bool)
+        padded[:ny, :nx] = cells
+        flagged = padded.reshape(nby, b, nbx, b).any(axis=(1, 3))
+        for i in range(self.buffer):
+            grown = flagged.copy()
+            grown[1:] |= flagged[:-1]
+            grown[:-1] |= flagged[1:]
+            grown[:, 1:] |= flagged[:, :-1]
+            grown[:, :-1] |= flagged[:, 1:]
+            flagged = grown
+        return flagged
+
+    def boxes(self, flagged):
+        '''Merges flagged blocks into non-overlapping rectangles (rows and columns in block units).'''
+        boxes = [[i, i + 1, j, j + 1] for i, j in zip(*np.nonzero(flagged))]
+        merged = True
+        while merged:
+            merged = False
+            for a in range(len(boxes)):
+                for c in range(a + 1, len(boxes)):
+                    A, C = boxes[a], boxes[c]
+                    # Merge boxes that overlap or touch, so that no interface cuts through the current
+                    if A[0] <= C[1] and C[0] <= A[1] and A[2] <= C[3] and C[2] <= A[3]:
+                        boxes[a] = [min(A[0], C[0]), max(A[1], C[1]), min(A[2], C[2]), max(A[3], C[3])]
+                        del boxes[c]
+                        merged = True
+                        break
+                if merged:
+                    break
+        return boxes
+
+    def regrid(self):
+        '''Rebuilds the patches from the current flags, keeping fine data where old and new patches overlap.'''
+        grid = self.grid
+        b = self.block
+        old = self.patches
+        self.patches = []
+        for i0, i1, j0, j1 in self.boxes(self.flag()):
+            r0, r1 = 1 + i0 * b, min(1 + i1 * b, grid.Ny - 1)
+            c0, c1 = 1 + j0 * b, min(1 + j1 * b, grid.Nx - 1)
+            patch = self.new_patch(r0, r1, c0, c1)
+            for o in old:
+                self.copy_overlap(o, patch)
+            patch.grid.calc_bathymetryDiff()
+            self.patches.append(patch)
+
+    def new_patch(self, r0, r1, c0, c1):
+        '''Creates a patch initialised by prolongation of the coarse grid.'''
+        grid = self.grid
+        r = self.ratio
+        Ny, Nx = (r1 - r0) * r + 2, (c1 - c0) * r + 2
+        halo = np.s_[r0 - 1:r1 + 1, c0 - 1:c1 + 1]
+        states = {}
+        for name in SUBSTATES:
+            full = np.zeros((Ny, Nx) + getattr(grid, name).shape[2:])
+            if name in ('Q_d', 'Q_a'):
+                full[:] = np.inf
+            linear = name in ('Q_th', 'Q_d', 'Q_a')
+            full[1:-1, 1:-1] = prolong(getattr(grid, name)[halo], r, linear)
+            states[name] = full
+        states['Q_v'][states['Q_th'] <= 0] = 0  # No speed without a current (as in Hexgrid)
+        fine = Hexgrid(Nx, Ny, ICstates=[states['Q_th'], states['Q_v'], states['Q_cj'], states['Q_cbj'],
+                                         states['Q_d'], np.zeros((Ny, Nx, 6))],
+                       reposeAngle=grid.reposeAngle, dx=grid.dx / r)
+        for name in CONSTANTS:
+            setattr(fine, name, getattr(grid, name))
+        fine.Q_a = states['Q_a']
+        fine.t = grid.t
+        return Patch(r0, r1, c0, c1, fine)
+
+    def copy_overlap(self, old, new):
+        r0, r1 = max(old.r0, new.r0), min(old.r1, new.r1)
+        c0, c1 = max(old.c0, new.c0), min(old.c1, new.c1)
+        if r0 >= r1 or c0 >= c1:
+            return
+        r = self.ratio
+        src = np.s_[1 + (r0 - old.r0) * r:1 + (r1 - old.r0) * r, 1 + (c0 - old.c0) * r:1 + (c1 - old.c0) * r]
+        dst = np.s_[1 + (r0 - new.r0) * r:1 + (r1 - new.r0) * r, 1 + (c0 - new.c0) * r:1 + (c1 - new.c0) * r]
+        for name in SUBSTATES:
+            getattr(new.grid, name)[dst] = getattr(old.grid, name)[src]
+
+    def patch_ids(self):
+        '''(Ny, Nx) array with the index of the patch covering each coarse cell, -1 if none.'''
+        ids = np.full((self.grid.Ny, self.grid.Nx), -1)
+        for n, patch in enumerate(self.patches):
+            ids[patch.window] = n
+        return ids
+
+    ################################ Time stepping ################################
+
+    def time_step(self):
+        grid = self.grid
+        grid.dt = grid.calc_dt()
+        if not np.isfinite(grid.dt):
+            self.step_bed()
+            return
+        grid.dt = min(grid.dt, grid.dt_max)
+        grid.t += grid.dt
+        ids = self.patch_ids()
+        grid.T_1()
+        grid.T_2()
+        grid.I_1()
+        current = self.current_exchange(ids)
+        grid.I_2()
+        grid.I_3()
+        grid.I_4()
+        for patch in self.patches:
+            self.subcycle(patch, grid.t)
+        bed = self.bed_exchange(ids)
+        for patch in self.patches:
+            self.apply_exchange(patch, current, bed)
+            self.restrict_patch(patch)
+        self.end_step()
+
+    def step_bed(self):
+        ids = self.patch_ids()
+        self.grid.I_4()
+        for patch in self.patches:
+            patch.grid.I_4()
+        bed = self.bed_exchange(ids)
+        for patch in self.patches:
+            self.apply_exchange(patch, None, bed)
+            self.restrict_patch(patch)
+        self.end_step()
+
+    def end_step(self):
+        self.steps += 1
+        if self.regrid_every and self.steps % self.regrid_every == 0:
+            self.regrid()
+        self.notify()
+
+    def subcycle(self, patch, t):
+        '''Advances a patch with its own time step until it reaches the time t.'''
+        fine = patch.grid
+        for i in range(self.max_subcycles):
+            if fine.t >= t:
+                return
+            fine.dt_max = t - fine.t
+            fine.time_step()
+            if not np.isfinite(fine.dt):  # No current in the patch
+                fine.t = t
+                return
+        raise RuntimeError('Patch needs more than %d subcycles' % self.max_subcycles)
+
+    def current_exchange(self, ids):
+        '''
+        Current and sediment exchanged across patch interfaces in the coarse step.\\
+        Must be called after I_1 and before I_2. Returns (outflow, inflow, sediment out, sediment in)\\
+        per interior coarse cell.
+        '''
+        grid = self.grid
+        centre = ids[1:-1, 1:-1]
+        out = np.zeros(centre.shape)
+        inn = np.zeros(centre.shape)
+        sed_in = np.zeros(centre.shape + (grid.Nj,))
+        for k in range(6):
+            interface = (centre >= 0) & (ids[grid.NEIGHBOR[k]] != centre)
+            out += np.where(interface, grid.Q_o[1:-1, 1:-1, k], 0)
+            inflow = np.where(interface, grid.Q_o[grid.NEIGHBOR[k] + (OPPOSITE[k],)], 0)
+            inn += inflow
+            sed_in += inflow[:, :, np.newaxis] * grid.Q_cj[grid.NEIGHBOR[k]]
+        sed_out = out[:, :, np.newaxis] * grid.Q_cj[1:-1, 1:-1]
+        return out, inn, sed_out, sed_in
+
+    def bed_exchange(self, ids):
+        '''
+        Bed thickness exchanged across patch interfaces by the toppling rule of the coarse step.\\
+        Must be called after the patches are subcycled: a covered cell cannot give away more bed than its\\
+        children hold, and what it cannot give is taken back from the coarse cells that received it.
+        '''
+        grid = self.grid
+        centre = ids[1:-1, 1:-1]
+        deltaS = np.zeros((grid.Ny, grid.Nx, 6))
+        deltaS[1:-1, 1:-1] = grid.deltaS
+        interface = [ids[grid.NEIGHBOR[k]] != centre for k in range(6)]
+
+        def exchange(deltaS):
+            change = np.zeros(centre.shape)
+            for k in range(6):
+                change -= np.where(interface[k], deltaS[1:-1, 1:-1, k], 0)
+                change += np.where(interface[k], deltaS[grid.NEIGHBOR[k] + (OPPOSITE[k],)], 0)
+            return change
+
+        before = exchange(deltaS)
+        outgoing = sum(np.where(interface[k] & (centre >= 0), deltaS[1:-1, 1:-1, k], 0) for k in range(6))
+        available = np.zeros(centre.shape)
+        for patch in self.patches:
+            available[patch.r0 - 1:patch.r1 - 1, patch.c0 - 1:patch.c1 - 1] = patch.children('Q_d').mean(axis=(1, 3))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            scale = np.where(outgoing > available, available / outgoing, 1)
+        deltaS[1:-1, 1:-1] *= scale[:, :, np.newaxis]
+        change = exchange(deltaS)
+
+        # Uncovered coarse cells already got the unlimited exchange in I_4
+        correction = np.where(centre < 0, change - before, 0)
+        if np.any(correction):
+            Q_d = grid.Q_d[1:-1, 1:-1]
+            Q_cbj = grid.Q_cbj[1:-1, 1:-1]
+            with np.errstate(divide='ignore', invalid='ignore'):
+                Q_cbj[:] = np.nan_to_num((Q_d[:, :, np.newaxis] * Q_cbj + correction[:, :, np.newaxis])
+                                         / (Q_d + correction)[:, :, np.newaxis], posinf=0)
+            Q_cbj[Q_cbj < 1e-15] = 0
+            Q_d += correction
+            grid.Q_a[1:-1, 1:-1] += correction
+        return change
+
+    def apply_exchange(self, patch, current, bed):
+        '''Applies the interface exchange of the covered coarse cells to their fine children.'''
+        window = np.s_[patch.r0 - 1:patch.r1 - 1, patch.c0 - 1:patch.c1 - 1]  # Interior indices
+        expand = np.s_[:, np.newaxis, :, np.newaxis]
+        if current is not None:
+            out, inn, sed_out, sed_in = (a[window] for a in current)
+            th = patch.children('Q_th')
+            cj = patch.children('Q_cj')
+            sed = th[..., np.newaxis] * cj
+            with np.errstate(divide='ignore', invalid='ignore'):
+                keep = np.clip(1 - out / th.mean(axis=(1, 3)), 0, 1)
+                keep_sed = np.clip(1 - sed_out / sed.mean(axis=(1, 3)), 0, 1)
+            keep[~np.isfinite(keep)] = 1
+            keep_sed[~np.isfinite(keep_sed)] = 1
+            th *= keep[expand]
+            th += inn[expand]
+            sed = sed * keep_sed[expand] + sed_in[expand]
+            with np.errstate(divide='ignore', invalid='ignore'):
+                cj[:] = np.nan_to_num(sed / th[..., np.newaxis], posinf=0)
+            patch.children('Q_v')[th <= 0] = 0
+        change = bed[window]
+        if np.any(change):
+            d = patch.children('Q_d')
+            oldQ_d = d.copy()
+            with np.errstate(divide='ignore', invalid='ignore'):
+                removed = np.clip(-change / d.mean(axis=(1, 3)), 0, 1)
+            removed[~np.isfinite(removed)] = 0
+            d *= 1 - removed[expand]
+            d += np.maximum(change, 0)[expand]
+            patch.children('Q_a')[:] += d - oldQ_d
+            cbj = patch.children('Q_cbj')
+            with np.errstate(divide='ignore', invalid='ignore'):
+                cbj[:] = np.nan_to_num((oldQ_d[..., np.newaxis] * cbj + (d - oldQ_d)[..., np.newaxis])
+                                       / d[..., np.newaxis], posinf=0)
+            cbj[cbj < 1e-15] = 0  # As in Hexgrid.I_4
+
+    def restrict_patch(self, patch):
+        '''Overwrites the covered coarse cells with the average of their fine children.'''
+        grid = self.grid
+        fine = patch.grid
+        r = self.ratio
+        inner = np.s_[1:-1, 1:-1]
+        th = fine.Q_th[inner]
+        grid.Q_th[patch.window] = restrict(th, r)
+        grid.Q_v[patch.window] = restrict(fine.Q_v[inner], r, weights=th)
+        grid.Q_cj[patch.window] = restrict(fine.Q_cj[inner], r, weights=th)
+        grid.Q_cbj[patch.window] = restrict(fine.Q_cbj[inner], r, weights=fine.Q_d[inner])
+        grid.Q_d[patch.window] = restrict(fine.Q_d[inner], r)
+        grid.Q_a[patch.window] = restrict(fine.Q_a[inner], r)
+
+    def fine_cells(self):
+        '''Number of fine cells in all patches.'''
+        return sum((p.grid.Ny - 2) * (p.grid.Nx - 2) for p in self.patches)
@@ -0,0 +1,322 @@
+'''
+Command-line runner for scenario files.
+
+Usage:
+
+    python -m runner scenario.toml [--steps N] [--until T] [--threads N] [--engine NAME]
+                                   [--profile [FILE]] [--checkpoint-every N] [--output DIR]
+
+A scenario is a TOML (or JSON) file with the sections [grid], [bed], [[sources]],
+[constants], [run], [output] and optionally [cache] (see terraincache.py) and [multilevel] (a coarse-to-fine
+warm start, see multilevel.py). See scenarios/main.toml for an example.
+Command-line options override the values in the [run] and [output] sections.
+The engines numpy (Hexgrid.run), flat (celllist.py), compiled (compiled.py, needs numba) and streaming
+(streaming.py) run the same model (see verification.py). multirate (multirate.py) is an approximation
+with a time step per region of the grid, which gives different results: e.g. flows die out later, and
+the current on the river terrain may not get going at all.
+The runner is headless: it never imports matplotlib itself.
+'''
+import argparse
+import json
+import math
+import os
+import sys
+
+THREAD_VARIABLES = ('OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS', 'NUMEXPR_NUM_THREADS')
+
+
+def load_scenario(path):
+    '''
+    Reads a scenario file. Files ending in .json are read as JSON, everything else as TOML.
+
+    :param path: Path to the scenario file
+    :return: The scenario as a dict
+    '''
+    if path.endswith('.json'):
+        with open(path) as file:
+            return json.load(file)
+    import tomllib
+    with open(path, 'rb') as file:
+        return tomllib.load(file)
+
+
+def build_grid(scenario):
+    '''
+    Creates a Hexgrid with the initial conditions described by a scenario.
+
+    :param scenario: Scenario dict (see load_scenario)
+    :return: Hexgrid
+    '''
+    import numpy as np
+    import mathfunk as ma
+    from hexgrid import Hexgrid
+
+    grid_cfg = scenario.get('grid', {})
+    bed = scenario.get('bed', {})
+    constants = dict(scenario.get('constants', {}))
+    Nx = grid_cfg['Nx']
+    Ny = grid_cfg['Ny']
+    Nj = len(constants.get('rho_j', [2650]))
+
+    Q_th = np.zeros((Ny, Nx))
+    Q_v = np.zeros((Ny, Nx))
+    Q_cj = np.zeros((Ny, Nx, Nj))
+    Q_cbj = np.zeros((Ny, Nx, Nj))
+    Q_d = np.ones((Ny, Nx)) * np.inf
+    Q_o = np.zeros((Ny, Nx, 6))
+    Q_d[1:-1, 1:-1] = bed.get('Q_d', 0)
+    Q_cbj[1:-1, 1:-1] = bed.get('Q_cbj', [0] * Nj)
+
+    for source in scenario.get('sources', []):
+        y, x = source['cell']
+        Q_th[y, x] = source.get('Q_th', 0)
+        Q_v[y, x] = source.get('Q_v', 0)
+        Q_cj[y, x] = source.get('Q_cj', [0] * Nj)
+        if 'Q_d' in source:
+            Q_d[y, x] = source['Q_d']
+
+    cache = None
+    if 'cache' in scenario:
+        from terraincache import TerrainCache
+        cache = TerrainCache(scenario['cache'].get('dir'), scenario['cache'].get('max_bytes', 2 ** 30))
+
+    grid = Hexgrid(Nx, Ny, ICstates=[Q_th, Q_v, Q_cj, Q_cbj, Q_d, Q_o],
+                   reposeAngle=np.deg2rad(grid_cfg.get('repose_angle', 0)),
+                   dx=grid_cfg.get('dx', 1), terrain=grid_cfg.get('terrain'), cache=cache,
+                   layout=grid_cfg.get('layout'))
+
+    for name in ('rho_j', 'D_sj'):
+        if name in constants:
+            constants[name] = np.array(constants[name], dtype=float)
+    for name, value in constants.items():
+        if not hasattr(grid, name):
+            raise KeyError('Unknown constant in scenario: %s' % name)
+        setattr(grid, name, value)
+    grid.Nj = Nj
+    grid.classThreads = scenario.get('run', {}).get('threads', 1)
+    if 'v_sj' not in constants:
+        grid.v_sj = ma.calc_settling_speed(grid.D_sj, grid.rho_a, grid.rho_j, grid.g, grid.nu)
+    return grid
+
+
+def run_numpy(grid, max_steps=None, until=None, callback=None, callback_every=1):
+    return grid.run(max_steps=max_steps, until=until, callback=callback)
+
+
+def run_flat(grid, max_steps=None, until=None, callback=None, callback_every=1):
+    '''
+    Runs on the flat cell list of the active cells (see celllist.py) and writes the state back into grid.\
+    The state is only written back every callback_every steps (0 = at the end), before the callback of that\
+    step. The callbacks of the other steps see grid as it was last written.
+    '''
+    from celllist import FlatHexgrid
+    flat = FlatHexgrid.from_hexgrid(grid)
+    steps = [0]
+
+    def step(flat):
+        steps[0] += 1
+        if callback_every and steps[0] % callback_every == 0:
+            flat.to_hexgrid(grid)
+        return callback(grid)
+
+    report = flat.run(max_steps=max_steps, until=until, callback=None if callback is None else step)
+    flat.to_hexgrid(grid)
+    return report
+
+
+def run_compiled(grid, max_steps=None, until=None, callback=None, callback_every=1):
+    '''Runs the whole loop in compiled code (see compiled.py), returning to Python only for the callback.'''
+    from compiled import run_compiled
+    report = run_compiled(grid, max_steps=max_steps, until=until, callback=callback, callback_every=callback_every)
+    del report['diagnostics']
+    return report
+
+
+def run_streaming(grid, max_steps=None, until=None, callback=None, callback_every=1):
+    '''Runs I_1, I_2 and I_3 strip by strip, without the outflows Q_o (see streaming.py).'''
+    from streaming import StreamingHexgrid
+    streaming = StreamingHexgrid.from_hexgrid(grid)
+    grid.Q_o = grid.classZeros((grid.Ny, grid.Nx, 6))  # Never written, so it takes no memory
+    report = streaming.run(max_steps=max_steps, until=until,
+                           callback=None if callback is None else lambda streaming: callback(streaming.to_hexgrid(grid)))
+    streaming.to_hexgrid(grid)
+    return report
+
+
+def run_multirate(grid, max_steps=None, until=None, callback=None, callback_every=1):
+    '''
+    Runs with a time step per rate level of the cells (see multirate.py). A step is a macro step. The results\
+    differ from those of the other engines.
+    '''
+    from multirate import MultirateHexgrid
+    return MultirateHexgrid(grid).run(max_steps=max_steps, until=until,
+                                      callback=None if callback is None else lambda multirate: callback(grid))
+
+
+# Engines are called as engine(grid, max_steps, until, callback, callback_every). The callback has to be
+# called after every step, but only does something every callback_every steps (0 = only at the end).
+ENGINES = {'numpy': run_numpy, 'flat': run_flat, 'compiled': run_compiled, 'streaming': run_streaming,
+           'multirate': run_multirate}
+
+
+def save_state(grid, path, step):
+    '''Saves the substates of a grid to a .npz file.'''
+    import numpy as np
+    np.savez(path, Q_th=grid.Q_th, Q_v=grid.Q_v, Q_cj=grid.Q_cj, Q_cbj=grid.Q_cbj,
+             Q_d=grid.Q_d, Q_a=grid.Q_a, t=grid.t, step=step)
+
+
+def run_scenario(scenario, steps=None, until=None, engine='numpy', checkpoint_every=0, output=None,
+                 history_every=0, history_options=None, on_step=None, on_step_every=0, pyramid_every=0,
+                 pyramid_options=None, reducers=None, reducer_options=None):
+    '''
+    Builds and runs a scenario.
+
+    :param scenario: Scenario dict (see load_scenario)
+    :param steps: Maximum number of time steps
+    :param until: Simulated time at which to stop
+    :param engine: Name of the engine used to advance the grid (a key of ENGINES)
+    :param checkpoint_every: Save the state every checkpoint_every steps (0 = never)
+    :param output: Output directory. Nothing is written if None.
+    :param history_every: Record a delta-encoded history frame every history_every steps (0 = never)
+    :param history_options: Keyword arguments for history.DeltaHistoryWriter
+    :param on_step: Called as on_step(grid, step) every on_step_every steps, e.g. to report progress
+    :param on_step_every: Steps between calls of on_step (0 = never)
+    :param pyramid_every: Record a multi-resolution pyramid frame every pyramid_every steps (0 = never)
+    :param pyramid_options: Keyword arguments for pyramid.PyramidWriter
+    :param reducers: Names of reducers.REDUCERS to update after every step and write to reducers.npz at the end.\
+    Needs output. The reducers see every step, so the flat and compiled engines write their state back into\
+    the grid after every step, which takes much of the speed of the compiled engine on small grids.
+    :param reducer_options: Keyword arguments for reducers.Reducers
+    :return: (grid, report)
+    '''
+    if engine not in ENGINES:
+        raise ValueError('Unknown engine %r. Choose from %s' % (engine, ', '.join(sorted(ENGINES))))
+    if reducers and output is None:
+        raise ValueError('Reducers are written to the output directory, but there is none')
+    grid = build_grid(scenario)
+    if output is not None:
+        os.makedirs(output, exist_ok=True)
+
+    # The warm start replaces the initial state, so the outputs start from its result
+    coarse = None
+    if 'multilevel' in scenario:
+        from multilevel import warm_start
+        cfg = scenario['multilevel']
+        if cfg.get('until') is None and cfg.get('steps') is None:
+            raise ValueError('[multilevel] needs until or steps to end the coarse phase')
+        coarse = warm_start(grid, ratio=cfg.get('ratio', 2), until=cfg.get('until'), max_steps=cfg.get('steps'))
+        coarse['t'] = float(coarse['t'])
+
+    history = None
+    if output is not None and history_every:
+        from history import DeltaHistoryWriter
+        history = DeltaHistoryWriter(os.path.join(output, 'history'), **(history_options or {}))
+        history.record(grid, step=0)
+
+    pyramid = None
+    if output is not None and pyramid_every:
+        from pyramid import PyramidWriter
+        pyramid = PyramidWriter(os.path.join(output, 'pyramid'), **(pyramid_options or {}))
+        pyramid.record(grid, step=0)
+
+    reducer = None
+    if reducers:
+        from reducers import Reducers
+        reducer = Reducers(grid, reducers, **(reducer_options or {}))
+
+    step = [0]
+    every = math.gcd(checkpoint_every if output is not None else 0, history_every if history is not None else 0,
+                     pyramid_every if pyramid is not None else 0, on_step_every if on_step is not None else 0,
+                     1 if reducer is not None else 0)
+
+    def callback(grid):
+        step[0] += 1
+        if output is not None and checkpoint_every and step[0] % checkpoint_every == 0:
+            save_state(grid, os.path.join(output, 'checkpoint_%06d.npz' % step[0]), step[0])
+        if history is not None and step[0] % history_every == 0:
+            history.record(grid, step=step[0])
+        if pyramid is not None and step[0] % pyramid_every == 0:
+            pyramid.record(grid, step=step[0])
+        if reducer is not None:
+            reducer.update(grid)
+        if on_step is not None and on_step_every and step[0] % on_step_every == 0:
+            on_step(grid, step[0])
+
+    report = ENGINES[engine](grid, max_steps=steps, until=until, callback=callback, callback_every=every)
+    report['t'] = float(report['t'])
+    if coarse is not None:
+        report['warm_start'] = coarse
+    if history is not None:
+        history.close()
+    if pyramid is not None:
+        pyramid.close()
+    if reducer is not None:
+        reducer.write(os.path.join(output, 'reducers.npz'))
+    if output is not None:
+        save_state(grid, os.path.join(output, 'final.npz'), step[0])
+        with open(os.path.join(output, 'report.json'), 'w') as file:
+            json.dump(report, file, indent=2)
+    return grid, report
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m runner', description='Run a turbidity current scenario.')
+    parser.add_argument('scenario', help='Scenario file (.toml or .json)')
+    parser.add_argument('--steps', type=int, help='Maximum number of time steps')
+    parser.add_argument('--until', type=float, help='Simulated time at which to stop')
+    parser.add_argument('--threads', type=int,
+                        help='Number of threads used by the numerical libraries and for the sediment classes in T_2')
+    parser.add_argument('--engine', help='Engine used to advance the grid: numpy, flat, compiled or streaming, '
+                                         'or multirate, an approximation that gives different results')
+    parser.add_argument('--profile', nargs='?', const='profile.pstats', metavar='FILE',
+                        help='Profile the run and write the statistics to FILE')
+    parser.add_argument('--checkpoint-every', type=int, metavar='N', help='Save the state every N steps')
+    parser.add_argument('--output', metavar='DIR', help='Output directory')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.threads is not None:
+        # Must be set before numpy/numexpr are imported
+        for name in THREAD_VARIABLES:
+            os.environ[name] = str(args.threads)
+
+    scenario = load_scenario(args.scenario)
+    if args.threads is not None:
+        scenario.setdefault('run', {})['threads'] = args.threads
+    run_cfg = scenario.get('run', {})
+    output_cfg = scenario.get('output', {})
+    kwargs = dict(
+        steps=args.steps if args.steps is not None else run_cfg.get('steps'),
+        until=args.until if args.until is not None else run_cfg.get('until'),
+        engine=args.engine or run_cfg.get('engine', 'numpy'),
+        checkpoint_every=(args.checkpoint_every if args.checkpoint_every is not None
+                          else output_cfg.get('checkpoint_every', 0)),
+        output=args.output or output_cfg.get('dir'),
+        history_every=output_cfg.get('history_every', 0),
+        history_options={name: output_cfg[name] for name in ('fields', 'keyframe_every', 'tolerance')
+                         if name in output_cfg},
+        pyramid_every=output_cfg.get('pyramid_every', 0),
+        pyramid_options={name: output_cfg['pyramid_' + name] for name in ('fields', 'ratio', 'min_size')
+                         if 'pyramid_' + name in output_cfg},
+        reducers=output_cfg.get('reducers'),
+        reducer_options={'threshold': output_cfg['reducer_threshold']} if 'reducer_threshold' in output_cfg else None,
+    )
+
+    if args.profile:
+        import cProfile
+        import pstats
+        profiler = cProfile.Profile()
+        grid, report = profiler.runcall(run_scenario, scenario, **kwargs)
+        profiler.dump_stats(args.profile)
+        pstats.Stats(profiler, stream=sys.stderr).sort_stats('cumulative').print_stats(20)
+    else:
+        grid, report = run_scenario(scenario, **kwargs)
+    print(json.dumps(report))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,114 @@
+'''
+Terrain shared between worker processes without copying.
+
+When many scenario runs on one basin are fanned out over processes, every worker would otherwise hold its
+own copies of the bathymetry Q_a, the bed thickness Q_d, the cell coordinates X and the bathymetry
+differences seaBedDiff. SharedTerrain publishes them once as .npy files, in /dev/shm (shared memory)
+when it exists. Workers memory-map them copy-on-write: all workers share the same physical pages, and a
+page is only copied into a worker when that worker modifies it, e.g. where its current erodes or
+deposits, or where the bed topples (T_2 and I_4 only write the cells whose bed changes). X and seaBedDiff
+are never modified and stay shared. A SharedTerrain is picklable (only its path is sent to the workers).
+
+The shared Q_d replaces the bed of the grid it is attached to, so every grid has to start from the bed
+of the published grid (the same Q_d in its ICstates) and use the same reposeAngle. attach checks both.
+
+Use:
+
+    terrain = SharedTerrain.publish(grid)
+    with multiprocessing.Pool() as pool:
+        pool.map(work, [(terrain, parameters) for parameters in sweep])
+    terrain.unlink()
+
+    def work(args):
+        terrain, parameters = args
+        grid = Hexgrid(terrain.Nx, terrain.Ny, ICstates=..., shared=terrain)
+'''
+import json
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+FIELDS = ('Q_a', 'Q_d', 'X', 'seaBedDiff')
+INDEX = 'terrain.json'
+
+
+def default_dir():
+    '''/dev/shm if it exists (RAM-backed and shared between processes), else the temporary directory.'''
+    return '/dev/shm' if os.path.isdir('/dev/shm') else None
+
+
+class SharedTerrain():
+    '''Read-only terrain fields published as memory-mappable files.'''
+
+    def __init__(self, path):
+        '''
+        :param path: Directory written by SharedTerrain.publish
+        '''
+        self.path = path
+        with open(os.path.join(path, INDEX)) as file:
+            index = json.load(file)
+        self.Nx = index['Nx']
+        self.Ny = index['Ny']
+        self.dx = index['dx']
+        self.reposeAngle = index['reposeAngle']
+
+    @classmethod
+    def publish(cls, grid, path=None):
+        '''
+        Writes the terrain fields of a Hexgrid.
+
+        :param grid: Hexgrid whose Q_a, Q_d, X and seaBedDiff are published
+        :param path: Directory to write to. Defaults to a new directory in /dev/shm.
+        :return: SharedTerrain
+        '''
+        if path is None:
+            path = tempfile.mkdtemp(dir=default_dir(), prefix='hexgrid-terrain-')
+        else:
+            os.makedirs(path, exist_ok=True)
+        for name in FIELDS:
+            np.save(os.path.join(path, name + '.npy'), np.asarray(getattr(grid, name)))
+        with open(os.path.join(path, INDEX), 'w') as file:
+            json.dump({'Nx': grid.Nx, 'Ny': grid.Ny, 'dx': grid.dx, 'reposeAngle': float(grid.reposeAngle)}, file)
+        return cls(path)
+
+    def load(self):
+        '''
+        :return: dict of copy-on-write memory-mapped arrays. Writes only affect the calling process.
+        '''
+        return {name: np.load(os.path.join(self.path, name + '.npy'), mmap_mode='c') for name in FIELDS}
+
+    def attach(self, grid):
+        '''
+        Replaces the terrain fields of a Hexgrid with copy-on-write views of the shared ones.
+
+        :param grid: Hexgrid whose Q_d (from its ICstates) and reposeAngle are those of the published grid
+        :raises ValueError: If the shape, dx, reposeAngle or Q_d of grid differ from those of the terrain.\
+        The shared Q_a and Q_d would otherwise silently replace a different bed of the run.
+        '''
+        if (grid.Ny, grid.Nx) != (self.Ny, self.Nx) or grid.dx != self.dx:
+            raise ValueError('Grid of shape (%d, %d) and dx = %g does not match the shared terrain (%d, %d), dx = %g'
+                             % (grid.Ny, grid.Nx, grid.dx, self.Ny, self.Nx, self.dx))
+        if float(grid.reposeAngle) != self.reposeAngle:
+            raise ValueError('Grid with reposeAngle = %g does not match the shared terrain, reposeAngle = %g'
+                             % (grid.reposeAngle, self.reposeAngle))
+        arrays = self.load()
+        if not np.array_equal(grid.Q_d, arrays['Q_d']):
+            raise ValueError('The Q_d of the grid differs from that of the shared terrain. Publish a terrain'
+                             ' for every bed, or start the grid from the same ICstates.')
+        for name, array in arrays.items():
+            setattr(grid, name, array)
+
+    def unlink(self):
+        '''Removes the published files. Grids that are attached keep working.'''
+        shutil.rmtree(self.path, ignore_errors=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.unlink()
+
+    def __reduce__(self):
+        return (SharedTerrain, (self.path,))
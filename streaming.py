@@ -0,0 +1,149 @@
+'''
+Strip-wise streaming of the transport rules.
+
+I_1 writes the outflows Q_o, a (Ny, Nx, 6) array that only I_2 and I_3 of the same step read. Together with
+the temporaries of I_1 and I_3 (angles, the sets A, height differences, ...), which have the same shape, the
+outflows take much of the memory of a large grid, and every one of these arrays is streamed through the
+cache once per rule. StreamingHexgrid evaluates I_1, I_2 and I_3 one strip of rows at a time instead, so
+the outflows and the temporaries only exist for one strip, while it is in cache.
+
+I_3 of a row needs Q_th and Q_cj after I_2 of the neighbouring rows, I_2 of those needs the outflows of
+their neighbours, and I_1 of those needs the substates of theirs. So the rows [a, b) are evaluated on a
+copy of the rows [a - HALO, b + HALO) with HALO = 3, of which only the rows [a, b) are kept. The new rows
+of a strip are written back once the next strip has been evaluated, as its halo still needs the old ones.
+The results are those of Hexgrid, bit for bit.
+
+The outflows are not kept, unless keepOutflows is set: then those of every strip are written into a full
+Q_o, as Hexgrid has it, e.g. for debugging.
+
+Use:
+
+    streaming = StreamingHexgrid.from_hexgrid(grid, rows=32)
+    streaming.run(max_steps=1000)
+    streaming.to_hexgrid(grid)
+'''
+import copy
+
+import numpy as np
+
+from hexgrid import Hexgrid
+
+HALO = 3  # Rows on either side of a strip that I_1, I_2 and I_3 together depend on
+CHANGED = ('Q_th', 'Q_v', 'Q_cj')  # Substates written by I_2 and I_3
+TOPPLING = ('diff', 'diffHeight', 'deltaS', 'toppleParameters')  # State I_4 keeps between calls
+
+
+def get_outflows(grid):
+    '''Q_o of a StreamingHexgrid, which only exists with keepOutflows.'''
+    if '_Q_o' not in grid.__dict__:
+        raise AttributeError('The outflows of a StreamingHexgrid are only kept with keepOutflows')
+    return Hexgrid.Q_o.fget(grid)
+
+
+class StreamingHexgrid(Hexgrid):
+    '''Hexgrid that evaluates I_1, I_2 and I_3 strip by strip, without a grid-sized Q_o.'''
+
+    SUBSTATES = ('Q_th', 'Q_v', 'Q_cj', 'Q_cbj', 'Q_d', 'Q_a')  # Q_o is only held with keepOutflows
+    Q_o = property(get_outflows, Hexgrid.Q_o.fset, doc=Hexgrid.Q_o.__doc__)
+    rows = 32  # Rows per strip
+    keepOutflows = False  # Write the outflows of every strip into a full Q_o
+
+    @classmethod
+    def from_hexgrid(cls, grid, rows=32, keepOutflows=False):
+        '''
+        Creates a StreamingHexgrid from a Hexgrid. The substates are shared with grid, except Q_o, which is\
+        only shared with keepOutflows.
+
+        :param grid: Hexgrid
+        :param rows: Rows per strip, at least HALO
+        :param keepOutflows: Write the outflows of every strip into a full Q_o
+        :return: StreamingHexgrid
+        :raises ValueError: If rows < HALO
+        '''
+        if rows < HALO:
+            raise ValueError('Strips need at least %d rows, got %d' % (HALO, rows))
+        for name in Hexgrid.SUBSTATES:
+            getattr(grid, name)  # Take the substates shared with forks of grid
+        streaming = cls.__new__(cls)
+        streaming.__dict__.update(grid.__dict__)
+        streaming.rows = rows
+        streaming.keepOutflows = keepOutflows
+        if not keepOutflows:
+            del streaming.__dict__['_Q_o']
+        return streaming
+
+    def to_hexgrid(self, grid):
+        '''Writes the state back into a Hexgrid of the same shape, e.g. the one it was created from, and returns it.'''
+        for name in self.SUBSTATES + (('Q_o',) if self.keepOutflows else ()):
+            if grid.__dict__.get('_' + name) is not self.__dict__['_' + name]:  # Not shared
+                getattr(grid, name)[...] = getattr(self, name)
+        for name in TOPPLING:
+            if name in self.__dict__:
+                setattr(grid, name, self.__dict__[name])
+        grid.t = self.t
+        grid.stepCount = self.stepCount
+        if hasattr(self, 'dt'):
+            grid.dt = self.dt
+        return grid
+
+    def fork(self):
+        '''Hexgrid.fork. A kept Q_o is copied.'''
+        child = super().fork()
+        if self.keepOutflows:
+            child.Q_o = self.Q_o.copy()
+        return child
+
+    def time_step(self):
+        '''Hexgrid.time_step, with I_1, I_2 and I_3 evaluated by transport.'''
+        self.dt = self.calc_dt()
+        if not np.isfinite(self.dt):
+            self.step_bed()
+            return
+        self.dt = min(self.dt, self.dt_max)
+        self.t += self.dt
+        self.T_1()
+        self.T_2()
+        self.transport()
+        self.I_4()
+        self.stepCount += 1
+        self.notify()
+
+    def transport(self):
+        '''Evaluates I_1, I_2 and I_3 on one strip of rows after the other.'''
+        if self.keepOutflows and '_Q_o' not in self.__dict__:
+            self.Q_o = self.classZeros((self.Ny, self.Nx, 6))
+        pending = None
+        for a in range(1, self.Ny - 1, self.rows):
+            strip = self.strip(a, min(a + self.rows, self.Ny - 1))
+            if pending is not None:
+                self.store(*pending)
+            pending = strip
+        if pending is not None:
+            self.store(*pending)
+
+    def strip(self, a, b):
+        '''
+        Evaluates I_1, I_2 and I_3 for the rows [a, b) on a copy of the rows [a - HALO, b + HALO).
+
+        :return: (a, b, first row of the copy, grid holding the copy)
+        '''
+        r0, r1 = max(a - HALO, 0), min(b + HALO, self.Ny)
+        part = copy.copy(self)
+        part.Ny = r1 - r0
+        for name in CHANGED:
+            setattr(part, name, getattr(self, name)[r0:r1].copy())
+        part.Q_a = self.Q_a[r0:r1]  # Only read
+        part.Q_o = part.classZeros((part.Ny, part.Nx, 6))
+        part.defineNeighbors()
+        part.I_1()
+        part.I_2()
+        part.I_3()
+        return a, b, r0, part
+
+    def store(self, a, b, r0, part):
+        '''Writes the rows [a, b) of a strip (see strip) back into the grid.'''
+        rows = np.s_[a - r0:b - r0]
+        for name in CHANGED:
+            getattr(self, name)[a:b] = getattr(part, name)[rows]
+        if self.keepOutflows:
+            self.Q_o[a:b] = part.Q_o[rows]
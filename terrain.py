@@ -0,0 +1,267 @@
+'''
+Seeded procedural terrains.
+
+Hexgrid.setBathymetry has two built-in terrains, 'river' and 'pit', which are evaluated on full-grid
+meshgrids. The generators here describe larger families of seabeds: a fractal slope, a sinuous
+channel with levees, a canyon on a steep slope feeding a fan on a gentle basin floor, and a slope of
+steps. They are functions of the positions of the cell centers, so they are evaluated block by block of
+rows, and only need temporaries of the size of a block, however large the grid.
+
+Positions are those of Hexgrid.X: the cells form a parallelogram, whose rows run down the slope. A
+generator is called with the distance s down the slope of each row and the position u across the slope
+of each cell, measured from the middle of the grid, and adds heights to the bathymetry Q_a. Lengths and
+heights are in the units of dx, and length options left as None are fractions of the size of the grid,
+so the same options give the same shapes on grids of any size and resolution.
+
+The random parts are value noise on integer lattices, whose values are a hash of the lattice point and
+the seed. A terrain only depends on its options and seed, not on the blocks it is evaluated in or on
+the order of the evaluation: the same seed gives the same terrain, also in a different process.
+
+Use:
+
+    grid = Hexgrid(Nx, Ny, ICstates=ICstates, terrain={'kind': 'channel', 'seed': 7, 'width': 20.0})
+
+or, in a scenario file:
+
+    [grid.terrain]
+    kind = "canyon_fan"
+    seed = 3
+'''
+import numpy as np
+
+BLOCK_CELLS = 2 ** 20  # Cells evaluated at once
+MASK = 2 ** 64 - 1
+
+
+def hash_uniform(ix, iy, key):
+    '''
+    :param ix, iy: Broadcastable integer arrays of lattice points
+    :param key: int, e.g. a seed
+    :return: Values uniform in [-1, 1), a hash of (ix, iy, key)
+    '''
+    h = (np.asarray(ix).astype(np.uint64) * np.uint64(0x9E3779B97F4A7C15)
+         ^ np.asarray(iy).astype(np.uint64) * np.uint64(0xC2B2AE3D27D4EB4F)
+         ^ np.uint64((key * 0x165667B19E3779F9) & MASK))
+    # Finalizer of SplitMix64
+    h ^= h >> np.uint64(30)
+    h *= np.uint64(0xBF58476D1CE4E5B9)
+    h ^= h >> np.uint64(27)
+    h *= np.uint64(0x94D049BB133111EB)
+    h ^= h >> np.uint64(31)
+    return (h >> np.uint64(11)) * 2.0 ** -52 - 1
+
+
+def value_noise(x, y, key):
+    '''
+    Smoothly interpolated random values on the integer lattice.
+
+    :param x, y: Broadcastable arrays of coordinates in lattice units
+    :param key: int
+    :return: Values in [-1, 1]
+    '''
+    x0 = np.floor(x)
+    y0 = np.floor(y)
+    ix = x0.astype(np.int64)
+    iy = y0.astype(np.int64)
+    # Values of the lattice points around the block only
+    ixMin, iyMin = ix.min(), iy.min()
+    table = hash_uniform(np.arange(ixMin, ix.max() + 2), np.arange(iyMin, iy.max() + 2)[:, np.newaxis], key)
+    a = ix - ixMin
+    b = iy - iyMin
+    fx = x - x0
+    fy = y - y0
+    sx = fx * fx * (3 - 2 * fx)
+    sy = fy * fy * (3 - 2 * fy)
+    top = table[b, a] + sx * (table[b, a + 1] - table[b, a])
+    bottom = table[b + 1, a] + sx * (table[b + 1, a + 1] - table[b + 1, a])
+    return top + sy * (bottom - top)
+
+
+def fbm(x, y, seed, wavelength, octaves=6, persistence=0.5, lacunarity=2.0):
+    '''
+    Fractal noise: a sum of value noise of decreasing wavelength and amplitude.
+
+    :param x, y: Broadcastable arrays of positions
+    :param seed: int
+    :param wavelength: Wavelength of the first octave
+    :param octaves: Number of octaves
+    :param persistence: Ratio of the amplitudes of consecutive octaves
+    :param lacunarity: Ratio of the frequencies of consecutive octaves
+    :return: Values in [-1, 1]
+    '''
+    total = 0
+    norm = 0
+    amplitude = 1.0
+    frequency = 1.0 / wavelength
+    for octave in range(octaves):
+        total = total + amplitude * value_noise(x * frequency, y * frequency, seed * 1024 + octave)
+        norm += amplitude
+        amplitude *= persistence
+        frequency *= lacunarity
+    return total / norm
+
+
+def smoothstep(x):
+    x = np.clip(x, 0, 1)
+    return x * x * (3 - 2 * x)
+
+
+def phases(seed, n):
+    '''n random phases of a seed, the same for every block.'''
+    return 2 * np.pi * (hash_uniform(np.arange(n), -1, seed) + 1) / 2
+
+
+def fractal(u, s, size, seed=0, slope=0.5, relief=None, wavelength=None, octaves=6, persistence=0.5):
+    '''
+    A plane slope with fractal roughness.
+
+    :param u: numpy.ndarray(rows, Nx), positions across the slope
+    :param s: numpy.ndarray(rows, 1), distances down the slope
+    :param size: (length, width) of the grid
+    :param seed: Seed
+    :param slope: Drop per length down the slope
+    :param relief: Amplitude of the roughness. Defaults to the drop over a tenth of the wavelength.
+    :param wavelength: Wavelength of the largest features. Defaults to a quarter of the grid.
+    :param octaves: Octaves of the roughness (see fbm)
+    :param persistence: Persistence of the roughness (see fbm)
+    :return: numpy.ndarray(rows, Nx) of heights
+    '''
+    wavelength = wavelength or max(size) / 4
+    relief = slope * wavelength / 10 if relief is None else relief
+    return -slope * s + relief * fbm(u, s, seed, wavelength, octaves, persistence)
+
+
+def channel(u, s, size, seed=0, slope=0.5, width=None, depth=None, meander=None, wavelength=None, levee=0.3,
+            roughness=0.05):
+    '''
+    A sinuous submarine channel with levees down a slope.
+
+    :param u, s, size, seed, slope: See fractal
+    :param width: Half width of the channel. Defaults to 1/20 of the width of the grid.
+    :param depth: Depth of the channel below the slope. Defaults to width / 4.
+    :param meander: Amplitude of the meanders. Defaults to 1/8 of the width of the grid.
+    :param wavelength: Wavelength of the meanders. Defaults to a third of the length of the grid.
+    :param levee: Height of the levees, as a fraction of depth
+    :param roughness: Amplitude of the roughness, as a fraction of depth
+    :return: numpy.ndarray(rows, Nx) of heights
+    '''
+    length, gridWidth = size
+    width = width or gridWidth / 20
+    depth = width / 4 if depth is None else depth
+    meander = gridWidth / 8 if meander is None else meander
+    wavelength = wavelength or length / 3
+    phase = phases(seed, 2)
+    k = 2 * np.pi / wavelength
+    # Center line, per row
+    center = meander * (np.sin(k * s + phase[0]) + 0.3 * np.sin(2.6 * k * s + phase[1])
+                        + 0.5 * fbm(0, s, seed + 1, wavelength, octaves=3))
+    d = np.abs(u - center) / width
+    heights = -depth * np.exp(-d * d) + levee * depth * np.exp(-((d - 1.5) / 0.75) ** 2)
+    heights += roughness * depth * fbm(u, s, seed + 2, 2 * width, octaves=4)
+    heights -= slope * s
+    return heights
+
+
+def canyon_fan(u, s, size, seed=0, slope=1.0, basin_slope=0.1, slope_break=0.4, width=None, depth=None,
+               fan_radius=None, fan_height=None, roughness=0.05):
+    '''
+    A canyon cut into a steep slope, which opens onto a fan on a gentle basin floor.
+
+    :param u, s, size, seed: See fractal
+    :param slope: Drop per length of the slope above the break
+    :param basin_slope: Drop per length of the basin floor below the break
+    :param slope_break: Distance of the break down the slope, as a fraction of the length of the grid
+    :param width: Half width of the canyon. Defaults to 1/15 of the width of the grid.
+    :param depth: Depth of the canyon at the top of the grid. Defaults to width.
+    :param fan_radius: Radius of the fan. Defaults to a quarter of the width of the grid.
+    :param fan_height: Height of the fan. Defaults to depth / 2.
+    :param roughness: Amplitude of the roughness, as a fraction of depth
+    :return: numpy.ndarray(rows, Nx) of heights
+    '''
+    length, gridWidth = size
+    sb = slope_break * length
+    width = width or gridWidth / 15
+    depth = width if depth is None else depth
+    fan_radius = fan_radius or gridWidth / 4
+    fan_height = depth / 2 if fan_height is None else fan_height
+    phase = phases(seed, 1)
+    soft = 0.05 * length  # Width of the transitions at the break
+    # Drop of the basin floor, and of the slope above the break, joined smoothly
+    profile = -basin_slope * s - (slope - basin_slope) * (sb - soft * np.logaddexp(0, (sb - s) / soft))
+    below = 1 / (1 + np.exp(-(s - sb) / soft))  # Per row: 0 above the break, 1 below
+    # V-shaped canyon, getting shallower towards the mouth
+    center = 0.05 * gridWidth * np.sin(3 * np.pi * s / sb + phase[0])
+    d = np.abs(u - center) / width
+    heights = profile - depth * np.sqrt(np.clip(1 - s / sb, 0, 1)) * np.maximum(1 - d, 0) ** 1.5
+    # Fan below the mouth, elongated down the slope, with lobes
+    r2 = (u / fan_radius) ** 2 + ((s - sb - 0.6 * fan_radius) / (1.5 * fan_radius)) ** 2
+    heights += (fan_height * below) * np.exp(-r2) * (1 + 0.3 * fbm(u, s, seed + 1, fan_radius / 2, octaves=3))
+    heights += roughness * depth * fbm(u, s, seed + 2, width, octaves=4)
+    return heights
+
+
+def stepped(u, s, size, seed=0, slope=0.5, steps=5, tread_slope=0.05, scarp_width=0.15, jitter=None,
+            roughness=0.02):
+    '''
+    A slope of terraces separated by scarps, which wander across the slope.
+
+    :param u, s, size, seed: See fractal
+    :param slope: Mean drop per length down the slope
+    :param steps: Number of scarps over the length of the grid
+    :param tread_slope: Drop per length of the terraces
+    :param scarp_width: Width of the scarps, as a fraction of the distance between them
+    :param jitter: Largest shift of the scarps down the slope. Defaults to a sixth of the distance between them.
+    :param roughness: Amplitude of the roughness, as a fraction of the drop of a scarp
+    :return: numpy.ndarray(rows, Nx) of heights
+    '''
+    spacing = size[0] / steps
+    drop = (slope - tread_slope) * spacing
+    jitter = spacing / 6 if jitter is None else jitter
+    shifted = (s + jitter * fbm(u, 0, seed, spacing, octaves=3)) / spacing
+    n = np.floor(shifted)
+    heights = -tread_slope * s - drop * (n + smoothstep((shifted - n - 1 + scarp_width) / scarp_width))
+    heights += roughness * drop * fbm(u, s, seed + 1, spacing / 4, octaves=4)
+    return heights
+
+
+GENERATORS = {'fractal': fractal, 'channel': channel, 'canyon_fan': canyon_fan, 'stepped': stepped}
+
+
+def parse(spec):
+    '''
+    :param spec: Name of a generator, or dict of 'kind', the name, and the options of the generator
+    :return: (generator, options)
+    :raises ValueError: If the generator is unknown
+    '''
+    if isinstance(spec, str):
+        kind, options = spec, {}
+    else:
+        options = dict(spec)
+        kind = options.pop('kind', None)
+    if kind not in GENERATORS:
+        raise ValueError('Unknown terrain %r. Choose from river, pit, %s' % (kind, ', '.join(GENERATORS)))
+    return GENERATORS[kind], options
+
+
+def add_terrain(Q_a, dx, spec, rows=None):
+    '''
+    Adds a terrain to a bathymetry block by block of rows.
+
+    :param Q_a: numpy.ndarray(Ny, Nx), updated in place. Infinite cells (the border) stay infinite.
+    :param dx: Cell size
+    :param spec: Terrain (see parse)
+    :param rows: Rows per block. Defaults to about BLOCK_CELLS cells per block.
+    :return: Q_a
+    '''
+    generator, options = parse(spec)
+    Ny, Nx = Q_a.shape
+    size = ((Ny - 1) * dx * np.sqrt(3) / 2, (Nx - 1) * dx)
+    middle = ((Nx - 1) / 2 + (Ny - 1) / 4) * dx  # x of the center of the grid
+    columns = np.arange(Nx) * dx - middle
+    rows = rows or max(1, BLOCK_CELLS // Nx)
+    for r0 in range(0, Ny, rows):
+        r = np.arange(r0, min(r0 + rows, Ny))[:, np.newaxis]
+        u = r * dx / 2 + columns
+        s = r * dx * np.sqrt(3) / 2
+        Q_a[r0:r0 + len(r)] += generator(u, s, size, **options)
+    return Q_a
@@ -0,0 +1,107 @@
+'''
+On-disk cache of terrain-derived precomputations.
+
+Hexgrid derives the cell coordinates X and the bathymetry differences seaBedDiff from the grid
+parameters and the bathymetry. The cache stores them as .npy files keyed by a content hash of
+Q_a, Q_d, Nx, Ny and dx, so that a new Hexgrid on a known basin can memory-map them instead of
+recomputing them. The cache is bounded in size; the least recently used entries are evicted first.
+
+Use:
+
+    cache = TerrainCache()  # $HEXGRID_CACHE or ~/.cache/hexgrid
+    grid = Hexgrid(Nx, Ny, ICstates=ICstates, terrain='river', cache=cache)
+'''
+import hashlib
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+FORMAT_VERSION = 1
+FIELDS = ('X', 'seaBedDiff')
+
+
+def default_cache_dir():
+    return os.environ.get('HEXGRID_CACHE', os.path.join(os.path.expanduser('~'), '.cache', 'hexgrid'))
+
+
+class TerrainCache():
+    '''Size-bounded LRU cache of terrain precomputations stored as memory-mappable .npy files.'''
+
+    def __init__(self, path=None, max_bytes=2 ** 30):
+        '''
+        :param path: Cache directory. Defaults to $HEXGRID_CACHE or ~/.cache/hexgrid.
+        :param max_bytes: Maximum total size of the cache on disk.
+        '''
+        self.path = os.path.expanduser(path) if path is not None else default_cache_dir()
+        self.max_bytes = max_bytes
+        os.makedirs(self.path, exist_ok=True)
+
+    @staticmethod
+    def key(Q_a, Q_d, Nx, Ny, dx):
+        '''Returns the content hash identifying a bathymetry and grid geometry.'''
+        h = hashlib.sha256()
+        h.update(repr((FORMAT_VERSION, Nx, Ny, float(dx))).encode())
+        for array in (Q_a, Q_d):
+            array = np.ascontiguousarray(array, dtype=np.float64)
+            h.update(repr(array.shape).encode())
+            h.update(array.data)
+        return h.hexdigest()
+
+    def load(self, key):
+        '''
+        Looks up an entry and marks it as recently used.
+
+        :return: dict of copy-on-write memory-mapped arrays, or None if the entry is not cached.
+        '''
+        entry = os.path.join(self.path, key)
+        try:
+            arrays = {name: np.load(os.path.join(entry, name + '.npy'), mmap_mode='c') for name in FIELDS}
+        except (FileNotFoundError, ValueError):
+            return None
+        os.utime(entry)
+        return arrays
+
+    def store(self, key, arrays):
+        '''Writes an entry atomically and evicts old entries if the cache is over its size limit.'''
+        entry = os.path.join(self.path, key)
+        if os.path.isdir(entry):
+            return
+        tmp = tempfile.mkdtemp(dir=self.path, prefix='.tmp-')
+        try:
+            for name in FIELDS:
+                np.save(os.path.join(tmp, name + '.npy'), arrays[name])
+            os.replace(tmp, entry)
+        except OSError:
+            shutil.rmtree(tmp, ignore_errors=True)
+            if not os.path.isdir(entry):
+                raise
+        self.evict(keep=key)
+
+    def entries(self):
+        '''Returns a list of (last use, size in bytes, key), least recently used first.'''
+        result = []
+        for key in os.listdir(self.path):
+            entry = os.path.join(self.path, key)
+            if key.startswith('.') or not os.path.isdir(entry):
+                continue
+            size = sum(os.path.getsize(os.path.join(entry, name)) for name in os.listdir(entry))
+            result.append((os.path.getmtime(entry), size, key))
+        return sorted(result)
+
+    def evict(self, keep=None):
+        '''Removes least recently used entries until the cache fits in max_bytes.'''
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        for _, size, key in entries:
+            if total <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            shutil.rmtree(os.path.join(self.path, key), ignore_errors=True)
+            total -= size
+
+    def clear(self):
+        for _, _, key in self.entries():
+            shutil.rmtree(os.path.join(self.path, key), ignore_errors=True)
@@ -0,0 +1,398 @@
+'''
+Differential checks of the engines against the NumPy Hexgrid.
+
+Every faster implementation of the rules (another memory layout, threads, the flat cell list, the compiled
+kernels, ...) has to give the results of Hexgrid. check runs the reference and a candidate in lockstep: in
+every step both compute the time step, then apply T_1, T_2, I_1, I_2, I_3 and I_4 one at a time, and after
+every rule all substates are compared cell by cell against per-field tolerances. The candidate uses the
+time step of the reference, so that a difference in calc_dt does not hide the later rules. The first
+comparison that fails is reported with the rule, step, substate and cell. With resync, the state of the
+reference is copied into the candidate after every comparison, so that each rule is checked on the same
+input and rounding differences can not accumulate. The engines have to agree exactly, except those that do
+not use the arithmetic of NumPy: they are checked that way by default, within a few ulps (see INEXACT).
+A candidate that applies several rules at once (e.g. the strips of streaming.py, or the macro steps of
+multirate.py) names them in its fusedRules, a dict of method -> rules, and is compared after the method
+instead of after each of the rules.
+
+The scenarios (SCENARIOS) cover a flat bed, the 'river' and 'pit' terrains, several sources and several
+sediment classes. The candidates (ENGINES) are built from the same scenario as the reference.
+
+MultirateHexgrid with more than one level does not give the results of Hexgrid (see multirate.py).
+multirate is checked exactly with levels=1, and accuracy runs 4 levels and Hexgrid on scenarios/main.toml
+and compares the simulated time at which the flow has used up its suspended load, which has to agree within
+MULTIRATE_BOUND. main runs it along with the checks of multirate.
+
+Use:
+
+    python -m verification [--engines flat compiled] [--scenarios river pit] [--steps N] [--resync | --lockstep]
+    python -m verification --accuracy
+
+    report = check('compiled', 'river', steps=50)
+    report['first']  # None, or {'rule': 'I_1', 'step': 3, 'field': 'Q_o', 'cell': (4, 7, 2), ...}
+'''
+import argparse
+import json
+import sys
+import warnings
+
+import numpy as np
+
+RULES = ('T_1', 'T_2', 'I_1', 'I_2', 'I_3', 'I_4')
+FIELDS = ('Q_th', 'Q_v', 'Q_cj', 'Q_cbj', 'Q_d', 'Q_a', 'Q_o')
+
+# (rtol, atol) per substate: |candidate - reference| <= atol + rtol * |reference|. 'dt' is the time step.
+# The engines do the arithmetic of Hexgrid in the same order, so they have to agree exactly. Engines that
+# do not get their own tolerances in INEXACT.
+TOLERANCES = dict.fromkeys(('dt',) + FIELDS, (0, 0))
+
+
+def scenario(Nx=20, Ny=20, terrain=None, sources=((2, 2),), Nj=1):
+    '''
+    A scenario dict for runner.build_grid: a bed of soft sediment and sources with a current.
+
+    :param Nx, Ny: Grid size
+    :param terrain: Terrain of Hexgrid.setBathymetry
+    :param sources: (row, column) of the source cells
+    :param Nj: Number of sediment classes
+    :return: dict
+    '''
+    return {'grid': {'Nx': Nx, 'Ny': Ny, 'dx': 1.0, 'repose_angle': 30.0, 'terrain': terrain},
+            'bed': {'Q_d': 1.0, 'Q_cbj': [0.4 / Nj] * Nj},
+            'sources': [{'cell': list(cell), 'Q_th': 1.5, 'Q_v': 0.2, 'Q_cj': [0.3 / Nj] * Nj, 'Q_d': 5.0}
+                        for cell in sources],
+            'constants': {'rho_j': [2650] * Nj, 'D_sj': np.linspace(0.0001, 0.00012, Nj).tolist()}}
+
+
+SCENARIOS = {
+    'flat': scenario(),
+    'river': scenario(terrain='river'),
+    'pit': scenario(terrain='pit'),
+    'sources': scenario(sources=((2, 2), (2, 15), (12, 8))),
+    'classes': scenario(Nj=3),
+}
+
+
+def build(scenario, **grid):
+    '''Builds the Hexgrid of a scenario, with the given [grid] settings changed.'''
+    import runner
+    return runner.build_grid(dict(scenario, grid=dict(scenario['grid'], **grid)))
+
+
+def flat(scenario):
+    from celllist import FlatHexgrid
+    return FlatHexgrid.from_hexgrid(build(scenario))
+
+
+def compiled(scenario):
+    from compiled import CompiledHexgrid
+    return CompiledHexgrid.from_hexgrid(build(scenario))
+
+
+def threaded(scenario):
+    grid = build(scenario)
+    grid.classThreads = 4
+    return grid
+
+
+def streaming(scenario):
+    from streaming import StreamingHexgrid
+    # Strips of 5 rows, so that the 20 rows of the scenarios take several, and the outflows are kept to compare
+    grid = StreamingHexgrid.from_hexgrid(build(scenario), rows=5, keepOutflows=True)
+    grid.fusedRules = {'transport': ('I_1', 'I_2', 'I_3')}
+    return grid
+
+
+def multirate(scenario):
+    from multirate import MultirateHexgrid
+    # With one level a macro step is a step of Hexgrid. The rules are those of the grid, so whole steps are checked.
+    grid = MultirateHexgrid(build(scenario), levels=1)
+    grid.fusedRules = {'time_step': RULES}
+    return grid
+
+
+# Candidates, built from a scenario dict
+ENGINES = {
+    'class': lambda scenario: build(scenario, layout='class'),
+    'threads': threaded,
+    'flat': flat,
+    'compiled': compiled,
+    'streaming': streaming,
+    'multirate': multirate,
+}
+
+# Engines whose arithmetic differs from that of NumPy, with the arguments check uses for them by default.
+# compiled calls libm's pow, which differs from the SIMD pow of NumPy in the last bit. Each rule agrees with
+# Hexgrid to a few ulps (at most 4e-14 relative where a concentration has lost most of its digits, 5e-16
+# absolute, over 100 steps of SCENARIOS), so it may differ by 1e-15 relative plus 1e-15 absolute, about 5
+# ulps of substates of order 1. Runs do not stay together: T_2 leaves a residue of an ulp, of either sign, in
+# Q_cj of a class that is deposited completely, and the sign of g' decides whether I_1 sends the current on
+# ('classes' separates at step 26). So compiled is checked rule by rule on the state of the reference.
+INEXACT = {'compiled': {'resync': True, 'tolerances': dict.fromkeys(('dt',) + FIELDS, (1e-15, 1e-15))}}
+
+# Largest relative difference in the time at which the flow on scenarios/main.toml has used up its suspended
+# load, between MultirateHexgrid with 4 levels and Hexgrid (measured: 43.3 against 33.75)
+MULTIRATE_BOUND = 0.35
+
+
+def stages(rules, fused=None):
+    '''
+    Groups the rules of a step into the stages after which the candidate is compared with the reference.
+
+    :param rules: Rules applied to the reference, in order
+    :param fused: dict of candidate methods that apply several rules at once -> those rules
+    :return: list of (name, rules of the reference, method of the candidate)
+    '''
+    result = []
+    i = 0
+    while i < len(rules):
+        for method, group in (fused or {}).items():
+            if tuple(rules[i:i + len(group)]) == tuple(group):
+                result.append((method, tuple(group), method))
+                i += len(group)
+                break
+        else:
+            result.append((rules[i], (rules[i],), rules[i]))
+            i += 1
+    return result
+
+
+def substates(grid, reference):
+    '''
+    :param grid: Hexgrid or celllist.FlatHexgrid
+    :param reference: Hexgrid of the same shape
+    :return: dict of the substates of grid as (Ny, Nx, ...) arrays. Cells a FlatHexgrid does not hold\
+    have the values of the reference.
+    '''
+    if not hasattr(grid, 'cells'):
+        return {name: getattr(grid, name) for name in FIELDS}
+    return {name: grid.cells.scatter(getattr(grid, name), getattr(reference, name).copy()) for name in FIELDS}
+
+
+def load(grid, reference):
+    '''Copies the substates, time and time step of the reference into grid.'''
+    for name in FIELDS:
+        values = getattr(reference, name)
+        if hasattr(grid, 'cells'):
+            getattr(grid, name)[:grid.N] = values[grid.cells.rows, grid.cells.cols]
+        else:
+            getattr(grid, name)[...] = values
+    grid.t = reference.t
+    grid.dt = reference.dt
+
+
+def compare(name, value, expected, tolerances=TOLERANCES):
+    '''
+    Compares a candidate value with the reference value, using tolerances[name]. inf and nan are equal\
+    to themselves.
+
+    :return: None if they agree, else a dict with the first failing cell and the number of failing cells
+    '''
+    rtol, atol = tolerances[name]
+    value = np.asarray(value, dtype=float)
+    expected = np.asarray(expected, dtype=float)
+    with np.errstate(invalid='ignore'):
+        bad = ~((np.abs(value - expected) <= atol + rtol * np.abs(expected)) | (value == expected)
+                | (np.isnan(value) & np.isnan(expected)))
+    if not bad.any():
+        return None
+    cell = np.unravel_index(np.argmax(bad), bad.shape)
+    return {'field': name, 'cell': tuple(int(i) for i in cell), 'reference': float(expected[cell]),
+            'candidate': float(value[cell]), 'cells': int(bad.sum())}
+
+
+def compare_grids(grid, reference, tolerances=TOLERANCES):
+    '''Returns the first substate in which grid and reference differ (see compare), or None.'''
+    values = substates(grid, reference)
+    for name in FIELDS:
+        failure = compare(name, values[name], getattr(reference, name), tolerances)
+        if failure is not None:
+            return failure
+    return None
+
+
+def check(engine, scenario, steps=20, resync=None, tolerances=None):
+    '''
+    Runs the reference Hexgrid and a candidate in lockstep and compares them after every rule.
+
+    :param engine: Name of a candidate in ENGINES, or a function building the candidate from a scenario dict
+    :param scenario: Name of a scenario in SCENARIOS, or a scenario dict
+    :param steps: Number of time steps
+    :param resync: Copy the reference state into the candidate after every rule. Defaults to True for the\
+    engines in INEXACT.
+    :param tolerances: dict of (rtol, atol) overriding entries of engine_tolerances, e.g. for a float32\
+    candidate
+    :return: dict with 'engine', 'scenario', 'steps' (the steps made) and 'first', the first failing\
+    comparison as a dict with 'rule', 'step', 'field', 'cell', 'reference', 'candidate' and 'cells'\
+    (the number of failing cells), or None if the candidate agrees everywhere
+    '''
+    spec = SCENARIOS[scenario] if isinstance(scenario, str) else scenario
+    make = ENGINES[engine] if isinstance(engine, str) else engine
+    if resync is None:
+        resync = INEXACT.get(engine, {}).get('resync', False) if isinstance(engine, str) else False
+    tolerances = dict(engine_tolerances(engine) if isinstance(engine, str) else TOLERANCES, **(tolerances or {}))
+    report = {'engine': engine if isinstance(engine, str) else getattr(engine, '__name__', repr(engine)),
+              'scenario': scenario if isinstance(scenario, str) else 'custom', 'steps': 0, 'first': None,
+              'resync': resync}
+    with warnings.catch_warnings(), np.errstate(all='ignore'):
+        warnings.simplefilter('ignore')
+        reference = build(spec)
+        candidate = make(spec)
+        failure = compare_grids(candidate, reference, tolerances)
+        if failure is not None:
+            report['first'] = dict(failure, rule='initial', step=0)
+            return report
+        for step in range(1, steps + 1):
+            dt = reference.calc_dt()
+            failure = compare('dt', candidate.calc_dt(), dt, tolerances)
+            if failure is not None:
+                report['first'] = dict(failure, rule='calc_dt', step=step)
+                return report
+            rules = RULES
+            if np.isfinite(dt):
+                reference.dt = min(dt, reference.dt_max)
+                reference.t += reference.dt
+            else:  # Bed only, as in Hexgrid.time_step
+                reference.dt = dt
+                rules = ('I_4',)
+            candidate.dt = reference.dt
+            candidate.t = reference.t
+            for rule, group, method in stages(rules, getattr(candidate, 'fusedRules', None)):
+                errors = []
+                for grid, calls in ((reference, group), (candidate, (method,))):
+                    try:
+                        for call in calls:
+                            getattr(grid, call)()
+                        errors.append(None)
+                    except (RuntimeError, FloatingPointError, ValueError) as error:
+                        errors.append(str(error))
+                if errors[0] != errors[1]:
+                    report['first'] = {'rule': rule, 'step': step, 'field': 'error', 'cell': None,
+                                       'reference': errors[0], 'candidate': errors[1], 'cells': 0}
+                    return report
+                if errors[0] is not None:  # Both fail in the same way: nothing left to compare
+                    report['steps'] = step
+                    report['error'] = errors[0]
+                    return report
+                failure = compare_grids(candidate, reference, tolerances)
+                if failure is not None:
+                    report['first'] = dict(failure, rule=rule, step=step)
+                    return report
+                if resync:
+                    load(candidate, reference)
+            report['steps'] = step
+    return report
+
+
+def engine_tolerances(engine):
+    '''TOLERANCES with the tolerances of the engine in INEXACT, if any.'''
+    return dict(TOLERANCES, **INEXACT.get(engine, {}).get('tolerances', {}))
+
+
+def used_up(grid, run, fraction=1e-12):
+    '''
+    Runs a grid until its suspended load is used up. The time at which run ends is no measure: once the load\
+    is used up, calc_dt is set by residues of rounding in Q_cj and the last steps are arbitrarily long.
+
+    :param grid: Hexgrid whose substates are advanced by run
+    :param run: Function running the grid, e.g. grid.run, taking a callback
+    :param fraction: Fraction of the peak suspended load (sum of Q_th * Q_cj) below which it is used up
+    :return: The time, or None if the load is not used up
+    '''
+    peak = [0.0]
+    result = []
+
+    def callback(model):
+        load = float(np.sum(grid.Q_th[1:-1, 1:-1, np.newaxis] * grid.Q_cj[1:-1, 1:-1]))
+        peak[0] = max(peak[0], load)
+        if load <= fraction * peak[0]:
+            result.append(float(grid.t))
+            return True
+
+    run(callback=callback)
+    return result[0] if result else None
+
+
+def accuracy(path='scenarios/main.toml', levels=4, max_steps=5000):
+    '''
+    Compares the simulated time of MultirateHexgrid with that of Hexgrid.run on a scenario file.
+
+    :param path: Scenario file
+    :param levels: Number of rate levels
+    :param max_steps: Largest number of steps of either run
+    :return: dict with 'reference' and 'multirate', the times at which the suspended load is used up (see\
+    used_up), 'error', their relative difference, and 'ok', whether it is within MULTIRATE_BOUND
+    '''
+    import runner
+    from multirate import MultirateHexgrid
+    spec = runner.load_scenario(path)
+    with warnings.catch_warnings(), np.errstate(all='ignore'):
+        warnings.simplefilter('ignore')
+        grid = runner.build_grid(spec)
+        reference = used_up(grid, lambda **kwargs: grid.run(max_steps=max_steps, **kwargs))
+        grid = runner.build_grid(spec)
+        multirate = MultirateHexgrid(grid, levels=levels)
+        candidate = used_up(grid, lambda **kwargs: multirate.run(max_steps=max_steps, **kwargs))
+    error = abs(candidate - reference) / reference if None not in (reference, candidate) else float('inf')
+    return {'scenario': path, 'levels': levels, 'reference': reference, 'multirate': candidate, 'error': error,
+            'ok': error <= MULTIRATE_BOUND}
+
+
+def describe(report):
+    '''One line describing a report of check.'''
+    head = '%-9s %-8s' % (report['engine'], report['scenario'])
+    first = report['first']
+    if first is None:
+        return head + ' ok (%d steps%s%s)' % (report['steps'], ', rule by rule' if report.get('resync') else '',
+                                              ', stopped: ' + report['error'] if 'error' in report else '')
+    if first['field'] == 'error':
+        return head + ' DIVERGES in %s at step %d: reference %r, candidate %r' % (
+            first['rule'], first['step'], first['reference'], first['candidate'])
+    return head + ' DIVERGES in %s at step %d: %s%s reference %.17g, candidate %.17g (%d cells)' % (
+        first['rule'], first['step'], first['field'], list(first['cell']), first['reference'], first['candidate'],
+        first['cells'])
+
+
+def print_accuracy(as_json=False):
+    '''Prints the report of accuracy. Returns True if it is not within MULTIRATE_BOUND.'''
+    report = accuracy()
+    print(json.dumps(report) if as_json else 'multirate levels=%d %s: load used up at t = %.4g, Hexgrid %.4g '
+          '(%.0f%%, bound %.0f%%)' % (report['levels'], report['scenario'], report['multirate'],
+                                     report['reference'], 100 * report['error'], 100 * MULTIRATE_BOUND))
+    return not report['ok']
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m verification',
+                                     description='Check engines rule by rule against the NumPy Hexgrid.')
+    parser.add_argument('--engines', nargs='+', default=sorted(ENGINES), choices=sorted(ENGINES))
+    parser.add_argument('--scenarios', nargs='+', default=list(SCENARIOS), choices=list(SCENARIOS))
+    parser.add_argument('--steps', type=int, default=20, help='Time steps per scenario')
+    parser.add_argument('--resync', action='store_true', default=None,
+                        help='Check every rule on the state of the reference')
+    parser.add_argument('--lockstep', action='store_false', dest='resync',
+                        help='Run every engine on its own state, also those in INEXACT')
+    parser.add_argument('--rtol', type=float, help='Relative tolerance for all substates and engines')
+    parser.add_argument('--atol', type=float, help='Absolute tolerance for all substates and engines')
+    parser.add_argument('--json', action='store_true', help='Print the reports as JSON')
+    parser.add_argument('--accuracy', action='store_true',
+                        help='Compare the simulated time of multirate with 4 levels with Hexgrid on scenarios/main.toml')
+    args = parser.parse_args(argv)
+
+    if args.accuracy:
+        return 1 if print_accuracy(args.json) else 0
+
+    def tolerances(engine):
+        return {name: (args.rtol if args.rtol is not None else rtol, args.atol if args.atol is not None else atol)
+                for name, (rtol, atol) in engine_tolerances(engine).items()}
+    reports = [check(engine, name, steps=args.steps, resync=args.resync, tolerances=tolerances(engine))
+               for engine in args.engines for name in args.scenarios]
+    for report in reports:
+        print(json.dumps(report) if args.json else describe(report))
+    failed = any(report['first'] is not None for report in reports)
+    if 'multirate' in args.engines:  # levels=1 is checked above, more levels against the bound
+        failed |= print_accuracy(args.json)
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())